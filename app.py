@@ -1,55 +1,106 @@
 import streamlit as st
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 import json
 import io 
+import functools
+import threading
+from collections import deque
+import perf
+from engine import COST_BASIS_METHODS, DEFAULT_CONFIG, LIMIT_MODE_OPTIONS, PRIORITIES, RESULT_CACHE, STEP_MODES, Checkpoint, config_hash, simulate_cached
+from jobs import JobSlot
+from solver import Evaluator, earliest_retirement_age, max_sustainable_cost, min_nisa_monthly
+from store import ScenarioStore, scenario_id
+
+# pandas・numpy・plotly と、それらを使うモンテカルロ・スイープは、使う関数の中で読み込む
+# (起動直後はサイドバーの入力欄を先に出し、重い読み込みは結果を描くところまで遅らせる)
 
 # ==========================================
 # ★ここにあなたのアプリのURLを貼り付けてください
 # （ブラウザのアドレスバーをコピーして上書きしてください）
+# ※共有リンクは開いているページの URL から作ります。URL が取れない場合だけこちらを使います
 SHARE_URL = "https://asset-simulator-easy-4urkwxcgh8csaxtx3bnbba.streamlit.app/"
 # ==========================================
 
-# --- デフォルト設定値 ---
-DEFAULT_CONFIG = {
-    "current_age": 33, "end_age": 100,
-    "ini_cash": 200, "ini_401k": 300, "ini_nisa": 100, "ini_paypay": 10,
-    "r_cash": 0.30, "r_401k": 5.0, "r_nisa": 5.0, "r_paypay": 6.0, "inflation": 2.0,
-    "age_work_last": 64,
-    "inc_20s": 300, "inc_30s": 400, "inc_40s": 500, "inc_50s": 600, "inc_60s": 400,
-    "age_401k_get": 65, "tax_401k": 12.0, "age_pension": 65, "pension_monthly": 200000, "tax_pension": 15.0,
-    
-    # 支出設定
-    "cost_20s": 20, "cost_30s": 25, "cost_40s": 30, "cost_50s": 30, 
-    "cost_6064": 28, "cost_65": 25,
-    "exp_20s": 50, "exp_30s": 100, "exp_40s": 150, "exp_50s": 100, 
-    "exp_6064": 80, "exp_65": 50,
-
-    "nisa_monthly": 50000,
-    "nisa_stop_age": 65,
-    "paypay_monthly": 300, "paypay_stop_age": 70,
-    "k401_monthly": 55000,
-    "k401_stop_age": 60,
-    "dam_1": 700, "dam_2": 700, "dam_3": 500,
-    "priority": "新NISAから先に使う",
-    "nisa_start_age": 65, "paypay_start_age": 60,
-    
-    # 上限設定
-    "limit_mode_nisa": "年額定額 (万円)",
-    "limit_val_nisa_yen": 0,
-    "limit_val_nisa_pct": 4.0,
-    "limit_mode_other": "年額定額 (万円)",
-    "limit_val_other_yen": 20,
-    "limit_val_other_pct": 4.0,
-    "tax_rate_other": 0.0,
-
-    "inc1_a": 55, "inc1_v": 500, "inc2_a": 0, "inc2_v": 0, "inc3_a": 0, "inc3_v": 0,
-    "dec1_a": 66, "dec1_v": 1000, "dec2_a": 0, "dec2_v": 0, "dec3_a": 0, "dec3_v": 0
-}
-
 # --- ヘルパー関数 ---
 
+# 点の数がこれを超えるグラフは WebGL (Scattergl) で描く
+WEBGL_MIN_POINTS = 2000
+
+ASSET_COLORS = {"Cash": "#90a4ae", "NISA": "#e57373", "401k": "#81c784", "Other": "#ba68c8"}
+
+# plotly 既定テンプレート (約7KB) のうち、白背景のグラフで見た目に効く部分だけを残したもの
+_AXIS_STYLE = dict(gridcolor="white", linecolor="white", zerolinecolor="white", zerolinewidth=2, ticks="",
+                   automargin=True, title=dict(standoff=15))
+CHART_TEMPLATE = dict(layout=dict(xaxis=_AXIS_STYLE, yaxis=_AXIS_STYLE, hoverlabel=dict(align="left")))
+
+GRAPH_MODES = ["積み上げ (総資産)", "折れ線 (個別推移)"]
+
+# --- 処理時間の計測 (URL に ?perf=1 を付けると、画面の下に計測パネルを出す) ---
+
+# セッションごとに残す直近の実行の件数
+PERF_HISTORY = 200
+
+def perf_enabled():
+    return st.query_params.get("perf") == "1"
+
+def record_perf(timings):
+    st.session_state.setdefault("perf_history", deque(maxlen=PERF_HISTORY)).append(timings.to_record())
+
+def timed_fragment(fn):
+    # フラグメントだけが再実行されたときも1回の実行として記録する (本体の実行中に呼ばれた場合はそのフェーズになる)
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with perf.run(fn.__name__, on_finish=record_perf, enabled=perf_enabled()), perf.phase(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+# --- バックグラウンドの計算 ---
+# 重い計算 (確率シミュレーション・スイープ・最適化) は jobs の作業スレッドで動かし、その間も画面の他の部分を操作できるようにする
+
+# この時間内に終わる計算は、途中経過を出さずにそのまま描く
+JOB_QUICK_SECONDS = 0.3
+# 計算中に途中経過を描き直す間隔 (秒)
+JOB_POLL_SECONDS = 0.5
+
+def job_slot(name):
+    return st.session_state.setdefault(name, JobSlot())
+
+def show_job(job, draw):
+    # draw(結果, partial): 終わっていれば結果を描く。計算中なら、この部分だけを定期的に再実行して途中経過と進み具合を描く
+    if job.wait(JOB_QUICK_SECONDS):
+        if job.error is not None:
+            st.error(f"⚠️ 計算に失敗しました: {job.error}")
+        elif job.cancelled:
+            st.info("入力が変わったため、計算を中止しました。")
+        else:
+            draw(job.result, partial=False)
+        return
+
+    @st.fragment(run_every=JOB_POLL_SECONDS)
+    def poll():
+        if job.done:
+            # 終わったら画面全体を描き直す (この定期的な再実行もそこで止まる)
+            st.rerun()
+        st.progress(job.progress, text=f"計算中... {job.progress * 100:.0f}% ({job.elapsed:.1f}秒)")
+        if job.partial is not None:
+            draw(job.partial, partial=True)
+    poll()
+
+def render_perf_panel():
+    import pandas as pd
+    timings = perf.current()
+    history = list(st.session_state.get("perf_history", ()))
+    with st.expander("⏱ 処理時間 (デバッグ用)", expanded=True):
+        # engine.* は逆算ソルバーなどからの呼び出しも含めた合計
+        st.caption("今回の実行 (ミリ秒)。名前に「.」を含むフェーズは、他のフェーズの内訳です。")
+        if timings is not None:
+            st.dataframe(pd.DataFrame({"ms": {name: t * 1000 for name, t in timings.phases.items()}}).round(3),
+                         use_container_width=True)
+        if history:
+            st.caption(f"このセッションの直近 {len(history)} 回 (フラグメントだけの再実行を含む)")
+            st.dataframe(pd.DataFrame(perf.summarize(history)).T.round(3), use_container_width=True)
+            st.download_button("📥 JSON Lines で保存", perf.to_jsonl(history), file_name="perf.jsonl",
+                               mime="application/jsonl")
+
 def load_uploaded_settings(uploaded_file):
     try:
         bytes_data = uploaded_file.getvalue()
@@ -63,6 +114,35 @@ def load_uploaded_settings(uploaded_file):
     except Exception as e:
         st.sidebar.error(f"⚠️ ファイル形式エラー: {e}")
 
+# --- 共有リンク (?s=シナリオID) ---
+
+@st.cache_resource
+def get_store():
+    # 保存先はプロセス内の全セッションで1つ
+    return ScenarioStore()
+
+def share_url(sid):
+    base = st.context.url or SHARE_URL
+    return f"{base.split('?')[0]}?s={sid}"
+
+def restore_shared_scenario():
+    # 共有リンクから開いた場合は設定を入力欄に戻し、保存済みの計算結果を共有キャッシュに入れる
+    # (この後の simulate_cached がキャッシュから返すので、計算は走らない)
+    sid = st.query_params.get("s")
+    if not sid or st.session_state.get("restored_scenario") == sid:
+        return
+    st.session_state["restored_scenario"] = sid
+    loaded = get_store().load(sid)
+    if loaded is None:
+        st.sidebar.warning("⚠️ 共有リンクの設定が見つかりませんでした (保存期間が過ぎた可能性があります)")
+        return
+    config, result = loaded
+    for key, value in config.items():
+        st.session_state[key] = value
+    if result is not None:
+        RESULT_CACHE.put(config_hash(config), result)
+    st.sidebar.success("🔗 共有された設定を読み込みました")
+
 def get_download_json():
     save_data = {}
     for key in DEFAULT_CONFIG.keys():
@@ -74,21 +154,453 @@ def next_step_guide(text):
     st.markdown("---")
     st.info(f"👉 **入力完了ですか？ 上のタブで『{text}』へ進んでください**")
 
+def draw_montecarlo(result, memory_mb, n_paths, partial=False):
+    import plotly.graph_objects as go
+    ages = result.ages
+    Trace = go.Scattergl if len(ages) * len(result.bands) > WEBGL_MIN_POINTS else go.Scatter
+
+    fig = go.Figure()
+    fig.add_trace(Trace(x=ages, y=result.bands[95], mode="lines", line=dict(width=0), showlegend=False, hoverinfo="skip"))
+    fig.add_trace(Trace(x=ages, y=result.bands[5], mode="lines", line=dict(width=0), fill="tonexty",
+                             fillcolor="rgba(161,136,127,0.25)", name="P5〜P95", hovertemplate="P5=%{y:,.0f}円<extra></extra>"))
+    fig.add_trace(Trace(x=ages, y=result.bands[75], mode="lines", line=dict(width=0), showlegend=False, hoverinfo="skip"))
+    fig.add_trace(Trace(x=ages, y=result.bands[25], mode="lines", line=dict(width=0), fill="tonexty",
+                             fillcolor="rgba(161,136,127,0.5)", name="P25〜P75", hovertemplate="P25=%{y:,.0f}円<extra></extra>"))
+    fig.add_trace(Trace(x=ages, y=result.bands[50], mode="lines", line=dict(color="#4e342e", width=2),
+                             name="中央値", hovertemplate="中央値=%{y:,.0f}円<extra></extra>"))
+    fig.update_layout(hovermode="x unified", plot_bgcolor="white", paper_bgcolor="white", template=CHART_TEMPLATE,
+                      font={"family": "Zen Kaku Gothic New", "color": "#5d5555"},
+                      margin=dict(l=20, r=20, t=40, b=20),
+                      legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1))
+    fig.update_xaxes(ticksuffix="歳")
+    st.plotly_chart(fig, use_container_width=True)
+
+    m1, m2, m3 = st.columns(3)
+    m1.metric(f"🎂 {int(ages[-1])}歳の総資産 (中央値)", f"{result.bands[50][-1]/10000:,.0f}万円")
+    m2.metric(f"⚠️ {int(ages[-1])}歳までに資金が尽きる確率", f"{result.ruin_prob[-1]*100:.1f}%")
+    m3.metric("⏱ 計算時間", f"{result.elapsed*1000:,.0f} ms", delta=f"{result.n_paths:,} パス", delta_color="off")
+    if partial:
+        st.caption(f"途中経過です ({result.n_paths:,} / {n_paths:,} パス)。パスが増えるにつれて帯が定まっていきます。")
+    elif result.peak_bytes is not None:
+        st.caption(f"{result.n_chunks} 回に分けて計算しました (メモリの使用量は見積もりで最大 約{result.peak_bytes / 1024 / 1024:,.0f}MB / "
+                   f"上限 {memory_mb}MB)。パーセンタイル帯は近似値です (誤差 約1%)。")
+
+    ruin = go.Figure(go.Scatter(x=ages, y=result.ruin_prob * 100, mode="lines", line=dict(color="#831843"),
+                                hovertemplate="%{y:.1f}%<extra></extra>"))
+    ruin.update_layout(height=250, plot_bgcolor="white", paper_bgcolor="white", template=CHART_TEMPLATE,
+                       margin=dict(l=20, r=20, t=30, b=20),
+                       title=dict(text="年齢別 資金が尽きている確率 (%)", font=dict(size=14)))
+    ruin.update_xaxes(ticksuffix="歳")
+    ruin.update_yaxes(range=[0, 100])
+    st.plotly_chart(ruin, use_container_width=True)
+
+# 分割計算のとき、途中経過をおよそ何回に分けて出すか
+MC_UPDATES = 10
+
+@st.fragment
+@timed_fragment
+def render_montecarlo(config):
+    st.caption("利回りとインフレ率を毎年ランダムに変動させ、多数のパスで資産の広がりを見ます。")
+    if not st.toggle("🎲 確率シミュレーションを実行する", key="mc_enabled"):
+        job_slot("mc_job").cancel()
+        return
+    import pandas as pd
+    from montecarlo import (BLOCK_PATHS, DEFAULT_CORRELATION, DEFAULT_VOLATILITY, MC_CACHE, MC_KEYS, MC_LABELS,
+                            STREAMING_MIN_PATHS, MonteCarloCheckpoint, montecarlo_cache_key, run_montecarlo_cached)
+
+    st.markdown("##### 変動の大きさ (年率の標準偏差 %)")
+    vol_cols = st.columns(len(MC_KEYS))
+    volatility = {}
+    for col, key in zip(vol_cols, MC_KEYS):
+        volatility[key] = col.number_input(MC_LABELS[key], 0.0, 50.0, DEFAULT_VOLATILITY[key], step=0.5, format="%.1f", key=f"mc_vol_{key}")
+    c_n, c_seed, c_mem = st.columns(3)
+    n_paths = c_n.selectbox("パス数", [1000, 5000, 10000, 20000, 50000, 100000, 200000], index=2, key="mc_paths")
+    seed = c_seed.number_input("乱数シード", 0, 99999, 0, key="mc_seed")
+    streaming = n_paths > STREAMING_MIN_PATHS
+    memory_mb = c_mem.selectbox("メモリの上限 (MB)", [64, 128, 256, 512], index=2, key="mc_memory", disabled=not streaming,
+                                help=f"{STREAMING_MIN_PATHS:,} パスを超えると、全パスを一度に持たずに分けて計算します。")
+    with st.expander("相関行列"):
+        labels = [MC_LABELS[key] for key in MC_KEYS]
+        corr_df = st.data_editor(pd.DataFrame(DEFAULT_CORRELATION, index=labels, columns=labels), key="mc_corr")
+
+    correlation = corr_df.to_numpy()
+    memory_limit = memory_mb * 1024 * 1024
+    draw = functools.partial(draw_montecarlo, memory_mb=memory_mb, n_paths=n_paths)
+    slot = job_slot("mc_job")
+    job_key = montecarlo_cache_key(config, n_paths, volatility, correlation, seed, memory_limit)
+    result = MC_CACHE.get(job_key)
+    if result is not None:
+        slot.cancel()
+        draw(result)
+        return
+
+    # 前回の計算の途中状態はセッションごとに持つ
+    checkpoint = st.session_state.setdefault("mc_checkpoint", MonteCarloCheckpoint())
+
+    def work(report):
+        # 分割計算ではパスの塊ごと、そうでなければ1年ごとに report を呼ぶ (入力が変わればそこで止まる)
+        return run_montecarlo_cached(config, n_paths, volatility, correlation, seed, checkpoint=checkpoint,
+                                     memory_limit=memory_limit, chunk_paths=max(BLOCK_PATHS, n_paths // MC_UPDATES),
+                                     on_chunk=lambda partial: report(partial, partial.n_paths / n_paths),
+                                     on_progress=lambda progress: report(progress=progress))
+
+    with perf.phase("render_montecarlo.simulate"):
+        show_job(slot.submit(job_key, work), draw)
+
+@st.fragment
+@timed_fragment
+def render_backtest(config):
+    st.caption("1970年以降の各年を開始年として、その年からの実際の株式リターン・預金金利・物価上昇率で今の計画を計算します。")
+    if not st.toggle("📜 過去データで検証する", key="bt_enabled"):
+        return
+    import numpy as np
+    import plotly.graph_objects as go
+    from backtest import run_backtest_cached
+
+    with perf.phase("render_backtest.simulate"):
+        result = run_backtest_cached(config)
+    picks = result.pick()
+    ages = result.ages
+    n = len(result.start_years)
+
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("⚠️ 資金が尽きた開始年の割合", f"{result.ruin_share*100:.1f}%", delta=f"{n} 通り", delta_color="off")
+    for col, (label, name) in zip((m2, m3, m4), (("最悪", "worst"), ("中央", "median"), ("最良", "best"))):
+        i = picks[name]
+        depletion = result.depletion_age[i]
+        col.metric(f"{label}: {result.start_years[i]}年開始", f"{result.total[i, -1]/10000:,.0f}万円",
+                   delta=f"{depletion}歳で枯渇" if depletion >= 0 else "尽きない", delta_color="off")
+
+    # 全ての開始年を薄い線1本にまとめ (途中に None を挟んで区切る)、最悪・中央・最良だけ色を付ける
+    xs = np.tile(np.append(ages, np.nan), n)
+    ys = np.column_stack([result.total, np.full(n, np.nan)]).ravel()
+    Trace = go.Scattergl if len(xs) > WEBGL_MIN_POINTS else go.Scatter
+    traces = [Trace(x=xs, y=ys, mode="lines", line=dict(color="rgba(161,136,127,0.25)", width=1),
+                    name="全ての開始年", hoverinfo="skip")]
+    for (label, name), color in zip((("最悪", "worst"), ("中央", "median"), ("最良", "best")), ("#831843", "#4e342e", "#2e7d32")):
+        i = picks[name]
+        traces.append(go.Scatter(x=ages, y=result.total[i], mode="lines", line=dict(color=color, width=2),
+                                 name=f"{label} ({result.start_years[i]}年〜)",
+                                 hovertemplate=f"{label}=%{{y:,.0f}}円<extra></extra>"))
+    st.plotly_chart(go.Figure(data=traces, layout=dict(
+        template=CHART_TEMPLATE, hovermode="x unified", plot_bgcolor="white", paper_bgcolor="white",
+        font={"family": "Zen Kaku Gothic New", "color": "#5d5555"}, margin=dict(l=20, r=20, t=40, b=20),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+        xaxis=dict(ticksuffix="歳"), yaxis=dict(title_text="総資産 (円)"),
+    )), use_container_width=True)
+
+    notes = ["データは概算値です。株式は米国株 (S&P500 配当込み, 米ドル建て・為替なし)、預金は日本の1年定期、物価は日本の CPI。401k は設定の利回りのままです。"]
+    if result.wrapped:
+        notes.append(f"計画の年数がデータ ({result.start_years[0]}年〜) より長いため、データの最後まで来たら最初の年に戻って続けています。")
+    st.caption(" ".join(notes))
+
+def sweep_heatmap(result, metric, slice_index=0):
+    import plotly.graph_objects as go
+    from sweep import METRICS, SWEEP_PARAMS
+    grid = result.grid(metric)
+    if grid.ndim == 3:
+        grid = grid[:, :, slice_index]
+    (key_y, values_y), (key_x, values_x) = result.axes[0], result.axes[1]
+    if metric == "final_total":
+        z, colorscale, unit = grid / 10000, "RdYlGn", "万円"
+    else:
+        z, colorscale, unit = grid, "YlOrRd_r", "歳"
+    fig = go.Figure(go.Heatmap(
+        x=values_x, y=values_y, z=z, colorscale=colorscale,
+        colorbar=dict(title=unit),
+        hovertemplate=f"{SWEEP_PARAMS[key_x][0]}=%{{x}}<br>{SWEEP_PARAMS[key_y][0]}=%{{y}}<br>%{{z:,.0f}}{unit}<extra></extra>",
+    ))
+    fig.update_layout(plot_bgcolor="white", paper_bgcolor="white", margin=dict(l=20, r=20, t=40, b=20),
+                      xaxis_title=SWEEP_PARAMS[key_x][0], yaxis_title=SWEEP_PARAMS[key_y][0],
+                      title=dict(text=METRICS[metric], font=dict(size=14)))
+    return fig
+
+@st.fragment
+@timed_fragment
+def render_sweep(config):
+    from sweep import METRICS, SWEEP_PARAMS, axis_values, run_sweep
+    st.caption("2〜3個の入力を格子状に振って一度に計算し、結果をヒートマップで比較します。")
+    n_axes = st.radio("軸の数", [2, 3], horizontal=True, key="sweep_n_axes")
+    keys = list(SWEEP_PARAMS)
+    defaults = ["age_work_last", "nisa_monthly", "cost_65"]
+    axes = []
+    for i in range(n_axes):
+        c_key, c_lo, c_hi, c_n = st.columns([3, 2, 2, 1])
+        key = c_key.selectbox(f"軸{i + 1}", keys, index=keys.index(defaults[i]), key=f"sweep_key_{i}",
+                              format_func=lambda k: SWEEP_PARAMS[k][0])
+        label, lo, hi = SWEEP_PARAMS[key]
+        v_lo = c_lo.number_input("最小", lo, hi, lo, key=f"sweep_lo_{i}_{key}")
+        v_hi = c_hi.number_input("最大", lo, hi, hi, key=f"sweep_hi_{i}_{key}")
+        steps = c_n.number_input("分割", 2, 100, 50 if i < 2 else 5, key=f"sweep_n_{i}")
+        axes.append((key, axis_values(key, v_lo, v_hi, steps)))
+    metric = st.radio("表示する指標", list(METRICS), horizontal=True, format_func=METRICS.get, key="sweep_metric")
+
+    # 入力 (設定・軸) が変わったら、計算中の古いスイープは取り消す (終わった結果も、今の入力のものだけを出す)
+    slot = job_slot("sweep_job")
+    job_key = repr((config_hash(config), axes))
+    slot.cancel_stale(job_key)
+    if st.button("▶ スイープを実行", key="sweep_run"):
+        if len({key for key, _ in axes}) < len(axes):
+            st.warning("同じ項目が複数の軸に選ばれています。")
+            return
+        slot.submit(job_key, lambda report: run_sweep(config, axes, on_chunk=lambda partial: report(partial, partial.progress)))
+    if slot.job is None:
+        return
+    if slot.job.key != job_key:
+        st.caption("設定が変わりました。もう一度「スイープを実行」を押してください。")
+        return
+
+    def draw(result, partial):
+        slice_index = 0
+        if len(result.shape) == 3 and not partial:
+            key_z, values_z = result.axes[2]
+            picked = st.select_slider(SWEEP_PARAMS[key_z][0], values_z, key="sweep_slice")
+            slice_index = values_z.index(picked)
+        st.plotly_chart(sweep_heatmap(result, metric, slice_index), use_container_width=True,
+                        key="sweep_partial" if partial else "sweep_chart")
+
+    with perf.phase("render_sweep.simulate"):
+        show_job(slot.job, draw)
+
+SENSITIVITY_TOP = 15
+
+@st.fragment
+@timed_fragment
+def render_sensitivity(config):
+    st.caption("数値の入力を1つずつ少しだけ上下に動かし、結果がどれだけ変わるかを影響の大きい順に並べます。")
+    if not st.toggle("🌪 感度分析を実行する", key="sens_enabled"):
+        return
+    import plotly.graph_objects as go
+    from sensitivity import METRICS, SENSITIVITY_PARAMS, run_sensitivity_cached
+
+    c_pct, c_point, c_years = st.columns(3)
+    pct = c_pct.number_input("金額の動かし幅 (±%)", 1.0, 50.0, 10.0, step=1.0, format="%.0f", key="sens_pct")
+    point = c_point.number_input("利回り・税率の動かし幅 (±%pt)", 0.1, 5.0, 1.0, step=0.1, format="%.1f", key="sens_point")
+    years = c_years.number_input("年齢の動かし幅 (±歳)", 1, 10, 1, key="sens_years")
+    metric = st.radio("表示する指標", list(METRICS), horizontal=True, format_func=METRICS.get, key="sens_metric")
+
+    with perf.phase("render_sensitivity.simulate"):
+        result = run_sensitivity_cached(config, pct, point, years)
+    order = result.ranked(metric, SENSITIVITY_TOP)
+    if not order:
+        st.info("どの入力を動かしても、この指標は変わりませんでした。")
+        return
+
+    deltas = result.deltas(metric)[order]
+    if metric == "final_total":
+        deltas, unit, fmt = deltas / 10000, "万円", ",.0f"
+        base_text = f"{result.base_total/10000:,.0f}万円"
+    else:
+        unit, fmt = "年", "+d"
+        base_text = f"{result.base_depletion}歳" if result.base_depletion >= 0 else "尽きない"
+    labels = [SENSITIVITY_PARAMS[result.keys[i]][0] for i in order]
+    values = [result.values[i] for i in order]
+    traces = [
+        go.Bar(y=labels, x=deltas[:, side], orientation="h", name=name, marker_color=color,
+               customdata=[v[side] for v in values],
+               hovertemplate=f"%{{y}} = %{{customdata}}<br>%{{x:{fmt}}}{unit}<extra>{name}</extra>")
+        for side, name, color in ((0, "下げた場合", "#4fc3f7"), (1, "上げた場合", "#ff7043"))
+    ]
+    st.plotly_chart(go.Figure(data=traces, layout=dict(
+        template=CHART_TEMPLATE, barmode="overlay", plot_bgcolor="white", paper_bgcolor="white",
+        font={"family": "Zen Kaku Gothic New", "color": "#5d5555"}, margin=dict(l=20, r=20, t=40, b=20),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+        height=120 + 28 * len(order),
+        # 影響の大きい項目を上に置く
+        yaxis=dict(autorange="reversed"),
+        xaxis=dict(title_text=f"元の設定との差 ({unit})", zeroline=True, zerolinecolor="#5d5555"),
+    )), use_container_width=True)
+
+    notes = [f"元の設定: {base_text}。"]
+    if metric == "depletion_age":
+        notes.append(f"資金が尽きない場合は「{result.end_age + 1}歳で尽きる」とみなして差を出しています。")
+    notes.append("0 の金額は動かしていません。")
+    st.caption(" ".join(notes))
+
+def apply_settings(settings):
+    # ボタンの on_click から呼ぶ (入力欄を作る前に書き換える)
+    for key, value in settings.items():
+        st.session_state[key] = value
+
+@st.fragment
+@timed_fragment
+def render_optimizer(config):
+    from optimizer import DECISION_LABELS, OBJECTIVES, format_decision, optimize
+    st.caption("取り崩しの優先順位・解禁年齢・取り崩し上限・401k積立終了年齢の組み合わせを探し、"
+               "最低貯蓄 (ダム水位) を割らない範囲で一番よいものを提案します。")
+    objective = st.radio("目的", list(OBJECTIVES), horizontal=True, format_func=OBJECTIVES.get, key="opt_objective")
+
+    # 入力が変わったら、計算中の古い最適化は取り消す (終わった結果も、今の入力のものだけを出す)
+    slot = job_slot("optimize_job")
+    job_key = repr((config_hash(config), objective))
+    slot.cancel_stale(job_key)
+    if st.button("▶ 最適化を実行", key="opt_run"):
+        slot.submit(job_key, lambda report: optimize(config, objective, on_round=report))
+    if slot.job is None or slot.job.key != job_key:
+        return
+
+    def draw(result, partial):
+        start, best = result.start_scores, result.best_scores
+        c_below, c_total, c_tax = st.columns(3)
+        c_below.metric("最低貯蓄を割る年数", f"{best[0]}年", f"{best[0] - start[0]:+d}年", delta_color="inverse")
+        c_total.metric("最終年齢の総資産", f"{best[1]/10000:,.0f}万円", f"{(best[1] - start[1])/10000:+,.0f}万円")
+        c_tax.metric("生涯の税金", f"{best[2]/10000:,.0f}万円", f"{(best[2] - start[2])/10000:+,.0f}万円", delta_color="inverse")
+        changes = result.changes()
+        if not changes:
+            if not partial:
+                st.success("今の設定が一番よい組み合わせでした。")
+        else:
+            st.table([{"項目": DECISION_LABELS[name], "今の設定": format_decision(name, a), "提案": format_decision(name, b)}
+                      for name, a, b in changes])
+        if not result.feasible and not partial:
+            st.warning("どの組み合わせでも、使えるお金 (現金 + 解禁済みの NISA・他運用) が最低貯蓄を割る年があります。"
+                       "割る年数が一番少ないものを出しています。")
+        st.caption(f"計算した組み合わせ: {result.evaluations:,}通り ({result.rounds}回に分けて計算)")
+        if changes and not partial:
+            if st.button("✅ この設定を入力欄に反映", key="opt_apply", on_click=apply_settings, args=(result.settings(),)):
+                st.rerun()
+
+    with perf.phase("render_optimizer.simulate"):
+        show_job(slot.job, draw)
+
+def build_asset_figure(columns, current_mode):
+    # トレースとレイアウトをまとめて渡して1回で作る (作った後の update_* は plotly 側の処理が重い)
+    import numpy as np
+    import plotly.graph_objects as go
+    ages = columns["Age"]
+    stacked = current_mode == GRAPH_MODES[0]
+    webgl = len(ages) * 5 > WEBGL_MIN_POINTS
+    Trace = go.Scattergl if webgl else go.Scatter
+    traces = []
+    base = np.zeros(len(ages), dtype=np.int64)
+    for name in ("Cash", "401k", "NISA", "Other"):
+        values = columns[name]
+        style = dict(name=name, mode="lines", line=dict(color=ASSET_COLORS[name]))
+        if stacked and webgl:
+            # Scattergl は stackgroup を使えないので、積み上げた値を自前で計算して下の線まで塗る
+            base = base + values
+            traces.append(Trace(x=ages, y=base, customdata=values, fill="tonexty" if traces else "tozeroy",
+                                hovertemplate="<b>%{data.name}</b>=%{customdata:,.0f}円<extra></extra>", **style))
+        else:
+            traces.append(Trace(x=ages, y=values, stackgroup="assets" if stacked else None,
+                                hovertemplate="<b>%{data.name}</b>=%{y:,.0f}円<extra></extra>", **style))
+
+    # 透明なTotalラインを追加 (ツールチップに総資産を1回だけ出す)
+    traces.append(Trace(
+        x=ages, y=columns["Total"],
+        mode='lines',
+        name='■ 総資産',
+        line=dict(width=0, color='rgba(0,0,0,0)'),
+        hovertemplate='総資産=%{y:,.0f}円<extra></extra>',
+        showlegend=True
+    ))
+
+    return go.Figure(data=traces, layout=dict(
+        template=CHART_TEMPLATE,
+        hovermode="x unified",
+        plot_bgcolor="white",
+        paper_bgcolor="white",
+        font={"family": "Zen Kaku Gothic New", "color": "#5d5555"},
+        margin=dict(l=20, r=20, t=40, b=20),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1, title_text="Asset"),
+        # ★ ヘッダーに年齢を表示
+        xaxis=dict(title_text="年齢", ticksuffix="歳"),
+        yaxis=dict(title_text="金額 (円)"),
+    ))
+
+@st.fragment
+@timed_fragment
+def render_results(result, result_key, current_age, end_age):
+    # ★ グラフ用の空箱
+    graph_container = st.container()
+
+    # --- 1. スライダー (レイアウト: グラフの下) ---
+    st.markdown("### 📅 年齢別 資産チェック")
+    target_age = st.slider("確認したい年齢を選択してください", current_age, end_age, 65, label_visibility="collapsed")
+    
+    try:
+        row = result.row(target_age)
+        c1, c2, c3, c4, c5 = st.columns(5)
+        c1.metric(f"🎂 {target_age}歳の総資産", f"{row['Total']/10000:,.0f}万円")
+        c2.metric("💴 現金・預金", f"{row['Cash']/10000:,.0f}万円")
+        c3.metric("📈 新NISA", f"{row['NISA']/10000:,.0f}万円", delta=f"元本 {row['NISA元本']/10000:,.0f}万円")
+        c4.metric("🐢 401k/iDeCo", f"{row['401k']/10000:,.0f}万円")
+        c5.metric("✨ その他運用", f"{row['Other']/10000:,.0f}万円")
+    except: st.error("データ取得エラー")
+
+    # --- 2. グラフ (縦線を追加 & ツールチップ修正) ---
+    # ★ グラフを「一番上のコンテナ」に入れる
+    with graph_container:
+        st.markdown("<br>", unsafe_allow_html=True)
+        
+        if "graph_mode" not in st.session_state:
+            st.session_state["graph_mode"] = GRAPH_MODES[0]
+        current_mode = st.session_state["graph_mode"]
+
+        # 縦線以外は計算結果と表示モードだけで決まるので、セッション内で表示モードごとに使い回して縦線だけ差し替える
+        figures = st.session_state.setdefault("asset_figures", {})
+        cached = figures.get(current_mode)
+        with perf.phase("render_results.figure"):
+            if cached is None or cached[0] != result_key:
+                # 起動時に作っておいた既定の設定のグラフがあれば、それを写して使う (縦線を書き換えるので共有はしない)
+                warmed = prewarm().get((result_key, current_mode))
+                if warmed is not None:
+                    import plotly.graph_objects as go
+                    fig = go.Figure(warmed)
+                else:
+                    fig = build_asset_figure(result.views(), current_mode)
+                cached = figures[current_mode] = (result_key, fig)
+            fig = cached[1]
+            fig.layout.shapes = ()
+            fig.add_vline(x=target_age, line_width=2, line_dash="dash", line_color="#831843")
+
+        # 図の JSON への変換はここで行われる
+        with perf.phase("render_results.chart"):
+            st.plotly_chart(fig, use_container_width=True)
+
+    # --- 3. その他表示 ---
+    st.markdown("<br>", unsafe_allow_html=True)
+    st.radio("グラフ表示モード", GRAPH_MODES, 
+             key="graph_mode", horizontal=True)
+
+# --- 起動直後の準備 ---
+
+@st.cache_resource
+def prewarm():
+    # プロセスごとに1回: 既定の設定の計算結果とグラフを、最初の訪問者の入力欄の表示と並行して作っておく
+    # 戻り値: {(結果のハッシュ, 表示モード): Figure}。出来上がったものから入る
+    figures = {}
+
+    def work():
+        result = simulate_cached(DEFAULT_CONFIG)
+        key = config_hash(DEFAULT_CONFIG)
+        for mode in GRAPH_MODES:
+            figures[(key, mode)] = build_asset_figure(result.views(), mode)
+
+    threading.Thread(target=work, name="prewarm", daemon=True).start()
+    return figures
+
+FONT_CSS = """
+    <style>
+    @import url('https://fonts.googleapis.com/css2?family=Shippori+Mincho:wght@400;500;700&family=Zen+Kaku+Gothic+New:wght@300;400;500&display=swap');
+    </style>
+"""
+
 # --- メインアプリ ---
 st.set_page_config(page_title="簡易資産シミュレータ v7.0", page_icon="💎", layout="wide")
 
 def main():
+    prewarm()
     if "first_load_done" not in st.session_state:
         for key, value in DEFAULT_CONFIG.items():
             if key not in st.session_state:
                 st.session_state[key] = value
         st.session_state["first_load_done"] = True
+    restore_shared_scenario()
     
     # ★デザインカスタマイズ
     st.markdown("""
         <style>
-        @import url('https://fonts.googleapis.com/css2?family=Shippori+Mincho:wght@400;500;700&family=Zen+Kaku+Gothic+New:wght@300;400;500&display=swap');
-        
         html, body, [class*="css"] {
             font-family: 'Zen Kaku Gothic New', sans-serif;
             color: #4a4a4a;
@@ -228,8 +740,13 @@ def main():
         st.header("⚙️ 設定")
     with c_share:
         if st.button("🔗 共有"):
+            # 今の設定と計算結果を保存し、その ID を URL に載せる
+            shared = {key: st.session_state[key] for key in DEFAULT_CONFIG}
+            sid = get_store().save(shared, simulate_cached(shared))
+            st.session_state["restored_scenario"] = sid
+            st.query_params["s"] = sid
             st.sidebar.info("👇 URLをコピー")
-            st.sidebar.code(SHARE_URL, language=None)
+            st.sidebar.code(share_url(sid), language=None)
             
     st.sidebar.subheader("📁 設定ファイル")
     col_dl, col_ul = st.sidebar.columns(2)
@@ -266,60 +783,62 @@ def main():
         end_age = st.number_input("終了年齢", 80, 120, key="end_age")
         st.markdown("---")
         st.subheader("💰 現在の資産 (万円)")
-        ini_cash = st.number_input("貯蓄 (現金)", 0, 10000, step=10, key="ini_cash") * 10000
-        ini_401k = st.number_input("401k (確定拠出)", 0, 10000, step=10, key="ini_401k") * 10000
-        ini_nisa = st.number_input("新NISA", 0, 10000, step=10, key="ini_nisa") * 10000
-        ini_paypay = st.number_input("他運用 (ポイント運用など)", 0, 10000, step=10, key="ini_paypay") * 10000
+        st.number_input("貯蓄 (現金)", 0, 10000, step=10, key="ini_cash")
+        st.number_input("401k (確定拠出)", 0, 10000, step=10, key="ini_401k")
+        st.number_input("新NISA", 0, 10000, step=10, key="ini_nisa")
+        st.number_input("他運用 (ポイント運用など)", 0, 10000, step=10, key="ini_paypay")
         st.markdown("---")
         st.subheader("📈 運用利回り (%)")
-        r_cash = st.number_input("貯蓄金利", 0.0, 10.0, step=0.01, format="%.2f", key="r_cash") / 100
-        r_401k = st.number_input("401k年利", 0.0, 30.0, step=0.1, format="%.2f", key="r_401k") / 100
-        r_nisa = st.number_input("新NISA年利", 0.0, 30.0, step=0.1, format="%.2f", key="r_nisa") / 100
-        r_paypay = st.number_input("他運用年利", 0.0, 50.0, step=0.1, format="%.2f", key="r_paypay") / 100
-        inflation = st.number_input("インフレ率", -5.0, 20.0, step=0.1, format="%.2f", key="inflation") / 100
+        st.number_input("貯蓄金利", 0.0, 10.0, step=0.01, format="%.2f", key="r_cash")
+        st.number_input("401k年利", 0.0, 30.0, step=0.1, format="%.2f", key="r_401k")
+        st.number_input("新NISA年利", 0.0, 30.0, step=0.1, format="%.2f", key="r_nisa")
+        st.number_input("他運用年利", 0.0, 50.0, step=0.1, format="%.2f", key="r_paypay")
+        st.number_input("インフレ率", -5.0, 20.0, step=0.1, format="%.2f", key="inflation")
+        st.radio("計算の細かさ", STEP_MODES, key="step_mode", horizontal=True,
+                 help="月次: 収支・積立・利回りを毎月計上し、現金が足りなくなった月にその都度取り崩します")
         next_step_guide("STEP 2: 収支")
 
     with tab2:
         st.subheader("🏢 働き方と収入の入力")
-        age_work_last = st.number_input("何歳まで働く？", 50, 90, key="age_work_last")
+        st.number_input("何歳まで働く？", 50, 90, key="age_work_last")
         st.markdown("##### 手取り年収 (万円)")
         inc_help = "ボーナスを含めた、年間の手取り収入の合計を入力してください。"
-        inc_20s = st.number_input("〜29歳", 0, 5000, step=10, key="inc_20s", help=inc_help) * 10000
-        inc_30s = st.number_input("30〜39歳", 0, 5000, step=10, key="inc_30s", help=inc_help) * 10000
-        inc_40s = st.number_input("40〜49歳", 0, 5000, step=10, key="inc_40s", help=inc_help) * 10000
-        inc_50s = st.number_input("50〜59歳", 0, 5000, step=10, key="inc_50s", help=inc_help) * 10000
-        inc_60s = st.number_input("60歳〜", 0, 5000, step=10, key="inc_60s", help=inc_help) * 10000
+        st.number_input("〜29歳", 0, 5000, step=10, key="inc_20s", help=inc_help)
+        st.number_input("30〜39歳", 0, 5000, step=10, key="inc_30s", help=inc_help)
+        st.number_input("40〜49歳", 0, 5000, step=10, key="inc_40s", help=inc_help)
+        st.number_input("50〜59歳", 0, 5000, step=10, key="inc_50s", help=inc_help)
+        st.number_input("60歳〜", 0, 5000, step=10, key="inc_60s", help=inc_help)
         st.markdown("---")
         st.subheader("🐢 年金・退職金")
-        age_401k_get = st.number_input("401k受取年齢", 50, 80, key="age_401k_get")
-        tax_401k = st.number_input("401k受取税率(%)", 0.0, 50.0, step=0.1, format="%.1f", key="tax_401k") / 100
-        age_pension = st.number_input("年金開始年齢", 60, 75, key="age_pension")
-        pension_monthly = st.number_input("年金月額(額面・円)", 0, 500000, step=10000, key="pension_monthly")
-        tax_pension = st.number_input("年金税・社会保険料率(%)", 0.0, 50.0, step=0.1, format="%.1f", key="tax_pension") / 100
+        st.number_input("401k受取年齢", 50, 80, key="age_401k_get")
+        st.number_input("401k受取税率(%)", 0.0, 50.0, step=0.1, format="%.1f", key="tax_401k")
+        st.number_input("年金開始年齢", 60, 75, key="age_pension")
+        st.number_input("年金月額(額面・円)", 0, 500000, step=10000, key="pension_monthly")
+        st.number_input("年金税・社会保険料率(%)", 0.0, 50.0, step=0.1, format="%.1f", key="tax_pension")
         st.markdown("---")
         st.subheader("🛒 支出設定")
         st.markdown("##### 基本生活費 (月/万円)")
         cost_help = "家賃、食費、光熱費など、毎月必ず出ていくお金です。"
-        cost_20s = st.number_input("〜29歳 生活費", 0, 500, step=1, key="cost_20s", help=cost_help) * 10000
-        cost_30s = st.number_input("30代 生活費", 0, 500, step=1, key="cost_30s", help=cost_help) * 10000
-        cost_40s = st.number_input("40代 生活費", 0, 500, step=1, key="cost_40s", help=cost_help) * 10000
-        cost_50s = st.number_input("50代 生活費", 0, 500, step=1, key="cost_50s", help=cost_help) * 10000
+        st.number_input("〜29歳 生活費", 0, 500, step=1, key="cost_20s", help=cost_help)
+        st.number_input("30代 生活費", 0, 500, step=1, key="cost_30s", help=cost_help)
+        st.number_input("40代 生活費", 0, 500, step=1, key="cost_40s", help=cost_help)
+        st.number_input("50代 生活費", 0, 500, step=1, key="cost_50s", help=cost_help)
         c_60, c_65 = st.columns(2)
         with c_60:
-            cost_6064 = st.number_input("60〜64歳 生活費", 0, 500, step=1, key="cost_6064") * 10000
+            st.number_input("60〜64歳 生活費", 0, 500, step=1, key="cost_6064")
         with c_65:
-            cost_65 = st.number_input("65歳〜 生活費", 0, 500, step=1, key="cost_65") * 10000
+            st.number_input("65歳〜 生活費", 0, 500, step=1, key="cost_65")
         st.markdown("##### 年間特別支出 (万円/年)")
         exp_help = "旅行、帰省、家電買替、車検など、年単位で発生する特別なお金です。"
-        exp_20s = st.number_input("〜29歳 特別出費", 0, 5000, step=10, key="exp_20s", help=exp_help) * 10000
-        exp_30s = st.number_input("30代 特別出費", 0, 5000, step=10, key="exp_30s", help=exp_help) * 10000
-        exp_40s = st.number_input("40代 特別出費", 0, 5000, step=10, key="exp_40s", help=exp_help) * 10000
-        exp_50s = st.number_input("50代 特別出費", 0, 5000, step=10, key="exp_50s", help=exp_help) * 10000
+        st.number_input("〜29歳 特別出費", 0, 5000, step=10, key="exp_20s", help=exp_help)
+        st.number_input("30代 特別出費", 0, 5000, step=10, key="exp_30s", help=exp_help)
+        st.number_input("40代 特別出費", 0, 5000, step=10, key="exp_40s", help=exp_help)
+        st.number_input("50代 特別出費", 0, 5000, step=10, key="exp_50s", help=exp_help)
         c_e60, c_e65 = st.columns(2)
         with c_e60:
-            exp_6064 = st.number_input("60〜64歳 特別出費", 0, 5000, step=10, key="exp_6064") * 10000
+            st.number_input("60〜64歳 特別出費", 0, 5000, step=10, key="exp_6064")
         with c_e65:
-            exp_65 = st.number_input("65歳〜 特別出費", 0, 5000, step=10, key="exp_65") * 10000
+            st.number_input("65歳〜 特別出費", 0, 5000, step=10, key="exp_65")
         next_step_guide("STEP 3: 積立")
 
     with tab3:
@@ -333,86 +852,91 @@ def main():
                 st.info(f"✅ 年間 {nisa_year_val/10000:.0f}万 / 120万")
             else:
                 st.warning(f"⚠️ 年間120万を超えています。")
-            nisa_stop_age = st.number_input("NISA積立終了年齢", 20, 100, key="nisa_stop_age")
+            st.number_input("NISA積立終了年齢", 20, 100, key="nisa_stop_age")
         with col_t2:
             st.markdown("**2. 他運用 (特定口座など)**")
             paypay_monthly = st.number_input("他運用積立(月/円)", 0, 1000000, step=1000, key="paypay_monthly")
             st.write(f"(年間 {paypay_monthly*12/10000:.0f}万円)")
-            paypay_stop_age = st.number_input("他運用積立終了年齢", 20, 100, key="paypay_stop_age")
+            st.number_input("他運用積立終了年齢", 20, 100, key="paypay_stop_age")
         st.markdown("---")
         st.markdown("**3. 401k/iDeCo (確定拠出年金)**")
         c_k1, c_k2 = st.columns(2)
         with c_k1:
-            k401_monthly = st.number_input("401k積立(月/円)", 0, 500000, step=1000, key="k401_monthly")
+            st.number_input("401k積立(月/円)", 0, 500000, step=1000, key="k401_monthly")
         with c_k2:
-            k401_stop_age = st.number_input("401k積立終了年齢", 20, 70, key="k401_stop_age")
+            st.number_input("401k積立終了年齢", 20, 70, key="k401_stop_age")
         st.markdown("---")
         st.subheader("💧 最低貯蓄額 (ダム水位)")
-        dam_1 = st.number_input("〜49歳 最低貯蓄(万)", 0, 10000, step=50, key="dam_1") * 10000
-        dam_2 = st.number_input("50代 最低貯蓄(万)", 0, 10000, step=50, key="dam_2") * 10000
-        dam_3 = st.number_input("60歳〜 最低貯蓄(万)", 0, 10000, step=50, key="dam_3") * 10000
+        st.number_input("〜49歳 最低貯蓄(万)", 0, 10000, step=50, key="dam_1")
+        st.number_input("50代 最低貯蓄(万)", 0, 10000, step=50, key="dam_2")
+        st.number_input("60歳〜 最低貯蓄(万)", 0, 10000, step=50, key="dam_3")
         next_step_guide("STEP 4: 取崩")
 
     with tab4:
         st.subheader("🍂 取崩し・補填ルール")
-        priority = st.radio("取り崩し優先順位 (不足時)", ["新NISAから先に使う", "他運用から先に使う"], horizontal=True, key="priority")
+        st.radio("取り崩し優先順位 (不足時)", PRIORITIES, horizontal=True, key="priority")
         col_out1, col_out2 = st.columns(2)
         with col_out1:
-            nisa_start_age = st.number_input("新NISA 解禁年齢", 50, 100, key="nisa_start_age")
+            st.number_input("新NISA 解禁年齢", 50, 100, key="nisa_start_age")
         with col_out2:
-            paypay_start_age = st.number_input("他運用 解禁年齢", 50, 100, key="paypay_start_age")
+            st.number_input("他運用 解禁年齢", 50, 100, key="paypay_start_age")
         st.markdown("---")
         st.write("▼ 取り崩し上限設定")
         c_n_mode, c_n_val = st.columns([3, 2])
-        limit_mode_options = ["年額定額 (万円)", "総資産比率 (%)", "残高比率 (%)"]
+        limit_mode_options = LIMIT_MODE_OPTIONS
         limit_mode_nisa = c_n_mode.selectbox("NISA上限方式", limit_mode_options, key="limit_mode_nisa", label_visibility="collapsed")
         if limit_mode_nisa == "年額定額 (万円)":
             limit_val_nisa = c_n_val.number_input("NISA金額", 0, 10000, step=10, key="limit_val_nisa_yen", label_visibility="collapsed", format="%d")
             st.caption(f"年間 **{limit_val_nisa}万円** まで")
-            nisa_limit_yen_calc = limit_val_nisa * 10000
         else:
             limit_val_nisa = c_n_val.number_input("NISA割合", 0.0, 100.0, step=0.1, key="limit_val_nisa_pct", label_visibility="collapsed", format="%.1f")
             if limit_mode_nisa == "総資産比率 (%)": st.caption(f"その年の **総資産の {limit_val_nisa:.1f}%** まで")
             else: st.caption(f"その年の **NISA残高の {limit_val_nisa:.1f}%** まで")
-            nisa_limit_yen_calc = limit_val_nisa
         c_o_mode, c_o_val = st.columns([3, 2])
         limit_mode_other = c_o_mode.selectbox("他運用上限方式", limit_mode_options, key="limit_mode_other", label_visibility="collapsed")
         if limit_mode_other == "年額定額 (万円)":
             limit_val_other = c_o_val.number_input("他運用金額", 0, 10000, step=10, key="limit_val_other_yen", label_visibility="collapsed", format="%d")
             st.caption(f"年間 **{limit_val_other}万円** まで")
-            other_limit_yen_calc = limit_val_other * 10000
         else:
             limit_val_other = c_o_val.number_input("他運用割合", 0.0, 100.0, step=0.1, key="limit_val_other_pct", label_visibility="collapsed", format="%.1f")
             if limit_mode_other == "総資産比率 (%)": st.caption(f"その年の **総資産の {limit_val_other:.1f}%** まで")
             else: st.caption(f"その年の **他運用残高の {limit_val_other:.1f}%** まで")
-            other_limit_yen_calc = limit_val_other
         st.markdown("**他運用 取崩し税率 (%)**")
-        tax_rate_other = st.number_input("他運用 取崩し税率", 0.0, 50.0, step=0.1, format="%.1f", key="tax_rate_other") / 100
+        st.number_input("他運用 取崩し税率", 0.0, 50.0, step=0.1, format="%.1f", key="tax_rate_other")
+        st.selectbox("取得価額の管理", COST_BASIS_METHODS, key="cost_basis",
+                     help="総平均法・先入先出法: 買付を年ごとに記録し、他運用は売却益にだけ課税します。"
+                          "NISA を売って空いた生涯投資枠は翌年に戻ります。")
         next_step_guide("STEP 5: 臨時")
 
     with tab5:
         st.subheader("🎀 臨時収入・支出")
         c_i1_a, c_i1_v = st.columns([1, 2])
-        inc1_age = c_i1_a.number_input("収入① 年齢", 0, 100, key="inc1_a")
-        inc1_val = c_i1_v.number_input("収入① 金額(万)", 0, 10000, step=100, key="inc1_v") * 10000
+        c_i1_a.number_input("収入① 年齢", 0, 100, key="inc1_a")
+        c_i1_v.number_input("収入① 金額(万)", 0, 10000, step=100, key="inc1_v")
         c_i2_a, c_i2_v = st.columns([1, 2])
-        inc2_age = c_i2_a.number_input("収入② 年齢", 0, 100, key="inc2_a")
-        inc2_val = c_i2_v.number_input("収入② 金額(万)", 0, 10000, step=100, key="inc2_v") * 10000
+        c_i2_a.number_input("収入② 年齢", 0, 100, key="inc2_a")
+        c_i2_v.number_input("収入② 金額(万)", 0, 10000, step=100, key="inc2_v")
         c_i3_a, c_i3_v = st.columns([1, 2])
-        inc3_age = c_i3_a.number_input("収入③ 年齢", 0, 100, key="inc3_a")
-        inc3_val = c_i3_v.number_input("収入③ 金額(万)", 0, 10000, step=100, key="inc3_v") * 10000
+        c_i3_a.number_input("収入③ 年齢", 0, 100, key="inc3_a")
+        c_i3_v.number_input("収入③ 金額(万)", 0, 10000, step=100, key="inc3_v")
         st.markdown("---")
         c_d1_a, c_d1_v = st.columns([1, 2])
-        dec1_age = c_d1_a.number_input("支出① 年齢", 0, 100, key="dec1_a")
-        dec1_val = c_d1_v.number_input("支出① 金額(万)", 0, 10000, step=100, key="dec1_v") * 10000
+        c_d1_a.number_input("支出① 年齢", 0, 100, key="dec1_a")
+        c_d1_v.number_input("支出① 金額(万)", 0, 10000, step=100, key="dec1_v")
         c_d2_a, c_d2_v = st.columns([1, 2])
-        dec2_age = c_d2_a.number_input("支出② 年齢", 0, 100, key="dec2_a")
-        dec2_val = c_d2_v.number_input("支出② 金額(万)", 0, 10000, step=100, key="dec2_v") * 10000
+        c_d2_a.number_input("支出② 年齢", 0, 100, key="dec2_a")
+        c_d2_v.number_input("支出② 金額(万)", 0, 10000, step=100, key="dec2_v")
         c_d3_a, c_d3_v = st.columns([1, 2])
-        dec3_age = c_d3_a.number_input("支出③ 年齢", 0, 100, key="dec3_a")
-        dec3_val = c_d3_v.number_input("支出③ 金額(万)", 0, 10000, step=100, key="dec3_v") * 10000
+        c_d3_a.number_input("支出③ 年齢", 0, 100, key="dec3_a")
+        c_d3_v.number_input("支出③ 金額(万)", 0, 10000, step=100, key="dec3_v")
         next_step_guide("STEP 6: 完了・オマケ")
 
+    # ここまでの入力で計算用の設定がそろう
+    config = {key: st.session_state[key] for key in DEFAULT_CONFIG}
+    if "s" in st.query_params and scenario_id(config) != st.query_params["s"]:
+        # 共有リンクから入力を変えたら、URL が古い設定を指したままにならないよう外す
+        del st.query_params["s"]
+
     with tab6:
         st.subheader("✨ 必要資産額シミュレータ")
         st.markdown("#### ステップ1: 目標の設定")
@@ -440,272 +964,72 @@ def main():
         else:
             st.warning("利回りを0より大きく設定してください。")
 
+        st.markdown("---")
+        st.markdown("#### ステップ3: 実際の推移から逆算")
+        st.caption("入力済みの設定で推移を繰り返し計算し、条件を満たす境目を探します。")
+        evaluator = Evaluator(config)
+        with perf.phase("solver"):
+            cost_result = max_sustainable_cost(config, evaluator=evaluator)
+        if cost_result.feasible:
+            st.success(f"💡 {end_age}歳まで資金が尽きない 65歳〜の生活費は **月{cost_result.value}万円** まで")
+        else:
+            st.warning("65歳〜の生活費を0にしても資金が尽きます。")
+        goal_c1, goal_c2 = st.columns(2)
+        goal_total = goal_c1.number_input("目標の総資産 (万円)", 0, 100000, 5000, step=500, key="goal_total")
+        goal_age = goal_c2.number_input("何歳の時点で", current_age, end_age, min(max(65, current_age), end_age), key="goal_age")
+        with perf.phase("solver"):
+            age_result = earliest_retirement_age(config, goal_total * 10000, goal_age)
+            nisa_result = min_nisa_monthly(config, goal_total * 10000, goal_age)
+        if age_result.feasible:
+            st.info(f"🏢 **{age_result.value}歳** まで働けば達成できます")
+        else:
+            st.warning(f"{age_result.upper}歳まで働いても届きません。")
+        if nisa_result.feasible:
+            st.info(f"🌱 NISA積立を **月{nisa_result.value:,}円** にすれば達成できます")
+        else:
+            st.warning("NISA積立を上限にしても届きません。")
+        st.caption(f"計算回数: {evaluator.calls + age_result.evaluations + nisa_result.evaluations}回")
+
     st.sidebar.markdown("---")
     st.sidebar.caption("👀 訪問者数")
     st.sidebar.markdown(f"![Visitor Count](https://visitor-badge.laobi.icu/badge?page_id=touched2222_asset_simulator_v6)")
 
-    # --- 計算ロジック ---
-    records = []
-    cash = ini_cash
-    k401 = ini_401k
-    nisa = ini_nisa
-    paypay = ini_paypay
-    nisa_principal = ini_nisa 
-    NISA_TSUMITATE_LIMIT = 1200000 
-    NISA_GROWTH_LIMIT = 2400000
-    NISA_LIFETIME_LIMIT = 18000000 
-
-    records.append({
-        "Age": current_age,
-        "Total": int(cash + k401 + nisa + paypay),
-        "Cash": int(cash),
-        "401k": int(k401),
-        "NISA": int(nisa),
-        "Other": int(paypay),
-        "NISA積立枠": 0,
-        "NISA成長枠": 0,
-        "NISA元本": int(nisa_principal) 
-    })
-    
-    # ★ グラフ用の空箱
-    graph_container = st.container()
+    perf.lap("widgets")
 
-    for age in range(current_age + 1, end_age + 1):
-        cash *= (1 + r_cash)
-        nisa *= (1 + r_nisa)
-        paypay *= (1 + r_paypay)
-        if age < age_401k_get: k401 *= (1 + r_401k)
-
-        is_working = (age <= age_work_last)
-        salary = 0
-        if is_working:
-            if age < 30: salary = inc_20s
-            elif age < 40: salary = inc_30s
-            elif age < 50: salary = inc_40s
-            elif age < 60: salary = inc_50s
-            else: salary = inc_60s
-
-        annual_extra_exp = 0
-        if age < 30: annual_extra_exp = exp_20s
-        elif age < 40: annual_extra_exp = exp_30s
-        elif age < 50: annual_extra_exp = exp_40s
-        elif age < 60: annual_extra_exp = exp_50s
-        elif age < 65: annual_extra_exp = exp_6064
-        else: annual_extra_exp = exp_65
-        
-        pension = 0
-        if age >= age_pension:
-            pension = pension_monthly * 12 * (1 - tax_pension)
-
-        base_monthly_cost = 0
-        if age < 30: base_monthly_cost = cost_20s
-        elif age < 40: base_monthly_cost = cost_30s
-        elif age < 50: base_monthly_cost = cost_40s
-        elif age < 60: base_monthly_cost = cost_50s
-        elif age < 65: base_monthly_cost = cost_6064
-        else: base_monthly_cost = cost_65
-
-        if age > age_work_last:
-            current_cost = base_monthly_cost * 12 * ((1 + inflation) ** (age - age_work_last))
-        else:
-            current_cost = base_monthly_cost * 12
-
-        val_k401_add = k401_monthly * 12 if (is_working and age < age_401k_get and age <= k401_stop_age) else 0 
-        
-        nisa_tsumitate_year = 0
-        nisa_growth_year = 0
-        can_invest = (cash > 0 or is_working)
-
-        val_nisa_add = 0
-        if can_invest and age <= nisa_stop_age:
-            raw_nisa_add = nisa_monthly * 12
-            lifetime_room = max(0, NISA_LIFETIME_LIMIT - nisa_principal)
-            val_nisa_add = min(raw_nisa_add, NISA_TSUMITATE_LIMIT, lifetime_room)
-            nisa_tsumitate_year = val_nisa_add
-            
-        val_paypay_add = paypay_monthly * 12 if (can_invest and age <= paypay_stop_age) else 0
-
-        k401 += val_k401_add
-        nisa += val_nisa_add
-        nisa_principal += val_nisa_add
-        paypay += val_paypay_add
-
-        if age == age_401k_get:
-            income_401k = k401 * (1 - tax_401k)
-            cash += income_401k
-            k401 = 0
-
-        event_inc = 0
-        if age == inc1_age: event_inc += inc1_val
-        if age == inc2_age: event_inc += inc2_val
-        if age == inc3_age: event_inc += inc3_val
-        
-        event_dec = 0
-        if age == dec1_age: event_dec += dec1_val
-        if age == dec2_age: event_dec += dec2_val
-        if age == dec3_age: event_dec += dec3_val
-
-        cash_flow = (salary + pension + event_inc) - (current_cost + annual_extra_exp + event_dec + val_k401_add + val_nisa_add + val_paypay_add)
-        cash += cash_flow
-
-        if cash < 0:
-            shortage = abs(cash)
-            current_total_investments = nisa + paypay + k401
-
-            def calc_actual_limit(mode, val, current_asset, total_assets):
-                if mode == "年額定額 (万円)":
-                    if val == 0: return float('inf') 
-                    return val 
-                elif mode == "総資産比率 (%)":
-                    return total_assets * (val / 100)
-                elif mode == "残高比率 (%)":
-                    return current_asset * (val / 100)
-                return float('inf')
-
-            limit_nisa_yen = calc_actual_limit(limit_mode_nisa, nisa_limit_yen_calc, nisa, current_total_investments)
-            limit_other_yen = calc_actual_limit(limit_mode_other, other_limit_yen_calc, paypay, current_total_investments)
-
-            def withdraw_asset_logic(needed, current_val, principal_val, is_nisa, limit_yen, tax_rate=0.0):
-                gross_needed = needed / (1 - tax_rate) if (1 - tax_rate) > 0 else needed
-                can_withdraw_gross = min(gross_needed, current_val, limit_yen)
-                net_cash_obtained = can_withdraw_gross * (1 - tax_rate)
-                new_val = current_val - can_withdraw_gross
-                new_principal = principal_val
-                if is_nisa and current_val > 0 and can_withdraw_gross > 0:
-                    ratio = can_withdraw_gross / current_val
-                    new_principal = principal_val * (1 - ratio)
-                return net_cash_obtained, new_val, new_principal
-
-            if priority == "新NISAから先に使う":
-                if age >= nisa_start_age:
-                    pay_nisa, nisa, nisa_principal = withdraw_asset_logic(shortage, nisa, nisa_principal, True, limit_nisa_yen, 0.0)
-                    shortage -= pay_nisa
-                if age >= paypay_start_age:
-                    pay_other, paypay, _ = withdraw_asset_logic(shortage, paypay, 0, False, limit_other_yen, tax_rate_other)
-                    shortage -= pay_other
-            else:
-                if age >= paypay_start_age:
-                    pay_other, paypay, _ = withdraw_asset_logic(shortage, paypay, 0, False, limit_other_yen, tax_rate_other)
-                    shortage -= pay_other
-                if age >= nisa_start_age:
-                    pay_nisa, nisa, nisa_principal = withdraw_asset_logic(shortage, nisa, nisa_principal, True, limit_nisa_yen, 0.0)
-                    shortage -= pay_nisa
-            
-            cash = -shortage
-
-        if age < 50: target = dam_1
-        elif age < 60: target = dam_2
-        else: target = dam_3
-
-        if cash > target and age <= nisa_stop_age:
-            surplus = cash - target
-            nisa_remaining_space = NISA_GROWTH_LIMIT 
-            lifetime_room = max(0, NISA_LIFETIME_LIMIT - nisa_principal)
-            move = min(surplus, nisa_remaining_space, lifetime_room)
-            cash -= move
-            nisa += move
-            nisa_principal += move
-            nisa_growth_year = move
-
-        records.append({
-            "Age": age,
-            "Total": int(cash + k401 + nisa + paypay),
-            "Cash": int(cash),
-            "401k": int(k401),
-            "NISA": int(nisa),
-            "Other": int(paypay),
-            "NISA積立枠": int(nisa_tsumitate_year),
-            "NISA成長枠": int(nisa_growth_year),
-            "NISA元本": int(nisa_principal) 
-        })
+    # --- 計算ロジック ---
+    # 計算は engine 側で行い、同じ設定の結果は全セッションで共有キャッシュから返す
+    with perf.phase("simulate"):
+        result = simulate_cached(config, checkpoint=st.session_state.setdefault("sim_checkpoint", Checkpoint()))
 
-    # --- 1. スライダー (レイアウト: グラフの下) ---
-    st.markdown("### 📅 年齢別 資産チェック")
-    target_age = st.slider("確認したい年齢を選択してください", current_age, end_age, 65, label_visibility="collapsed")
-    
-    df = pd.DataFrame(records)
-    
-    try:
-        row = df[df["Age"] == target_age].iloc[0]
-        c1, c2, c3, c4, c5 = st.columns(5)
-        c1.metric(f"🎂 {target_age}歳の総資産", f"{row['Total']/10000:,.0f}万円")
-        c2.metric("💴 現金・預金", f"{row['Cash']/10000:,.0f}万円")
-        c3.metric("📈 新NISA", f"{row['NISA']/10000:,.0f}万円", delta=f"元本 {row['NISA元本']/10000:,.0f}万円")
-        c4.metric("🐢 401k/iDeCo", f"{row['401k']/10000:,.0f}万円")
-        c5.metric("✨ その他運用", f"{row['Other']/10000:,.0f}万円")
-    except: st.error("データ取得エラー")
+    # グラフ・スライダー・メトリクスはフラグメントにまとめ、年齢や表示モードの変更ではそこだけ再実行する
+    render_results(result, config_hash(config), current_age, end_age)
 
-    # --- 2. グラフ (縦線を追加 & ツールチップ修正) ---
-    # ★ グラフを「一番上のコンテナ」に入れる
-    with graph_container:
-        st.markdown("<br>", unsafe_allow_html=True)
-        
-        if "graph_mode" not in st.session_state:
-            st.session_state["graph_mode"] = "積み上げ (総資産)"
-        current_mode = st.session_state["graph_mode"]
+    st.markdown("<br>", unsafe_allow_html=True)
+    # 表の DataFrame は開いているときだけ作る
+    with st.expander("📝 年単位の資産明細を表示", key="detail_table", on_change="rerun") as detail:
+        if detail.open:
+            with perf.phase("table"):
+                st.dataframe(result.to_frame(), use_container_width=True, height=300)
 
-        df_melt = df.melt(id_vars=["Age"], value_vars=["Cash", "401k", "NISA", "Other"], var_name="Asset", value_name="Amount")
-        df_melt = pd.merge(df_melt, df[["Age", "Total"]], on="Age", how="left")
+    st.markdown("<br>", unsafe_allow_html=True)
+    with st.expander("🎲 確率シミュレーション (モンテカルロ)"):
+        render_montecarlo(config)
 
-        colors = {"Cash": "#90a4ae", "NISA": "#e57373", "401k": "#81c784", "Other": "#ba68c8"}
-        
-        if current_mode == "積み上げ (総資産)":
-            fig = px.area(df_melt, x="Age", y="Amount", color="Asset", 
-                          labels={"Amount": "金額 (円)", "Age": "年齢"}, 
-                          color_discrete_map=colors,
-                          custom_data=["Total"])
-        else:
-            fig = px.line(df_melt, x="Age", y="Amount", color="Asset", 
-                          labels={"Amount": "金額 (円)", "Age": "年齢"}, 
-                          color_discrete_map=colors,
-                          custom_data=["Total"])
-
-        # 透明なTotalラインを追加
-        fig.add_trace(go.Scatter(
-            x=df['Age'], y=df['Total'],
-            mode='lines',
-            name='■ 総資産',
-            line=dict(width=0, color='rgba(0,0,0,0)'),
-            # ★ ツールチップから年齢を削除
-            hovertemplate='総資産=%{y:,.0f}円<extra></extra>',
-            showlegend=True
-        ))
-
-        # ★ ツールチップから年齢を削除
-        fig.update_traces(
-            selector=dict(type='area'),
-            hovertemplate="<b>%{data.name}</b>=%{y:,.0f}円<br><b>総資産</b>=%{customdata[0]:,.0f}円<extra></extra>"
-        )
-        if current_mode == "折れ線 (個別推移)":
-            fig.update_traces(
-                selector=dict(type='scatter', mode='lines'),
-                hovertemplate="<b>%{data.name}</b>=%{y:,.0f}円<br><b>総資産</b>=%{customdata[0]:,.0f}円<extra></extra>"
-            )
-
-        fig.update_layout(
-            hovermode="x unified",
-            plot_bgcolor="white",
-            paper_bgcolor="white",
-            font={"family": "Zen Kaku Gothic New", "color": "#5d5555"},
-            margin=dict(l=20, r=20, t=40, b=20),
-            legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1)
-        )
-        
-        # ★ ヘッダーに年齢を表示（これだけでOK）
-        fig.update_xaxes(ticksuffix="歳") 
-        
-        fig.add_vline(x=target_age, line_width=2, line_dash="dash", line_color="#831843")
+    st.markdown("<br>", unsafe_allow_html=True)
+    with st.expander("📜 過去データでの検証 (バックテスト)"):
+        render_backtest(config)
 
-        st.plotly_chart(fig, use_container_width=True)
+    st.markdown("<br>", unsafe_allow_html=True)
+    with st.expander("🔥 パラメータスイープ (ヒートマップ)"):
+        render_sweep(config)
 
-    # --- 3. その他表示 ---
     st.markdown("<br>", unsafe_allow_html=True)
-    st.radio("グラフ表示モード", ["積み上げ (総資産)", "折れ線 (個別推移)"], 
-             key="graph_mode", horizontal=True)
+    with st.expander("🌪 感度分析 (トルネード図)"):
+        render_sensitivity(config)
 
     st.markdown("<br>", unsafe_allow_html=True)
-    with st.expander("📝 年単位の資産明細を表示"):
-        st.dataframe(df, use_container_width=True, height=300)
+    with st.expander("🧭 取り崩しルールの最適化"):
+        render_optimizer(config)
 
     st.markdown("<br>", unsafe_allow_html=True)
     with st.expander("ℹ️ このシミュレータのルール（クリックで開く）"):
@@ -718,7 +1042,16 @@ def main():
         6.  **取り崩し上限**：年額固定、総資産比率、残高比率の3パターンから選択できます。
         7.  **他運用の税金**：設定された税率分を差し引いて、手取り額で現金の不足を埋めます。
         8.  **積立停止**：現金がマイナス（借金）の年は、新規の積立投資を行いません。
+        9.  **月次モード**：年額の収支・積立を12等分して毎月計上し、利回りも月ごとに複利で付きます。臨時収支と401kの受取は年初の月、成長枠への投資は年末に行います。取り崩し上限は年額で、その年に最初に現金が不足した月の残高で決まります。
         """)
 
+    # Web フォントは最後に読み込む (CSS の先頭で @import すると、読み込み終わるまで他の CSS の適用が遅れる)
+    st.markdown(FONT_CSS, unsafe_allow_html=True)
+
+    perf.lap("other")
+    if perf_enabled():
+        render_perf_panel()
+
 if __name__ == '__main__':
-    main()
+    with perf.run("main", on_finish=record_perf, enabled=perf_enabled()):
+        main()
@@ -0,0 +1,97 @@
+import csv
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from batch_engine import prepare_batch, repeat_params, run_vectorized
+from engine import SimulationCache, config_hash, normalize_config
+
+# ==========================================
+# 過去データでの検証 (バックテスト)
+# 過去の各年を開始年として、その年からの実際の利回り・物価の並びで今の計画を計算する。
+# 全ての開始年 (窓) は、系列のずらし見 (sliding_window_view) を1回のベクトル化計算にまとめて流す。
+# ==========================================
+
+HISTORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "historical_returns.csv")
+
+# 設定のキー → 使う系列 (r_401k は設定の利回りのまま)
+HISTORY_KEYS = {"r_nisa": "equity", "r_paypay": "equity", "r_cash": "deposit", "inflation": "cpi"}
+
+class History:
+    def __init__(self, years, series):
+        self.years = years
+        self.series = series
+
+    def __len__(self):
+        return len(self.years)
+
+def load_history(path=HISTORY_PATH):
+    # "#" で始まる行は説明。値は % なので比率に直す
+    with open(path, encoding="utf-8") as f:
+        rows = list(csv.DictReader(line for line in f if not line.startswith("#")))
+    years = np.array([int(row["year"]) for row in rows], dtype=np.int64)
+    series = {name: np.array([float(row[name]) for row in rows]) / 100 for name in rows[0] if name != "year"}
+    return History(years, series)
+
+def window_returns(history, n_years):
+    # 戻り値: (開始年の配列, {"r_nisa": (n_years + 1, 窓の数), ...})。行 0 は初年度の状態なので使われない
+    # 計画がデータより短ければ、データの中に収まる窓だけ。長ければデータの最後から最初に戻って続ける (開始年はデータの全ての年)
+    n = len(history)
+    wrap = n_years > n
+    n_windows = n if wrap else n - n_years + 1
+    returns = {}
+    for key, name in HISTORY_KEYS.items():
+        values = history.series[name]
+        if wrap:
+            values = np.tile(values, n_years // n + 2)
+        # 先頭に使われない値を1つ足し、窓の行 0 をそれに当てる (コピーせずにずらし見するだけ)
+        padded = np.concatenate([values[:1], values])
+        returns[key] = sliding_window_view(padded, n_years + 1)[:n_windows].T
+    return history.years[:n_windows], returns
+
+class BacktestResult:
+    def __init__(self, ages, start_years, total, current_age, wrapped):
+        self.ages = ages
+        self.start_years = start_years
+        # (窓の数, 年齢数)
+        self.total = total
+        self.wrapped = wrapped
+        depleted = (total <= 0) & (ages > current_age)
+        self.depleted = depleted.any(axis=1)
+        self.depletion_age = np.where(self.depleted, ages[depleted.argmax(axis=1)], -1)
+        # 最終年齢の総資産で並べた順 (先頭が最悪)
+        self.order = np.argsort(total[:, -1], kind="stable")
+
+    @property
+    def nbytes(self):
+        return self.ages.nbytes + self.start_years.nbytes + self.total.nbytes
+
+    @property
+    def ruin_share(self):
+        return float(self.depleted.mean())
+
+    def pick(self):
+        # {"worst": 窓の番号, "median": ..., "best": ...}
+        order = self.order
+        return {"worst": int(order[0]), "median": int(order[len(order) // 2]), "best": int(order[-1])}
+
+def run_backtest(config, history=None):
+    c = normalize_config(config)
+    if history is None:
+        history = load_history()
+    n_years = c["end_age"] - c["current_age"]
+    start_years, returns = window_returns(history, n_years)
+    P = repeat_params(prepare_batch([c]), len(start_years))
+    result = run_vectorized(P, returns, columns=("Total",))
+    return BacktestResult(result.ages, start_years, result.columns["Total"], c["current_age"], n_years > len(history))
+
+BACKTEST_CACHE = SimulationCache(max_entries=32, max_bytes=16 * 1024 * 1024)
+
+def run_backtest_cached(config, cache=BACKTEST_CACHE):
+    key = config_hash(config)
+    result = cache.get(key)
+    if result is None:
+        result = run_backtest(config)
+        cache.put(key, result)
+    return result
@@ -0,0 +1,196 @@
+import argparse
+import importlib.util
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from batch_engine import merge_results, simulate_batch
+from engine import MONTHLY_COLUMNS, validate_config
+
+# ==========================================
+# バッチ実行 (コマンドライン)
+# 「💾 保存」で書き出した設定ファイルを、Streamlit を起動せずにまとめて計算する
+#
+#   python batch_cli.py 設定フォルダ/ -o 出力フォルダ/
+#   cat configs.jsonl | python batch_cli.py - -o 出力フォルダ/ --format parquet
+#
+# 出力: 年ごとの推移 (yearly) と、設定ごとに1行の要約 (summary)。
+# 設定はチャンク単位で読み込み・計算・書き出しするので、件数が増えてもメモリはチャンク分で頭打ちになる。
+# ==========================================
+
+FORMATS = ("csv", "parquet")
+
+# --- 入力 ---
+
+def iter_sources(source):
+    # (ID, JSON 文字列) を1件ずつ返す。フォルダなら *.json を名前順に、それ以外は JSONL (1行1設定、"-" は標準入力)
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.endswith(".json"):
+                with open(os.path.join(source, name), encoding="utf-8") as f:
+                    yield name, f.read()
+        return
+    label = "stdin" if source == "-" else os.path.basename(source)
+    stream = sys.stdin if source == "-" else open(source, encoding="utf-8")
+    try:
+        for lineno, line in enumerate(stream, 1):
+            if line.strip():
+                yield f"{label}:{lineno}", line
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+def load_config(text):
+    # 画面の読み込み (load_uploaded_settings) と同じく、知らないキーは無視し、足りないキーは既定値で埋める
+    # 数値の型違い・入力欄の範囲外の値はここで弾き、1件のためにチャンク全体の計算が止まらないようにする
+    return validate_config(json.loads(text))
+
+def iter_configs(source, errors):
+    for config_id, text in iter_sources(source):
+        try:
+            yield config_id, load_config(text)
+        except ValueError as e:
+            # json.JSONDecodeError も ValueError
+            errors.append(config_id)
+            print(f"⚠️ {config_id}: 読み込めませんでした ({e})", file=sys.stderr)
+
+# --- 出力 ---
+
+class TableWriter:
+    # チャンクごとの DataFrame を1つのファイルに追記していく
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        self._file = None
+        self._parquet = None
+
+    def write(self, df):
+        if self.fmt == "csv":
+            if self._file is None:
+                # Excel で文字化けしないよう BOM 付き UTF-8
+                self._file = open(self.path, "w", encoding="utf-8-sig", newline="")
+                df.to_csv(self._file, index=False)
+            else:
+                df.to_csv(self._file, index=False, header=False)
+            return
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self._parquet is None:
+            self._parquet = pq.ParquetWriter(self.path, table.schema)
+        self._parquet.write_table(table)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        if self._parquet is not None:
+            self._parquet.close()
+
+def yearly_frame(ids, result):
+    # 各設定の範囲 (current_age〜end_age) の行だけを、設定順・年齢順に平らに並べる
+    in_range = (result.ages >= result.current_age[:, None]) & (result.ages <= result.end_age[:, None])
+    rows, cols = np.nonzero(in_range)
+    data = {"config_id": np.asarray(ids, dtype=object)[rows], "Age": result.ages[cols]}
+    for name in MONTHLY_COLUMNS[1:]:
+        # 年次だけのチャンクには「現金不足月数」が無いので 0 で埋め、列の並びをそろえる
+        data[name] = result.columns[name][in_range] if name in result.columns else np.zeros(len(rows), dtype=np.int64)
+    return pd.DataFrame(data)
+
+def summary_frame(ids, configs, result):
+    in_range = (result.ages >= result.current_age[:, None]) & (result.ages <= result.end_age[:, None])
+    total = result.columns["Total"]
+    depletion = result.depletion_age()
+    return pd.DataFrame({
+        "config_id": ids,
+        "step_mode": [c["step_mode"] for c in configs],
+        "current_age": result.current_age,
+        "end_age": result.end_age,
+        "final_total": result.final("Total"),
+        "min_total": np.where(in_range, total, np.iinfo(np.int64).max).min(axis=1),
+        # 尽きない場合は空欄
+        "depletion_age": pd.Series(depletion).where(depletion >= 0).astype("Int64"),
+    })
+
+# --- 本体 ---
+
+def simulate_chunk(ids, configs, errors):
+    # 戻り値: (計算できた ID, 設定, BatchResult)。チャンクの計算に失敗したら1件ずつ計算し直し、
+    # 失敗した設定は errors に記録して除く (読み込みで弾けなかった値でも、他の設定は書き出す)
+    try:
+        return ids, configs, simulate_batch(configs)
+    except Exception:
+        pass
+    parts = []
+    kept_ids, kept = [], []
+    for config_id, config in zip(ids, configs):
+        try:
+            result = simulate_batch([config])
+        except Exception as e:
+            errors.append(config_id)
+            print(f"⚠️ {config_id}: 計算できませんでした ({e})", file=sys.stderr)
+            continue
+        parts.append((np.array([len(kept)]), result))
+        kept_ids.append(config_id)
+        kept.append(config)
+    return kept_ids, kept, merge_results(parts, len(kept)) if parts else None
+
+def run_batch(source, out_dir, fmt="csv", chunk_size=1000, yearly=True, progress=None):
+    os.makedirs(out_dir, exist_ok=True)
+    summary = TableWriter(os.path.join(out_dir, f"summary.{fmt}"), fmt)
+    detail = TableWriter(os.path.join(out_dir, f"yearly.{fmt}"), fmt) if yearly else None
+    errors = []
+    done = 0
+    configs = iter_configs(source, errors)
+    try:
+        while True:
+            chunk = list(itertools.islice(configs, chunk_size))
+            if not chunk:
+                break
+            ids, chunk_configs, result = simulate_chunk(
+                [config_id for config_id, _ in chunk], [config for _, config in chunk], errors)
+            if result is None:
+                continue
+            summary.write(summary_frame(ids, chunk_configs, result))
+            if detail is not None:
+                detail.write(yearly_frame(ids, result))
+            done += len(ids)
+            if progress is not None:
+                progress(done)
+    finally:
+        summary.close()
+        if detail is not None:
+            detail.close()
+    return done, errors
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="保存した設定ファイルをまとめてシミュレーションし、結果をファイルに書き出します。")
+    parser.add_argument("source", help="設定ファイル (*.json) のフォルダ、JSONL ファイル、または - (標準入力の JSONL)")
+    parser.add_argument("-o", "--out", required=True, help="出力フォルダ")
+    parser.add_argument("--format", choices=FORMATS, default="csv", help="出力形式 (既定: csv)")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="一度に計算する設定の件数 (既定: 1000)")
+    parser.add_argument("--summary-only", action="store_true", help="年ごとの推移を書き出さず、要約だけにする")
+    args = parser.parse_args(argv)
+
+    if args.format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        parser.error("Parquet 出力には pyarrow が必要です (pip install pyarrow)")
+    if args.chunk_size < 1:
+        parser.error("--chunk-size は 1 以上にしてください")
+
+    start = time.perf_counter()
+
+    def progress(done):
+        print(f"{done:,} 件 ({time.perf_counter() - start:.1f} 秒)", file=sys.stderr)
+
+    done, errors = run_batch(args.source, args.out, args.format, args.chunk_size, not args.summary_only, progress)
+    print(f"✅ {done:,} 件を計算しました ({time.perf_counter() - start:.1f} 秒) → {args.out}", file=sys.stderr)
+    if errors:
+        print(f"⚠️ 読み込めなかった・計算できなかった設定: {len(errors):,} 件", file=sys.stderr)
+    return 1 if errors and not done else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
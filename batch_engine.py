@@ -0,0 +1,678 @@
+import numpy as np
+
+from engine import (
+    AGE_KEYS,
+    COLUMNS,
+    COST_BASIS_METHODS,
+    DEFAULT_CONFIG,
+    MONTHLY_COLUMNS,
+    NISA_GROWTH_LIMIT,
+    NISA_LIFETIME_LIMIT,
+    NISA_TSUMITATE_LIMIT,
+    RATE_KEYS,
+    YEN_KEYS,
+)
+
+# ==========================================
+# ベクトル化エンジン
+# 1シナリオ = 配列の1要素として、多数の設定を年ループ1本でまとめて計算する
+# (計算順序は engine.simulate と同じにしてあるので、年次モードの結果は1円単位で一致する。
+#  月次モードは 12 か月をそのまま回すので、engine の等比数列の和による計算とは丸め誤差の範囲で一致する)
+# ==========================================
+
+LIMIT_MODES = {"年額定額 (万円)": 0, "総資産比率 (%)": 1, "残高比率 (%)": 2}
+
+# その年に払った税 (401k 一括受取の税と、取り崩しで売った額と手取りの差)。columns で頼んだときだけ記録する
+# 年金の税・社会保険料は設定だけで決まる (取り崩し方で変わらない) ので含めない
+TAX_COLUMN = "税金"
+
+_STR_KEYS = ("priority", "limit_mode_nisa", "limit_mode_other", "step_mode", "cost_basis")
+# 取得価額の管理 → 0: 管理しない / 1: 総平均法 / 2: 先入先出法 (知らない値は 0)
+COST_BASIS_CODES = {m: i for i, m in enumerate(COST_BASIS_METHODS)}
+
+# --- 設定の配列化 ---
+
+def prepare_batch(configs):
+    # engine.prepare_params の配列版 (キーごとに列を作ってから単位変換する)
+    def column(key, dtype=np.float64):
+        default = DEFAULT_CONFIG[key]
+        return np.array([c.get(key, default) for c in configs], dtype=dtype)
+
+    P = {}
+    for key in DEFAULT_CONFIG:
+        if key in _STR_KEYS:
+            continue
+        P[key] = column(key, np.int64 if key in AGE_KEYS else np.float64)
+    for key in YEN_KEYS:
+        P[key] = P[key] * 10000
+    for key in RATE_KEYS:
+        P[key] = P[key] / 100
+    for name in ("nisa", "other"):
+        modes = np.array([LIMIT_MODES.get(m, -1) for m in column(f"limit_mode_{name}", object)], dtype=np.int8)
+        P[f"limit_mode_{name}"] = modes
+        P[f"{name}_limit_yen_calc"] = np.where(modes == 0, P[f"limit_val_{name}_yen"] * 10000, P[f"limit_val_{name}_pct"])
+    P["nisa_first"] = column("priority", object) == "新NISAから先に使う"
+    P["monthly"] = column("step_mode", object) == "月次"
+    P["cost_basis"] = np.array([COST_BASIS_CODES.get(m, 0) for m in column("cost_basis", object)], dtype=np.int8)
+    P["n"] = len(configs)
+    P["schedule"] = compile_schedules(P)
+    return P
+
+# --- 年齢ごとの表 (engine.Schedule の配列版) ---
+# (シナリオ数, 年齢数) の表を、年齢 (1, 年齢数) と設定 (シナリオ数, 1) の比較で一度に作る。
+# 年ループの中では列を1本引くだけになる。モンテカルロ・バックテストのように1件の設定を複製する場合は
+# 表は (1, 年齢数) のまま持ち、ブロードキャストで全パスに使う。
+
+_BRACKETS = (
+    ("inc_20s", "exp_20s", "cost_20s"), ("inc_30s", "exp_30s", "cost_30s"), ("inc_40s", "exp_40s", "cost_40s"),
+    ("inc_50s", "exp_50s", "cost_50s"), ("inc_60s", "exp_6064", "cost_6064"), ("inc_60s", "exp_65", "cost_65"),
+)
+
+def compile_schedules(P):
+    cur, end = P["current_age"], P["end_age"]
+    a0 = int(cur.min()) if P["n"] else 0
+    a1 = int(end.max()) if P["n"] else -1
+    A = np.arange(a0, a1 + 1)[None, :]
+
+    def col(key):
+        return P[key][:, None]
+
+    brackets = [A < 30, A < 40, A < 50, A < 60, A < 65]
+
+    def by_bracket(j):
+        return np.select(brackets, [col(b[j]) for b in _BRACKETS[:5]], col(_BRACKETS[5][j]))
+
+    def events(kind):
+        # 臨時収支は1件につき1つの年齢にしか入らないので、その位置にだけ足す (1件目から順に足すのは engine と同じ)
+        table = np.zeros((P["n"], A.shape[1]))
+        for k in (1, 2, 3):
+            i = np.flatnonzero((P[f"{kind}{k}_a"] >= a0) & (P[f"{kind}{k}_a"] <= a1))
+            table[i, P[f"{kind}{k}_a"][i] - a0] += P[f"{kind}{k}_v"][i]
+        return table
+
+    awl = col("age_work_last")
+    working = A <= awl
+    retired = A > awl
+    salary = np.where(working, by_bracket(0), 0.0)
+    extra = by_bracket(1)
+    cost_base = by_bracket(2) * 12
+    pension = np.where(A >= col("age_pension"), col("pension_monthly") * 12 * (1 - col("tax_pension")), 0.0)
+    # 退職後の生活費は (1 + インフレ率) ** (退職からの年数) を掛ける (** の表から引く)
+    infl_table, infl_row = _power_table(1 + P["inflation"], a1 - (int(P["age_work_last"].min()) if P["n"] else 0))
+    cost = np.where(retired, cost_base * infl_table[infl_row[:, None], np.where(retired, A - awl, 0)], cost_base)
+
+    k401_grows = A < col("age_401k_get")
+    k401_add = np.where(working & k401_grows & (A <= col("k401_stop_age")), col("k401_monthly") * 12, 0.0)
+    event_inc = events("inc")
+    event_dec = events("dec")
+    nisa_open = A <= col("nisa_stop_age")
+    target = np.where(A < 50, col("dam_1"), np.where(A < 60, col("dam_2"), col("dam_3")))
+    income = salary + pension
+    return {
+        "a0": a0,
+        "working": working,
+        "retired": retired,
+        # 年次: 収入と、支出のうち残高に依存しない分 (足す順番は engine と同じ)
+        "inflow": income + event_inc,
+        "outflow": cost + extra + event_dec + k401_add,
+        # 月次: 年額の収入・支出 (臨時収支は年初にまとめて lump)
+        "income": income,
+        "monthly_out": cost + extra + k401_add,
+        "lump": event_inc - event_dec,
+        # 変動インフレ率のときは生活費をループの中で作り直す
+        "cost_base": cost_base,
+        "extra": extra,
+        "event_dec": event_dec,
+        "k401_add": k401_add,
+        "k401_grows": k401_grows,
+        "get_401k": A == col("age_401k_get"),
+        "nisa_cap": np.where(nisa_open, np.minimum(col("nisa_monthly") * 12, NISA_TSUMITATE_LIMIT), 0.0),
+        "paypay_add": np.where(A <= col("paypay_stop_age"), col("paypay_monthly") * 12, 0.0),
+        # 現金がこの額を超えたら超過分を成長枠へ (積立期間外は inf)
+        "sweep_above": np.where(nisa_open, target, np.inf),
+        "nisa_unlocked": A >= col("nisa_start_age"),
+        "other_unlocked": A >= col("paypay_start_age"),
+    }
+
+# --- 取り崩しルール (配列版) ---
+
+def calc_actual_limit_vec(mode, val, current_asset, total_assets):
+    fixed = np.where(val == 0, np.inf, val)
+    limit = np.where(mode == 0, fixed, np.inf)
+    limit = np.where(mode == 1, total_assets * (val / 100), limit)
+    limit = np.where(mode == 2, current_asset * (val / 100), limit)
+    return limit
+
+def withdraw_asset_vec(mask, needed, current_val, principal_val, limit_yen, tax_rate):
+    # mask が False の要素は何も変えない
+    keep = 1 - tax_rate
+    gross_needed = np.where(keep > 0, needed / np.where(keep > 0, keep, 1.0), needed)
+    can_withdraw_gross = np.minimum(np.minimum(gross_needed, current_val), limit_yen)
+    can_withdraw_gross = np.where(mask, can_withdraw_gross, 0.0)
+    net_cash_obtained = can_withdraw_gross * keep
+    new_val = np.where(mask, current_val - can_withdraw_gross, current_val)
+    new_principal = principal_val
+    if principal_val is not None:
+        shrink = mask & (current_val > 0) & (can_withdraw_gross > 0)
+        ratio = can_withdraw_gross / np.where(shrink, current_val, 1.0)
+        new_principal = np.where(shrink, principal_val * (1 - ratio), principal_val)
+    return net_cash_obtained, new_val, new_principal
+
+# --- 結果 ---
+
+class BatchResult:
+    # 各列は (シナリオ数, 年齢数) の int64 配列。列方向は ages (絶対年齢) に揃えてある
+    def __init__(self, ages, columns, current_age, end_age, checkpoints=None):
+        self.ages = ages
+        self.columns = columns
+        self.current_age = current_age
+        self.end_age = end_age
+        self.checkpoints = checkpoints or {}
+
+    def __len__(self):
+        return len(self.current_age)
+
+    def _span(self, i):
+        a0 = int(self.ages[0])
+        return int(self.current_age[i]) - a0, int(self.end_age[i]) - a0 + 1
+
+    def series(self, i, column):
+        lo, hi = self._span(i)
+        return self.columns[column][i, lo:hi]
+
+    def records(self, i):
+        lo, hi = self._span(i)
+        cols = [("Age", self.ages[lo:hi])] + [(name, values[i, lo:hi]) for name, values in self.columns.items()]
+        return [{name: int(values[j]) for name, values in cols} for j in range(hi - lo)]
+
+    def final(self, column="Total"):
+        idx = self.end_age - int(self.ages[0])
+        return self.columns[column][np.arange(len(self)), idx]
+
+    def depletion_age(self):
+        # engine.depletion_age の配列版 (尽きなければ -1)
+        in_range = (self.ages > self.current_age[:, None]) & (self.ages <= self.end_age[:, None])
+        depleted = in_range & (self.columns["Total"] <= 0)
+        first = depleted.argmax(axis=1)
+        return np.where(depleted.any(axis=1), self.ages[first], -1)
+
+# --- 取得価額の管理 (engine.LotBook の配列版) ---
+# ロットは (シナリオ数, 年齢数) の配列で、列はその年齢に買った分 (列 0 は初期残高)。計算の順番は engine と同じ。
+# 売却は、売るシナリオの行だけを取り出し、古いロットから _LOT_WINDOW 列ずつ、売り終わるまで進める
+# (1回の売却で減るロットはたいてい数本なので、全部の列は見ない)。足し合わせは engine と同じく古いロットから順に足す。
+
+_LOT_WINDOW = 8
+
+def _running(carry, x):
+    # carry に x の各列を左から順に足していった途中の値 (先頭の列は carry。np.sum とは足す順番が違う)
+    return np.cumsum(np.concatenate([carry[:, None], x], axis=1), axis=1)
+
+class LotBooks:
+    def __init__(self, value, T, fifo, tax_rate, start):
+        # start: 各シナリオの初年度の列 (初期残高のロットを置く)
+        n = len(value)
+        self.fifo = fifo
+        self.tax_rate = np.broadcast_to(np.asarray(tax_rate, dtype=np.float64), (n,))
+        # 各行のまだ残っている最も古いロットと、買付のあった最後のロットの次 (売却はこの間だけを見る)
+        self.first = start.copy()
+        self.top = start.copy()
+        # 総平均法だけのときはロットの配列を持たない (末尾の余りの列は、売却の窓がはみ出しても読めるように)
+        self.units = np.zeros((n, T + _LOT_WINDOW)) if fifo.any() else None
+        self.cost = np.zeros((n, T + _LOT_WINDOW)) if fifo.any() else None
+        # 初期残高は、その時点の時価を取得価額とする (含み益なし)
+        held = value > 0
+        self.total_units = np.where(held, value, 0.0)
+        self.basis = self.total_units.copy()
+        self.top = np.where(held, start + 1, start)
+        if self.units is not None:
+            self.units[np.arange(n), start] = self.total_units
+            self.cost[np.arange(n), start] = self.total_units
+
+    def buy(self, col, amount, value):
+        buying = amount > 0
+        if not buying.any():
+            return
+        # 空の口座 (売り切った後の端数を含む) は単価 1 から数え直す
+        empty = buying & ((value <= 0) | (self.total_units <= 0))
+        if empty.any():
+            self.total_units = np.where(empty, 0.0, self.total_units)
+            self.basis = np.where(empty, 0.0, self.basis)
+            if self.units is not None:
+                self.units[empty] = 0.0
+                self.cost[empty] = 0.0
+                self.first[empty] = col
+        priced = buying & ~empty
+        price = np.where(priced, value / np.where(priced, self.total_units, 1.0), 1.0)
+        units = np.where(buying, amount / price, 0.0)
+        self.total_units = np.where(buying, self.total_units + units, self.total_units)
+        self.basis = np.where(buying, self.basis + amount, self.basis)
+        self.top = np.where(buying, col + 1, self.top)
+        if self.units is not None:
+            self.units[:, col] += units
+            self.cost[:, col] += np.where(buying, amount, 0.0)
+
+    def sell(self, mask, w, value):
+        # mask の行で、残高 value のうち w を売る
+        # 戻り値: (税引後の受取額, 売った分の取得価額)。mask の外は 0
+        net = np.zeros(len(w))
+        consumed = np.zeros(len(w))
+        sold = np.zeros(len(w))
+        tax = np.zeros(len(w))
+        # ロットを売り切った後の端数の残高は、総平均法と同じに扱う
+        fifo = self.fifo & (self.total_units > 0)
+        avg = np.flatnonzero(mask & ~fifo)
+        if len(avg):
+            frac = w[avg] / value[avg]
+            sold[avg] = self.total_units[avg] * frac
+            consumed[avg] = self.basis[avg] * frac
+            tax[avg] = self.tax_rate[avg] * np.maximum(w[avg] - consumed[avg], 0.0)
+        rows = np.flatnonzero(mask & fifo)
+        if len(rows):
+            price = value[rows] / self.total_units[rows]
+            rate = self.tax_rate[rows]
+            goal = w[rows]
+            before = np.zeros(len(rows))
+            out = np.zeros((3, len(rows)))
+            col = self.first[rows].copy()
+            top = self.top[rows]
+            live = np.arange(len(rows))
+            window = np.arange(_LOT_WINDOW)
+            while len(live):
+                r, j = rows[live][:, None], col[live][:, None] + window
+                u = self.units[r, j]
+                cost = self.cost[r, j]
+                v = u * price[live][:, None]
+                b = _running(before[live], v)
+                take = np.minimum(np.maximum(goal[live][:, None] - b[:, :-1], 0.0), v)
+                frac = np.divide(take, v, out=np.zeros_like(v), where=take > 0)
+                c = cost * frac
+                rest = u - u * frac
+                self.units[r, j] = rest
+                self.cost[r, j] = cost - c
+                out[0, live] = _running(out[0, live], u * frac)[:, -1]
+                out[1, live] = _running(out[1, live], c)[:, -1]
+                out[2, live] = _running(out[2, live], rate[live][:, None] * np.maximum(take - c, 0.0))[:, -1]
+                before[live] = b[:, -1]
+                going = (before[live] < goal[live]) & (col[live] + _LOT_WINDOW < top[live])
+                # 売り終わった行は、窓の中で残っているロットから (窓の中を売り切っていれば次の窓から)
+                done, left = live[~going], rest[~going] != 0
+                self.first[rows[done]] = np.where(left.any(axis=1), col[done] + left.argmax(axis=1),
+                                                  np.minimum(col[done] + _LOT_WINDOW, top[done] - 1))
+                col[live[going]] += _LOT_WINDOW
+                live = live[going]
+            sold[rows], consumed[rows], tax[rows] = out
+        self.total_units = np.where(mask, self.total_units - sold, self.total_units)
+        self.basis = np.where(mask, self.basis - consumed, self.basis)
+        net[mask] = (w - tax)[mask]
+        return net, consumed
+
+    def gross_for(self, mask, net, value):
+        # 税引後で net を受け取るのに売る額 (全部売っても足りなければ残高)。mask の外は net のまま
+        rate = self.tax_rate
+        gross = net.copy()
+        taxed = mask & (rate != 0) & (value > 0)
+        fifo = self.fifo & (self.total_units > 0)
+        avg = np.flatnonzero(taxed & ~fifo)
+        if len(avg):
+            keep = 1 - rate[avg] * np.maximum(1 - self.basis[avg] / value[avg], 0.0)
+            gross[avg] = np.where(keep > 0, net[avg] / np.where(keep > 0, keep, 1.0), net[avg])
+        rows = np.flatnonzero(taxed & fifo)
+        if len(rows):
+            price = value[rows] / self.total_units[rows]
+            rate = rate[rows]
+            goal = net[rows]
+            got = np.zeros(len(rows))
+            total = np.zeros(len(rows))
+            col = self.first[rows].copy()
+            top = self.top[rows]
+            live = np.arange(len(rows))
+            window = np.arange(_LOT_WINDOW)
+            while len(live):
+                r, j = rows[live][:, None], col[live][:, None] + window
+                v = self.units[r, j] * price[live][:, None]
+                cap = v - rate[live][:, None] * np.maximum(v - self.cost[r, j], 0.0)
+                g = _running(got[live], cap)
+                take = np.minimum(np.maximum(goal[live][:, None] - g[:, :-1], 0.0), cap)
+                parts = np.divide(take, cap, out=np.zeros_like(cap), where=take > 0) * v
+                total[live] = _running(total[live], parts)[:, -1]
+                got[live] = g[:, -1]
+                going = (got[live] < goal[live]) & (col[live] + _LOT_WINDOW < top[live])
+                col[live[going]] += _LOT_WINDOW
+                live = live[going]
+            gross[rows] = np.where(got >= goal, total, value[rows])
+        return gross
+
+class BatchLots:
+    # engine.TaxLots の配列版。start_year() でその年の列と、計算中のシナリオ (active) を決める
+    # 範囲外のシナリオは状態を据え置くので、ロットにも買付・売却を記録しない
+    def __init__(self, P, T):
+        fifo = P["cost_basis"] == 2
+        start = P["current_age"] - P["current_age"].min()
+        self.nisa = LotBooks(P["ini_nisa"], T, fifo, 0.0, start)
+        self.other = LotBooks(P["ini_paypay"], T, fifo, P["tax_rate_other"], start)
+        self.freed = np.zeros(P["n"])
+        self.col = 0
+        self.active = None
+
+    def start_year(self, col, active):
+        self.col = col
+        self.active = active
+        self.freed = np.zeros(len(active))
+
+    def buy(self, book, amount, value):
+        book.buy(self.col, np.where(self.active, amount, 0.0), value)
+
+    def sweep_room(self):
+        # 生涯枠は、今年売った分の取得価額をまだ戻さずに数える
+        return np.maximum(0, NISA_LIFETIME_LIMIT - (self.nisa.basis + self.freed))
+
+    def _sell_nisa(self, mask, shortage, nisa, limit_yen):
+        w = np.minimum(np.minimum(shortage, nisa), limit_yen)
+        _, consumed = self.nisa.sell(mask & (w > 0), w, nisa)
+        self.freed = self.freed + consumed
+        return np.where(mask, shortage - w, shortage), np.where(mask, nisa - w, nisa)
+
+    def _sell_other(self, mask, shortage, paypay, limit_yen):
+        gross = self.other.gross_for(mask, shortage, paypay)
+        w = np.minimum(np.minimum(gross, paypay), limit_yen)
+        sell = mask & (w > 0)
+        net, _ = self.other.sell(sell, w, paypay)
+        return np.where(sell, shortage - net, shortage), np.where(sell, paypay - w, paypay)
+
+    def withdraw(self, P, unlocked, short, shortage, nisa, paypay, nisa_principal, limit_nisa_yen, limit_other_yen):
+        # _withdraw_vec のロット版 (引数・戻り値も同じ)
+        short = short & self.active
+        nisa_first = P["nisa_first"]
+        nisa_open = short & unlocked[0]
+        other_open = short & unlocked[1]
+        nisa_before, paypay_before = nisa, paypay
+        shortage, nisa = self._sell_nisa(nisa_open & nisa_first, shortage, nisa, limit_nisa_yen)
+        shortage, paypay = self._sell_other(other_open, shortage, paypay, limit_other_yen)
+        shortage, nisa = self._sell_nisa(nisa_open & ~nisa_first, shortage, nisa, limit_nisa_yen)
+        return nisa, paypay, self.nisa.basis, shortage, (nisa_before - nisa, paypay_before - paypay)
+
+# --- シミュレーション本体 ---
+
+def _power_table(base, max_exp):
+    # np.power は Python の ** と末尾ビットが食い違うことがあるため、
+    # 基数ごとに ** で表を作ってから引く (基数の種類は設定の数よりずっと少ない)
+    uniq, row = np.unique(base, return_inverse=True)
+    max_exp = max(max_exp, 0)
+    table = np.array([[b ** k for k in range(max_exp + 1)] for b in uniq.tolist()], dtype=np.float64)
+    return table, row
+
+def _withdraw_vec(P, unlocked, short, shortage, nisa, paypay, nisa_principal, limit_nisa_yen, limit_other_yen):
+    # 優先順位: NISA先 → [NISA, 他運用] / 他運用先 → [他運用, NISA]
+    # unlocked: (NISA を取り崩せるか, 他運用を取り崩せるか) のその年の列
+    # 戻り値の最後は、各資産から実際に引いた額 (税引前) の合計 (月次モードの上限管理用)
+    nisa_first = P["nisa_first"]
+    nisa_open = short & unlocked[0]
+    other_open = short & unlocked[1]
+    nisa_before, paypay_before = nisa, paypay
+    pay, nisa, nisa_principal = withdraw_asset_vec(nisa_open & nisa_first, shortage, nisa, nisa_principal, limit_nisa_yen, 0.0)
+    shortage = np.where(nisa_open & nisa_first, shortage - pay, shortage)
+    pay, paypay, _ = withdraw_asset_vec(other_open, shortage, paypay, None, limit_other_yen, P["tax_rate_other"])
+    shortage = np.where(other_open, shortage - pay, shortage)
+    pay, nisa, nisa_principal = withdraw_asset_vec(nisa_open & ~nisa_first, shortage, nisa, nisa_principal, limit_nisa_yen, 0.0)
+    shortage = np.where(nisa_open & ~nisa_first, shortage - pay, shortage)
+    return nisa, paypay, nisa_principal, shortage, (nisa_before - nisa, paypay_before - paypay)
+
+def _step_months_vec(P, unlocked, state, flows, growth, lots=None):
+    # engine._step_months の配列版。年率の成長率 (1 + r) を月次に直して 12 か月回す
+    # lots: ロットを管理する場合の BatchLots (毎月の積立をロットに記録し、取り崩しもロット版を使う)
+    cash, k401, nisa, paypay, nisa_principal = state
+    fc, lump, an, ap, ak, get_401k, k401_grows = flows
+    gc, gn, gp, gk = (g ** (1 / 12) for g in growth)
+    withdraw = _withdraw_vec if lots is None else lots.withdraw
+    limit_nisa_yen = limit_other_yen = None
+    short_months = np.zeros(P["n"], dtype=np.int64)
+    tax = np.zeros(P["n"])
+    for m in range(12):
+        cash = cash * gc + fc
+        if lots is None:
+            nisa = nisa * gn + an
+            nisa_principal = nisa_principal + an
+            paypay = paypay * gp + ap
+        else:
+            nisa = nisa * gn
+            lots.buy(lots.nisa, an, nisa)
+            nisa = nisa + an
+            nisa_principal = lots.nisa.basis
+            paypay = paypay * gp
+            lots.buy(lots.other, ap, paypay)
+            paypay = paypay + ap
+        if m == 0:
+            tax = np.where(get_401k, k401 * P["tax_401k"], tax)
+            cash = np.where(get_401k, cash + k401 * (1 - P["tax_401k"]), cash) + lump
+            k401 = np.where(get_401k, 0.0, k401)
+        k401 = np.where(k401_grows, k401 * gk + ak, k401)
+
+        short = cash < 0
+        if not short.any():
+            continue
+        short_months += short
+        # 取り崩し上限は、その年最初の不足月の残高で決まる年額
+        total = nisa + paypay + k401
+        first_short = short & (short_months == 1)
+        new_nisa = calc_actual_limit_vec(P["limit_mode_nisa"], P["nisa_limit_yen_calc"], nisa, total)
+        new_other = calc_actual_limit_vec(P["limit_mode_other"], P["other_limit_yen_calc"], paypay, total)
+        limit_nisa_yen = new_nisa if limit_nisa_yen is None else np.where(first_short, new_nisa, limit_nisa_yen)
+        limit_other_yen = new_other if limit_other_yen is None else np.where(first_short, new_other, limit_other_yen)
+        needed = np.where(short, -cash, 0.0)
+        nisa, paypay, nisa_principal, shortage, (used_nisa, used_other) = withdraw(
+            P, unlocked, short, needed, nisa, paypay, nisa_principal, limit_nisa_yen, limit_other_yen)
+        limit_nisa_yen = limit_nisa_yen - used_nisa
+        limit_other_yen = limit_other_yen - used_other
+        tax = np.where(short, tax + used_nisa + used_other - (needed - shortage), tax)
+        cash = np.where(short, -shortage, cash)
+    return cash, k401, nisa, paypay, nisa_principal, short_months, tax
+
+def simulate_batch(configs, columns=None):
+    # columns: run_vectorized と同じ (記録する列。TAX_COLUMN はここで頼んだときだけ)
+    P = prepare_batch(configs)
+    monthly = P["monthly"]
+    group = monthly * 2 + (P["cost_basis"] > 0)
+    kinds = np.unique(group)
+    if len(kinds) > 1:
+        # 年次と月次、ロットの管理の有無が混ざっている場合は分けて計算し、元の順番に戻す
+        parts = [(idx, run_vectorized(take_params(P, idx), columns=columns))
+                 for idx in (np.flatnonzero(group == k) for k in kinds)]
+        return merge_results(parts, P["n"])
+    return run_vectorized(P, columns=columns)
+
+def take_params(P, idx):
+    R = {key: (value[idx] if isinstance(value, np.ndarray) else value) for key, value in P.items()}
+    R["schedule"] = {key: (value[idx] if isinstance(value, np.ndarray) and len(value) > 1 else value)
+                     for key, value in P["schedule"].items()}
+    R["n"] = len(idx)
+    return R
+
+def merge_results(parts, n):
+    # 年次の結果には「現金不足月数」が無いので 0 のまま (各シナリオの範囲外の年齢も使われないので 0 のまま)
+    a0 = min(int(r.ages[0]) for _, r in parts)
+    a1 = max(int(r.ages[-1]) for _, r in parts)
+    ages = np.arange(a0, a1 + 1)
+    names = [name for name in MONTHLY_COLUMNS[1:] + [TAX_COLUMN] if any(name in r.columns for _, r in parts)]
+    out = {name: np.zeros((n, len(ages)), dtype=np.int64) for name in names}
+    cur = np.zeros(n, dtype=np.int64)
+    end = np.zeros(n, dtype=np.int64)
+    for idx, r in parts:
+        lo = int(r.ages[0]) - a0
+        for name, values in r.columns.items():
+            out[name][idx, lo:lo + len(r.ages)] = values
+        cur[idx] = r.current_age
+        end[idx] = r.end_age
+    return BatchResult(ages, out, cur, end)
+
+def repeat_params(P, n):
+    # 1件の設定を n 本のパスに複製する (モンテカルロ用)
+    # 年齢ごとの表は、設定が1件なら (1, 年齢数) のまま全パスで共有する
+    R = {key: (np.repeat(value, n) if isinstance(value, np.ndarray) else value) for key, value in P.items()}
+    R["schedule"] = {key: (np.repeat(value, n, axis=0) if isinstance(value, np.ndarray) and len(value) > 1 else value)
+                     for key, value in P["schedule"].items()}
+    R["n"] = P["n"] * n
+    return R
+
+def run_vectorized(P, returns=None, columns=None, resume=None, checkpoint_every=0, on_year=None):
+    # returns: 年ごとに変動させる利回り {"r_cash": (年齢数, n), ...}。
+    # 列 col の値は ages[col-1] → ages[col] の1年間に適用される (単位は比率)
+    # columns: 記録する列 (省略時は TAX_COLUMN 以外の全部)。モンテカルロのように Total しか使わない場合はメモリと時間の節約になる
+    # checkpoint_every: N 年ごとに丸める前の状態を result.checkpoints[col] に残す
+    # (ロットを管理する設定では、ロットが状態に入らないので残さない)
+    # resume: (col, checkpoints[col - 1], 前回の result.columns)。col 列目から計算を再開する
+    # on_year(進み具合 0〜1): 1年分を計算するたびに呼ぶ (例外を投げれば計算を途中で止められる)
+    n = P["n"]
+    cur, end = P["current_age"], P["end_age"]
+    a0, a1 = int(cur.min()), int(end.max())
+    ages = np.arange(a0, a1 + 1)
+    T = len(ages)
+
+    monthly = bool(P["monthly"].all())
+    # ロットの管理も、全シナリオがする場合だけ (simulate_batch は混ざっていれば分けて呼ぶ)
+    lots = BatchLots(P, T) if P["cost_basis"].all() else None
+    if lots is not None:
+        checkpoint_every = 0
+    names = (MONTHLY_COLUMNS if monthly else COLUMNS)[1:]
+    out = {name: np.zeros((n, T), dtype=np.int64) for name in names if columns is None or name in columns}
+    if columns is not None and TAX_COLUMN in columns:
+        out[TAX_COLUMN] = np.zeros((n, T), dtype=np.int64)
+
+    cash = P["ini_cash"].copy()
+    k401 = P["ini_401k"].copy()
+    nisa = P["ini_nisa"].copy()
+    paypay = P["ini_paypay"].copy()
+    nisa_principal = P["ini_nisa"].copy()
+    infl_index = np.ones(n)
+    zeros = np.zeros(n)
+    checkpoints = {}
+
+    def record(col, tsumitate, growth, short_months=zeros, tax=zeros):
+        if "Total" in out: out["Total"][:, col] = cash + k401 + nisa + paypay
+        if "Cash" in out: out["Cash"][:, col] = cash
+        if "401k" in out: out["401k"][:, col] = k401
+        if "NISA" in out: out["NISA"][:, col] = nisa
+        if "Other" in out: out["Other"][:, col] = paypay
+        if "NISA積立枠" in out: out["NISA積立枠"][:, col] = tsumitate
+        if "NISA成長枠" in out: out["NISA成長枠"][:, col] = growth
+        if "NISA元本" in out: out["NISA元本"][:, col] = nisa_principal
+        if "現金不足月数" in out: out["現金不足月数"][:, col] = short_months
+        if TAX_COLUMN in out: out[TAX_COLUMN][:, col] = tax
+        if checkpoint_every and col % checkpoint_every == 0:
+            checkpoints[col] = (cash, k401, nisa, paypay, nisa_principal, infl_index)
+
+    if resume is None:
+        first_col = 1
+        record(0, zeros, zeros)
+    else:
+        first_col, state, previous = resume
+        cash, k401, nisa, paypay, nisa_principal, infl_index = state
+        for name, values in out.items():
+            values[:, :first_col] = previous[name][:, :first_col]
+
+    returns = returns or {}
+    g_cash, g_nisa, g_paypay, g_401k = 1 + P["r_cash"], 1 + P["r_nisa"], 1 + P["r_paypay"], 1 + P["r_401k"]
+    infl_path = returns.get("inflation")
+    keep_401k = 1 - P["tax_401k"]
+    # 年齢ごとの表は prepare_batch 時点の年齢の範囲で作ってあるので、この計算の範囲に合わせてずらす
+    off = a0 - P["schedule"]["a0"]
+    S = {key: value[:, off:off + T] for key, value in P["schedule"].items() if isinstance(value, np.ndarray)}
+
+    for col in range(first_col, T):
+        if on_year is not None:
+            on_year((col - first_col) / (T - first_col))
+        age = int(ages[col])
+        active = (age > cur) & (age <= end)
+        if not active.any():
+            record(col, zeros, zeros)
+            continue
+        prev = (cash, k401, nisa, paypay, nisa_principal)
+        if lots is not None:
+            lots.start_year(col, active)
+
+        if returns:
+            g_cash = 1 + returns["r_cash"][col] if "r_cash" in returns else g_cash
+            g_nisa = 1 + returns["r_nisa"][col] if "r_nisa" in returns else g_nisa
+            g_paypay = 1 + returns["r_paypay"][col] if "r_paypay" in returns else g_paypay
+            g_401k = 1 + returns["r_401k"][col] if "r_401k" in returns else g_401k
+
+        k401_grows = S["k401_grows"][:, col]
+        if not monthly:
+            cash = cash * g_cash
+            nisa = nisa * g_nisa
+            paypay = paypay * g_paypay
+            k401 = np.where(k401_grows, k401 * g_401k, k401)
+
+        val_k401_add = S["k401_add"][:, col]
+        if infl_path is None:
+            inflow, outflow = S["inflow"][:, col], S["outflow"][:, col]
+            income, monthly_out = S["income"][:, col], S["monthly_out"][:, col]
+        else:
+            # 変動インフレ率の場合は退職翌年からの物価指数を積み上げ、生活費を作り直す
+            retired = S["retired"][:, col]
+            infl_index = np.where(retired, np.where(active, infl_index * (1 + infl_path[col]), infl_index), 1.0)
+            cost_base = S["cost_base"][:, col]
+            current_cost = np.where(retired, cost_base * infl_index, cost_base)
+            inflow, income = S["inflow"][:, col], S["income"][:, col]
+            outflow = current_cost + S["extra"][:, col] + S["event_dec"][:, col] + val_k401_add
+            monthly_out = current_cost + S["extra"][:, col] + val_k401_add
+
+        can_invest = (cash > 0) | S["working"][:, col]
+        lifetime_room = np.maximum(0, NISA_LIFETIME_LIMIT - nisa_principal)
+        val_nisa_add = np.where(can_invest, np.minimum(S["nisa_cap"][:, col], lifetime_room), 0.0)
+        nisa_tsumitate_year = val_nisa_add
+        val_paypay_add = np.where(can_invest, S["paypay_add"][:, col], 0.0)
+
+        get_401k = S["get_401k"][:, col]
+        unlocked = (S["nisa_unlocked"][:, col], S["other_unlocked"][:, col])
+
+        if monthly:
+            fc = (income - (monthly_out + val_nisa_add + val_paypay_add)) / 12
+            cash, k401, nisa, paypay, nisa_principal, short_months, tax = _step_months_vec(
+                P, unlocked, (cash, k401, nisa, paypay, nisa_principal),
+                (fc, S["lump"][:, col], val_nisa_add / 12, val_paypay_add / 12, val_k401_add / 12, get_401k, k401_grows),
+                (g_cash, g_nisa, g_paypay, g_401k), lots)
+        else:
+            k401 = k401 + val_k401_add
+            if lots is not None:
+                lots.buy(lots.nisa, val_nisa_add, nisa)
+                lots.buy(lots.other, val_paypay_add, paypay)
+            nisa = nisa + val_nisa_add
+            nisa_principal = nisa_principal + val_nisa_add if lots is None else lots.nisa.basis
+            paypay = paypay + val_paypay_add
+
+            tax = np.where(get_401k, k401 * P["tax_401k"], 0.0)
+            cash = np.where(get_401k, cash + k401 * keep_401k, cash)
+            k401 = np.where(get_401k, 0.0, k401)
+
+            cash = cash + (inflow - (outflow + val_nisa_add + val_paypay_add))
+
+            short = cash < 0
+            if short.any():
+                shortage = np.where(short, -cash, 0.0)
+                current_total_investments = nisa + paypay + k401
+                limit_nisa_yen = calc_actual_limit_vec(P["limit_mode_nisa"], P["nisa_limit_yen_calc"], nisa, current_total_investments)
+                limit_other_yen = calc_actual_limit_vec(P["limit_mode_other"], P["other_limit_yen_calc"], paypay, current_total_investments)
+                needed = shortage
+                nisa, paypay, nisa_principal, shortage, (used_nisa, used_other) = (_withdraw_vec if lots is None else lots.withdraw)(
+                    P, unlocked, short, shortage, nisa, paypay, nisa_principal, limit_nisa_yen, limit_other_yen)
+                tax = np.where(short, tax + used_nisa + used_other - (needed - shortage), tax)
+                cash = np.where(short, -shortage, cash)
+
+        sweep_above = S["sweep_above"][:, col]
+        sweep = cash > sweep_above
+        lifetime_room = np.maximum(0, NISA_LIFETIME_LIMIT - nisa_principal) if lots is None else lots.sweep_room()
+        move = np.where(sweep, np.minimum(np.minimum(cash - sweep_above, NISA_GROWTH_LIMIT), lifetime_room), 0.0)
+        cash = np.where(sweep, cash - move, cash)
+        if lots is not None:
+            lots.buy(lots.nisa, move, nisa)
+        nisa = np.where(sweep, nisa + move, nisa)
+        nisa_principal = np.where(sweep, nisa_principal + move, nisa_principal) if lots is None else lots.nisa.basis
+
+        # 範囲外 (開始前・終了後) のシナリオは状態を据え置く
+        cash, k401, nisa, paypay, nisa_principal = (
+            np.where(active, new, old) for new, old in zip((cash, k401, nisa, paypay, nisa_principal), prev)
+        )
+        record(col, np.where(active, nisa_tsumitate_year, 0.0), np.where(active, move, 0.0),
+               np.where(active, short_months, 0) if monthly else zeros, np.where(active, tax, 0.0))
+
+    return BatchResult(ages, out, cur, end, checkpoints)
@@ -0,0 +1,294 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+from engine import DEFAULT_CONFIG, simulate
+
+# ==========================================
+# ベンチマーク
+# 計算エンジンと画面の再実行にかかる時間を測り、基準値 (ベースライン) と比べる
+#
+#   python benchmark.py --save        # 今の結果を基準値として保存
+#   python benchmark.py               # 基準値と比べ、しきい値 (既定 20%) 以上遅くなったケースがあれば終了コード 1
+#   python benchmark.py -k scalar     # 名前に scalar を含むケースだけ
+#
+# 時間はマシンによって変わるので、基準値は比べたいマシンの上で保存し直すこと。
+# ==========================================
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+DEFAULT_THRESHOLD = 20.0
+
+# 毎年「現金不足 → 新NISA・他運用の取り崩し」が起きる設定 (NISA・他運用の両方から毎年取り崩す)
+WITHDRAW_HEAVY_CONFIG = dict(
+    DEFAULT_CONFIG,
+    current_age=40, end_age=120, age_work_last=40, age_pension=75,
+    ini_cash=0, ini_nisa=6000, ini_paypay=6000,
+    nisa_monthly=0, paypay_monthly=0, k401_monthly=0,
+    nisa_start_age=41, paypay_start_age=41, limit_val_other_yen=0,
+    cost_40s=25, cost_50s=25, cost_6064=25, cost_65=25,
+)
+
+# 年金で生活費をまかなえ、取り崩しのない長い期間がある設定 (区切り飛ばしエンジンが効く形)
+LONG_SPAN_CONFIG = dict(DEFAULT_CONFIG, current_age=20, end_age=120, inflation=0, pension_monthly=400000)
+
+def varied_configs(n):
+    # バッチ用: 年齢・積立額・生活費・計算の刻みを少しずつずらした設定 (毎回同じ並び)
+    return [dict(DEFAULT_CONFIG,
+                 current_age=25 + i % 35,
+                 nisa_monthly=(i * 7919) % 100 * 1000,
+                 cost_65=15 + (i * 31) % 25,
+                 step_mode="月次" if i % 4 == 0 else "年次") for i in range(n)]
+
+# --- ケース ---
+# 各ケースは「準備をして、測る対象の関数を返す」関数。戻り値の関数1回の実行時間を測る
+
+def case_scalar_default():
+    return lambda: simulate(DEFAULT_CONFIG)
+
+def case_scalar_monthly():
+    config = dict(DEFAULT_CONFIG, step_mode="月次")
+    return lambda: simulate(config)
+
+def case_scalar_end120():
+    config = dict(DEFAULT_CONFIG, end_age=120)
+    return lambda: simulate(config)
+
+def case_scalar_end120_monthly():
+    config = dict(DEFAULT_CONFIG, end_age=120, step_mode="月次")
+    return lambda: simulate(config)
+
+def case_withdraw_heavy():
+    return lambda: simulate(WITHDRAW_HEAVY_CONFIG)
+
+def case_jump_long():
+    from jump_engine import project_final
+    return lambda: project_final(LONG_SPAN_CONFIG)
+
+def case_jump_long_monthly():
+    from jump_engine import project_final
+    config = dict(LONG_SPAN_CONFIG, step_mode="月次")
+    return lambda: project_final(config)
+
+def case_scalar_long():
+    # jump_long と比べる用
+    return lambda: simulate(LONG_SPAN_CONFIG)
+
+def case_batch_1000():
+    from batch_engine import simulate_batch
+    configs = varied_configs(1000)
+    return lambda: simulate_batch(configs)
+
+def case_sweep_20x20():
+    from sweep import SWEEP_PARAMS, axis_values, get_pool, run_sweep
+    axes = [(key, axis_values(key, SWEEP_PARAMS[key][1], SWEEP_PARAMS[key][2], 20)) for key in ("nisa_monthly", "cost_65")]
+    pool = get_pool()
+    # プロセスの起動は測らない
+    run_sweep(DEFAULT_CONFIG, axes, pool=pool)
+    return lambda: run_sweep(DEFAULT_CONFIG, axes, pool=pool)
+
+def case_montecarlo_streaming():
+    # 全パスを持たずに分割して計算する (メモリの上限 64MB)
+    from montecarlo import run_montecarlo_streaming
+    return lambda: run_montecarlo_streaming(DEFAULT_CONFIG, 100000, seed=0, memory_limit=64 * 1024 * 1024)
+
+def case_sensitivity():
+    from sensitivity import run_sensitivity
+    return lambda: run_sensitivity(DEFAULT_CONFIG)
+
+def case_optimize():
+    # 取り崩しルールの最適化 (年次・70年弱の計画)
+    from optimizer import optimize
+    return lambda: optimize(DEFAULT_CONFIG)
+
+def _app_test():
+    from streamlit.logger import set_log_level
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    at.run()
+    if at.exception:
+        raise RuntimeError(f"app.py の実行に失敗しました: {at.exception}")
+    # 非推奨の警告などが測定のたびに出ないよう、streamlit のログはエラーだけにする
+    # (ロガーは初回の実行中に作られるので、その後で下げる)
+    set_log_level("error")
+    return at
+
+def case_app_rerun():
+    # 画面の再実行1回 (入力は変えない。計算結果はキャッシュ済み)
+    at = _app_test()
+    return lambda: at.run()
+
+def case_app_rerun_uncached():
+    # 入力を変えて再計算が必要になる再実行 (毎回違う値にしてキャッシュを外す)
+    at = _app_test()
+    values = iter(range(10**9))
+
+    def rerun():
+        at.number_input(key="nisa_monthly").set_value(10000 + next(values) % 40000)
+        at.run()
+    return rerun
+
+def cold_start():
+    # 新しいプロセスの中で呼ぶ: streamlit の読み込みから、最初の画面の実行が終わるまで (秒)
+    # first_render は入力欄 (サイドバー) を出し終えるまで。app.py の計測フック (?perf=1) の記録から求める
+    start = time.time()
+    from streamlit.testing.v1 import AppTest
+    imported = time.time()
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    at.query_params["perf"] = "1"
+    at.run()
+    done = time.time()
+    if at.exception:
+        raise RuntimeError(f"app.py の実行に失敗しました: {at.exception}")
+    record = at.session_state["perf_history"][0]
+    phases = record["phases_ms"]
+    sidebar_done = record["ts"] + (phases.get("widgets", 0) + phases.get("solver", 0)) / 1000
+    return {
+        "import_streamlit": imported - start,
+        "script_start": record["ts"] - start,
+        "first_render": sidebar_done - start,
+        "first_run": done - start,
+    }
+
+def _run_cold_start():
+    import subprocess
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--cold-start-child"],
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def case_app_cold_start():
+    # プロセスの起動から最初の画面の実行が終わるまで (毎回新しいプロセス)
+    return _run_cold_start
+
+# (名前, 準備関数, 測定回数)
+CASES = [
+    ("scalar_default", case_scalar_default, 200),
+    ("scalar_monthly", case_scalar_monthly, 100),
+    ("scalar_end120", case_scalar_end120, 200),
+    ("scalar_end120_monthly", case_scalar_end120_monthly, 100),
+    ("withdraw_heavy", case_withdraw_heavy, 200),
+    ("scalar_long", case_scalar_long, 200),
+    ("jump_long", case_jump_long, 200),
+    ("jump_long_monthly", case_jump_long_monthly, 100),
+    ("batch_1000", case_batch_1000, 10),
+    ("sweep_20x20", case_sweep_20x20, 5),
+    ("montecarlo_streaming", case_montecarlo_streaming, 3),
+    ("sensitivity", case_sensitivity, 20),
+    ("optimize", case_optimize, 5),
+    ("app_rerun", case_app_rerun, 10),
+    ("app_rerun_uncached", case_app_rerun_uncached, 10),
+    ("app_cold_start", case_app_cold_start, 3),
+]
+
+# --- 測定 ---
+
+def measure(fn, repeat, warmup=2):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    # 外れ値 (GC や他プロセス) に引っ張られないよう、中央値で比べる
+    return {"median": statistics.median(times), "min": min(times), "repeat": repeat}
+
+def run_cases(pattern=None, progress=None):
+    results = {}
+    for name, setup, repeat in CASES:
+        if pattern and pattern not in name:
+            continue
+        try:
+            fn = setup()
+        except ImportError as e:
+            # streamlit が入っていない環境などでは、そのケースだけ飛ばす
+            if progress is not None:
+                progress(f"{name:<24} スキップ ({e})")
+            continue
+        results[name] = measure(fn, repeat)
+        if progress is not None:
+            progress(f"{name:<24} {results[name]['median'] * 1000:10.3f} ms (最小 {results[name]['min'] * 1000:.3f} ms)")
+    return results
+
+def compare(results, baseline, threshold):
+    # 戻り値: [(名前, 基準値, 今回, 変化率 %)] のうち、しきい値を超えて遅くなったもの
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        change = (r["median"] / base["median"] - 1) * 100
+        if change > threshold:
+            regressions.append((name, base["median"], r["median"], change))
+    return regressions
+
+def load_baseline(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["cases"]
+
+def save_baseline(path, results):
+    # 一部のケースだけ測った場合は、残りのケースの基準値を残したまま上書きする
+    cases = load_baseline(path) if os.path.exists(path) else {}
+    cases.update(results)
+    data = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "saved_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "cases": cases,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="計算エンジンと画面の再実行の速さを測り、基準値と比べます。")
+    parser.add_argument("-k", dest="pattern", help="名前にこの文字列を含むケースだけ測る")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="基準値のファイル (既定: benchmark_baseline.json)")
+    parser.add_argument("--save", action="store_true", help="今回の結果を基準値として保存する")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"何 %% 遅くなったら失敗にするか (既定: {DEFAULT_THRESHOLD:g})")
+    parser.add_argument("--cold-start", action="store_true", help="起動直後の最初の表示までの内訳だけを測る")
+    parser.add_argument("--cold-start-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.cold_start_child:
+        print(json.dumps(cold_start()))
+        return 0
+    if args.cold_start:
+        runs = [_run_cold_start() for _ in range(5)]
+        for name in runs[0]:
+            print(f"{name:<20} {statistics.median(r[name] for r in runs) * 1000:10.1f} ms")
+        return 0
+
+    results = run_cases(args.pattern, progress=print)
+    if not results:
+        parser.error("該当するケースがありません")
+
+    if args.save:
+        save_baseline(args.baseline, results)
+        print(f"💾 基準値を保存しました → {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"基準値がありません。--save で保存してください ({args.baseline})")
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    print()
+    for name, r in results.items():
+        if name in baseline:
+            change = (r["median"] / baseline[name]["median"] - 1) * 100
+            print(f"{name:<24} {baseline[name]['median'] * 1000:10.3f} ms → {r['median'] * 1000:10.3f} ms ({change:+.1f}%)")
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"\n⚠️ {args.threshold:g}% を超えて遅くなったケース: " + ", ".join(name for name, *_ in regressions))
+        return 1
+    print(f"\n✅ {args.threshold:g}% を超えて遅くなったケースはありません")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
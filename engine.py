@@ -0,0 +1,1149 @@
+import hashlib
+import json
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+
+from perf import phase
+
+# ==========================================
+# 計算エンジン (Streamlit に依存しない純粋な計算部分)
+# ==========================================
+
+# --- デフォルト設定値 ---
+DEFAULT_CONFIG = {
+    "current_age": 33, "end_age": 100,
+    "ini_cash": 200, "ini_401k": 300, "ini_nisa": 100, "ini_paypay": 10,
+    "r_cash": 0.30, "r_401k": 5.0, "r_nisa": 5.0, "r_paypay": 6.0, "inflation": 2.0,
+    "step_mode": "年次",
+    "age_work_last": 64,
+    "inc_20s": 300, "inc_30s": 400, "inc_40s": 500, "inc_50s": 600, "inc_60s": 400,
+    "age_401k_get": 65, "tax_401k": 12.0, "age_pension": 65, "pension_monthly": 200000, "tax_pension": 15.0,
+
+    # 支出設定
+    "cost_20s": 20, "cost_30s": 25, "cost_40s": 30, "cost_50s": 30,
+    "cost_6064": 28, "cost_65": 25,
+    "exp_20s": 50, "exp_30s": 100, "exp_40s": 150, "exp_50s": 100,
+    "exp_6064": 80, "exp_65": 50,
+
+    "nisa_monthly": 50000,
+    "nisa_stop_age": 65,
+    "paypay_monthly": 300, "paypay_stop_age": 70,
+    "k401_monthly": 55000,
+    "k401_stop_age": 60,
+    "dam_1": 700, "dam_2": 700, "dam_3": 500,
+    "priority": "新NISAから先に使う",
+    "nisa_start_age": 65, "paypay_start_age": 60,
+
+    # 上限設定
+    "limit_mode_nisa": "年額定額 (万円)",
+    "limit_val_nisa_yen": 0,
+    "limit_val_nisa_pct": 4.0,
+    "limit_mode_other": "年額定額 (万円)",
+    "limit_val_other_yen": 20,
+    "limit_val_other_pct": 4.0,
+    "tax_rate_other": 0.0,
+    "cost_basis": "管理しない (売却額全体に課税)",
+
+    "inc1_a": 55, "inc1_v": 500, "inc2_a": 0, "inc2_v": 0, "inc3_a": 0, "inc3_v": 0,
+    "dec1_a": 66, "dec1_v": 1000, "dec2_a": 0, "dec2_v": 0, "dec3_a": 0, "dec3_v": 0
+}
+
+# 計算の刻み (年次: 1年ごと / 月次: 1か月ごとに複利・積立・現金不足チェック)
+STEP_MODES = ["年次", "月次"]
+
+# 取得価額の管理 (管理しない: 他運用は売却額全体に税率を掛け、NISA の元本は売却の割合で縮める)
+# 総平均法・先入先出法: 買付を年ごとのロットに記録し、他運用は売却益にだけ課税、NISA の売却で空いた生涯枠は翌年に戻る
+COST_BASIS_METHODS = ["管理しない (売却額全体に課税)", "総平均法", "先入先出法"]
+
+# 取り崩し優先順位 (不足時) と、NISA・他運用の取り崩し上限の方式
+PRIORITIES = ["新NISAから先に使う", "他運用から先に使う"]
+LIMIT_MODE_OPTIONS = ["年額定額 (万円)", "総資産比率 (%)", "残高比率 (%)"]
+
+NISA_TSUMITATE_LIMIT = 1200000
+NISA_GROWTH_LIMIT = 2400000
+NISA_LIFETIME_LIMIT = 18000000
+
+# --- 設定の正規化 ---
+
+def normalize_config(config):
+    # 足りないキーはデフォルト値で埋め、余計なキーは捨てる
+    return {key: config.get(key, default) for key, default in DEFAULT_CONFIG.items()}
+
+# 年齢のキー (整数だけ)
+AGE_KEYS = (
+    "current_age", "end_age", "age_work_last", "age_401k_get", "age_pension",
+    "nisa_stop_age", "paypay_stop_age", "k401_stop_age", "nisa_start_age", "paypay_start_age",
+    "inc1_a", "inc2_a", "inc3_a", "dec1_a", "dec2_a", "dec3_a",
+)
+
+# 数値の項目の範囲 (画面の入力欄と同じ)
+CONFIG_RANGES = {
+    "current_age": (20, 80), "end_age": (80, 120),
+    **dict.fromkeys(("ini_cash", "ini_401k", "ini_nisa", "ini_paypay"), (0, 10000)),
+    "r_cash": (0.0, 10.0), "r_401k": (0.0, 30.0), "r_nisa": (0.0, 30.0), "r_paypay": (0.0, 50.0),
+    "inflation": (-5.0, 20.0),
+    "age_work_last": (50, 90),
+    **dict.fromkeys(("inc_20s", "inc_30s", "inc_40s", "inc_50s", "inc_60s"), (0, 5000)),
+    "age_401k_get": (50, 80), "tax_401k": (0.0, 50.0),
+    "age_pension": (60, 75), "pension_monthly": (0, 500000), "tax_pension": (0.0, 50.0),
+    **dict.fromkeys(("cost_20s", "cost_30s", "cost_40s", "cost_50s", "cost_6064", "cost_65"), (0, 500)),
+    **dict.fromkeys(("exp_20s", "exp_30s", "exp_40s", "exp_50s", "exp_6064", "exp_65"), (0, 5000)),
+    "nisa_monthly": (0, 500000), "nisa_stop_age": (20, 100),
+    "paypay_monthly": (0, 1000000), "paypay_stop_age": (20, 100),
+    "k401_monthly": (0, 500000), "k401_stop_age": (20, 70),
+    **dict.fromkeys(("dam_1", "dam_2", "dam_3"), (0, 10000)),
+    "nisa_start_age": (50, 100), "paypay_start_age": (50, 100),
+    "limit_val_nisa_yen": (0, 10000), "limit_val_nisa_pct": (0.0, 100.0),
+    "limit_val_other_yen": (0, 10000), "limit_val_other_pct": (0.0, 100.0),
+    "tax_rate_other": (0.0, 50.0),
+    **dict.fromkeys(("inc1_a", "inc2_a", "inc3_a", "dec1_a", "dec2_a", "dec3_a"), (0, 100)),
+    **dict.fromkeys(("inc1_v", "inc2_v", "inc3_v", "dec1_v", "dec2_v", "dec3_v"), (0, 10000)),
+}
+
+# 選択肢の項目と、その選択肢 (画面の入力欄と同じ)
+CONFIG_OPTIONS = {
+    "step_mode": STEP_MODES, "priority": PRIORITIES, "cost_basis": COST_BASIS_METHODS,
+    "limit_mode_nisa": LIMIT_MODE_OPTIONS, "limit_mode_other": LIMIT_MODE_OPTIONS,
+}
+
+def validate_config(data):
+    # ファイルや外部から受け取った設定を normalize_config し、計算できない値があれば ValueError
+    # (数値の項目に数値以外・入力欄の範囲外・整数でない年齢・選択肢にない値・current_age > end_age)
+    if not isinstance(data, dict):
+        raise ValueError("設定は JSON オブジェクトである必要があります")
+    config = normalize_config(data)
+    for key, default in DEFAULT_CONFIG.items():
+        value = config[key]
+        if key in CONFIG_OPTIONS:
+            # 文字列以外 (dict・list など) はハッシュできないこともあるので、先に型を見る
+            if not isinstance(value, str) or value not in CONFIG_OPTIONS[key]:
+                raise ValueError(f"{key} は {' / '.join(CONFIG_OPTIONS[key])} のどれかを指定してください ({value!r})")
+            continue
+        if isinstance(default, (int, float)) and (isinstance(value, bool) or not isinstance(value, (int, float))):
+            raise ValueError(f"{key} が数値ではありません")
+        if key in AGE_KEYS:
+            if isinstance(value, float) and not value.is_integer():
+                raise ValueError(f"{key} は整数で指定してください ({value})")
+            value = config[key] = int(value)
+        lo, hi = CONFIG_RANGES.get(key, (None, None))
+        if lo is not None and not lo <= value <= hi:
+            raise ValueError(f"{key} は {lo}〜{hi} の範囲で指定してください ({value})")
+    if config["current_age"] > config["end_age"]:
+        raise ValueError("current_age は end_age 以下にしてください")
+    return config
+
+def config_hash(config):
+    canonical = json.dumps(normalize_config(config), sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+# 万円 → 円 に変換するキー
+YEN_KEYS = (
+    "ini_cash", "ini_401k", "ini_nisa", "ini_paypay",
+    "inc_20s", "inc_30s", "inc_40s", "inc_50s", "inc_60s",
+    "cost_20s", "cost_30s", "cost_40s", "cost_50s", "cost_6064", "cost_65",
+    "exp_20s", "exp_30s", "exp_40s", "exp_50s", "exp_6064", "exp_65",
+    "dam_1", "dam_2", "dam_3",
+    "inc1_v", "inc2_v", "inc3_v", "dec1_v", "dec2_v", "dec3_v",
+)
+# % → 比率 に変換するキー
+RATE_KEYS = (
+    "r_cash", "r_401k", "r_nisa", "r_paypay", "inflation",
+    "tax_401k", "tax_pension", "tax_rate_other",
+)
+
+def prepare_params(config):
+    # 画面の入力単位 (万円・%) を計算用の単位 (円・比率) に変換する
+    c = normalize_config(config)
+    p = dict(c)
+    for key in YEN_KEYS:
+        p[key] = c[key] * 10000
+    for key in RATE_KEYS:
+        p[key] = c[key] / 100
+    if c["limit_mode_nisa"] == "年額定額 (万円)":
+        p["nisa_limit_yen_calc"] = c["limit_val_nisa_yen"] * 10000
+    else:
+        p["nisa_limit_yen_calc"] = c["limit_val_nisa_pct"]
+    if c["limit_mode_other"] == "年額定額 (万円)":
+        p["other_limit_yen_calc"] = c["limit_val_other_yen"] * 10000
+    else:
+        p["other_limit_yen_calc"] = c["limit_val_other_pct"]
+    return p
+
+# --- 取り崩しルール ---
+
+def calc_actual_limit(mode, val, current_asset, total_assets):
+    if mode == "年額定額 (万円)":
+        if val == 0: return float('inf')
+        return val
+    elif mode == "総資産比率 (%)":
+        return total_assets * (val / 100)
+    elif mode == "残高比率 (%)":
+        return current_asset * (val / 100)
+    return float('inf')
+
+def withdraw_asset_logic(needed, current_val, principal_val, is_nisa, limit_yen, tax_rate=0.0):
+    gross_needed = needed / (1 - tax_rate) if (1 - tax_rate) > 0 else needed
+    can_withdraw_gross = min(gross_needed, current_val, limit_yen)
+    net_cash_obtained = can_withdraw_gross * (1 - tax_rate)
+    new_val = current_val - can_withdraw_gross
+    new_principal = principal_val
+    if is_nisa and current_val > 0 and can_withdraw_gross > 0:
+        ratio = can_withdraw_gross / current_val
+        new_principal = principal_val * (1 - ratio)
+    return net_cash_obtained, new_val, new_principal
+
+# --- 計算結果 ---
+
+COLUMNS = ["Age", "Total", "Cash", "401k", "NISA", "Other", "NISA積立枠", "NISA成長枠", "NISA元本"]
+MONTHLY_COLUMNS = COLUMNS + ["現金不足月数"]
+
+class ProjectionResult:
+    # 1回分の推移。列ごとに int64 の型付き配列を先に確保しておき、行は age - current_age で引く
+    def __init__(self, current_age, end_age, names=COLUMNS):
+        size = end_age - current_age + 1
+        self.current_age = current_age
+        self.end_age = end_age
+        self.columns = {name: array("q", bytes(8 * size)) for name in names}
+        self.columns["Age"] = array("q", range(current_age, end_age + 1))
+
+    def __len__(self):
+        return self.end_age - self.current_age + 1
+
+    @property
+    def nbytes(self):
+        return sum(col.itemsize * len(col) for col in self.columns.values())
+
+    def set_row(self, i, cash, k401, nisa, paypay, tsumitate, growth, principal):
+        # 計算ループの中では呼び出しの手間を省くため、列を直接書き込んでいる (並びはこの関数と同じ)
+        c = self.columns
+        c["Total"][i] = int(cash + k401 + nisa + paypay)
+        c["Cash"][i] = int(cash)
+        c["401k"][i] = int(k401)
+        c["NISA"][i] = int(nisa)
+        c["Other"][i] = int(paypay)
+        c["NISA積立枠"][i] = int(tsumitate)
+        c["NISA成長枠"][i] = int(growth)
+        c["NISA元本"][i] = int(principal)
+
+    def copy_rows(self, other, n):
+        # other の先頭 n 年分をそのまま写す (途中から再開するとき)
+        for name, col in self.columns.items():
+            col[:n] = other.columns[name][:n]
+
+    def value(self, name, age):
+        return self.columns[name][age - self.current_age]
+
+    def row(self, age):
+        i = age - self.current_age
+        return {name: col[i] for name, col in self.columns.items()}
+
+    def view(self, name):
+        # コピーせずに numpy 配列として見る (書き換えないこと)
+        # 計算だけなら numpy は要らないので、画面の起動を遅らせないようここで読み込む
+        import numpy as np
+        return np.frombuffer(self.columns[name], dtype=np.int64)
+
+    def views(self):
+        return {name: self.view(name) for name in self.columns}
+
+    def records(self):
+        # 年ごとの dict のリスト (以前の形式)
+        return [self.row(age) for age in range(self.current_age, self.end_age + 1)]
+
+    def to_frame(self):
+        # 表を表示するときだけ作るので、pandas はここで読み込む
+        import pandas as pd
+        return pd.DataFrame(self.views())
+
+    def to_bytes(self):
+        # 保存用: 1行目に年齢の範囲と列名 (JSON)、その後ろに各列の中身をそのまま並べて zlib で圧縮する
+        header = json.dumps([self.current_age, self.end_age, list(self.columns)], ensure_ascii=False)
+        return zlib.compress(header.encode("utf-8") + b"\n" + b"".join(col.tobytes() for col in self.columns.values()))
+
+    @classmethod
+    def from_bytes(cls, data):
+        header, body = zlib.decompress(data).split(b"\n", 1)
+        current_age, end_age, names = json.loads(header)
+        result = cls(current_age, end_age, names)
+        size = 8 * len(result)
+        for j, name in enumerate(names):
+            result.columns[name] = array("q", body[j * size:(j + 1) * size])
+        return result
+
+# --- 年齢ごとの表 (スケジュール) ---
+# 状態 (残高) に依存しない年ごとの値は、計算ループに入る前に年齢ごとの表にしておく。
+# 年齢区分の分岐・物価の累乗・臨時収支の年齢比較・取り崩しルールの文字列比較はここで1回だけ行い、
+# ループの中は表を引いて足し引きするだけにする (足し算の順番は元の式のままなので、結果は1円も変わらない)。
+
+def _limit_rule(mode, val):
+    # 取り崩し上限のモードを、(その資産の残高, 投資資産の合計) → 上限額 の関数にする
+    if mode == "年額定額 (万円)":
+        limit = float('inf') if val == 0 else val
+        return lambda current_asset, total_assets: limit
+    rate = val / 100
+    if mode == "総資産比率 (%)":
+        return lambda current_asset, total_assets: total_assets * rate
+    if mode == "残高比率 (%)":
+        return lambda current_asset, total_assets: current_asset * rate
+    return lambda current_asset, total_assets: float('inf')
+
+def _withdraw_rules(p):
+    # 取り崩しの順番を関数にする。解禁状況 (NISA, 他運用) ごとに1つずつ
+    # 各関数: (不足額, nisa, paypay, nisa_principal, NISA の上限, 他運用の上限) → (残りの不足額, nisa, paypay, nisa_principal)
+    # 中身は withdraw_asset_logic を資産ごとに書き下したもの (NISA は非課税なので税の割り戻しを省く。値は同じになる)
+    keep = 1 - p["tax_rate_other"]
+
+    def take_none(shortage, nisa, paypay, nisa_principal, limit_nisa, limit_other):
+        return shortage, nisa, paypay, nisa_principal
+
+    def take_nisa(shortage, nisa, paypay, nisa_principal, limit_nisa, limit_other):
+        w = min(shortage, nisa, limit_nisa)
+        if nisa > 0 and w > 0:
+            nisa_principal *= 1 - w / nisa
+        return shortage - w, nisa - w, paypay, nisa_principal
+
+    def take_other(shortage, nisa, paypay, nisa_principal, limit_nisa, limit_other):
+        w = min(shortage / keep if keep > 0 else shortage, paypay, limit_other)
+        return shortage - w * keep, nisa, paypay - w, nisa_principal
+
+    def take_nisa_then_other(shortage, nisa, paypay, nisa_principal, limit_nisa, limit_other):
+        w = min(shortage, nisa, limit_nisa)
+        if nisa > 0 and w > 0:
+            nisa_principal *= 1 - w / nisa
+        shortage -= w
+        nisa -= w
+        w = min(shortage / keep if keep > 0 else shortage, paypay, limit_other)
+        return shortage - w * keep, nisa, paypay - w, nisa_principal
+
+    def take_other_then_nisa(shortage, nisa, paypay, nisa_principal, limit_nisa, limit_other):
+        w = min(shortage / keep if keep > 0 else shortage, paypay, limit_other)
+        shortage -= w * keep
+        paypay -= w
+        w = min(shortage, nisa, limit_nisa)
+        if nisa > 0 and w > 0:
+            nisa_principal *= 1 - w / nisa
+        return shortage - w, nisa - w, paypay, nisa_principal
+
+    take_both = take_nisa_then_other if p["priority"] == "新NISAから先に使う" else take_other_then_nisa
+    return {(False, False): take_none, (True, False): take_nisa, (False, True): take_other, (True, True): take_both}
+
+def _by_age(current_age, n, edges, values):
+    # 年齢の区切り edges (昇順) で値が切り替わる表。age < edges[0] → values[0]、edges[0] <= age < edges[1] → values[1] ...
+    out = []
+    lo = 0
+    for edge, value in zip(edges, values):
+        hi = min(max(edge - current_age, lo), n)
+        out += [value] * (hi - lo)
+        lo = hi
+    out += [values[len(edges)]] * (n - lo)
+    return out
+
+_EVENT_KEYS = (("inc1_a", "inc1_v", "dec1_a", "dec1_v"),
+               ("inc2_a", "inc2_v", "dec2_a", "dec2_v"),
+               ("inc3_a", "inc3_v", "dec3_a", "dec3_v"))
+
+_BRACKET_EDGES = (30, 40, 50, 60, 65)
+
+class Schedule:
+    # 1つの設定を年齢ごとの表にしたもの。各リストは i = age - current_age で引く (i = 0 は初年度の状態なので使わない)
+    # 値が変わるのは年齢区分・退職・年金開始などの区切りだけなので、区切りの間を同じ値で埋めて作る
+    def __init__(self, p):
+        current_age, end_age = p["current_age"], p["end_age"]
+        n = end_age - current_age + 1
+        ages = range(current_age, end_age + 1)
+        age_work_last, age_401k_get = p["age_work_last"], p["age_401k_get"]
+
+        def until(age):
+            # 「age 歳まで」の年数 (表の範囲に収める)
+            return min(max(age + 1 - current_age, 0), n)
+
+        def flag(age):
+            # age 歳まで True、その後 False
+            w = until(age)
+            return [True] * w + [False] * (n - w)
+
+        n_work = until(age_work_last)
+        self.working = flag(age_work_last)
+        salary = _by_age(current_age, n_work, _BRACKET_EDGES,
+                         [p[k] for k in ("inc_20s", "inc_30s", "inc_40s", "inc_50s", "inc_60s", "inc_60s")]) + [0] * (n - n_work)
+        extra = _by_age(current_age, n, _BRACKET_EDGES,
+                        [p[k] for k in ("exp_20s", "exp_30s", "exp_40s", "exp_50s", "exp_6064", "exp_65")])
+        base_cost = _by_age(current_age, n, _BRACKET_EDGES,
+                            [p[k] for k in ("cost_20s", "cost_30s", "cost_40s", "cost_50s", "cost_6064", "cost_65")])
+        # 生活費は退職の翌年から物価上昇を乗せる
+        g_infl = 1 + p["inflation"]
+        cost = [c * 12 for c in base_cost[:n_work]] + [
+            c * 12 * (g_infl ** (age - age_work_last)) for c, age in zip(base_cost[n_work:], ages[n_work:])]
+        n_before_pension = until(p["age_pension"] - 1)
+        pension = [0] * n_before_pension + [p["pension_monthly"] * 12 * (1 - p["tax_pension"])] * (n - n_before_pension)
+        k401_year = p["k401_monthly"] * 12
+        n_k401 = min(n_work, until(age_401k_get - 1), until(p["k401_stop_age"]))
+        self.k401_add = [k401_year] * n_k401 + [0] * (n - n_k401)
+        self.k401_grows = flag(age_401k_get - 1)
+        self.k401_lump = [False] * n
+        if current_age <= age_401k_get <= end_age:
+            self.k401_lump[age_401k_get - current_age] = True
+        self.keep_401k = 1 - p["tax_401k"]
+
+        # 年次: 収入 (給与 + 年金 + 臨時収入) と、支出のうち残高に依存しない分 (生活費 + 特別支出 + 臨時支出 + 401k 拠出)
+        # 足す順番は元の式と同じ (臨時収支のない年は 0 を足すのと同じなので省く)。積立 (NISA・他運用) は現金の有無で決まるのでループの中で足す
+        self.income = [a + b for a, b in zip(salary, pension)]
+        self.monthly_out = [a + b + c for a, b, c in zip(cost, extra, self.k401_add)]
+        self.inflow = list(self.income)
+        self.outflow = list(self.monthly_out)
+        # 臨時収支: 年齢 → その年の合計額 (収入・支出別)。月次は年齢ごとの差額にまとめて年初に計上する
+        event_inc, event_dec, lumps = {}, {}, {}
+        for inc_a, inc_v, dec_a, dec_v in _EVENT_KEYS:
+            event_inc[p[inc_a]] = event_inc.get(p[inc_a], 0) + p[inc_v]
+            event_dec[p[dec_a]] = event_dec.get(p[dec_a], 0) + p[dec_v]
+            lumps[p[inc_a]] = lumps.get(p[inc_a], 0) + p[inc_v]
+            lumps[p[dec_a]] = lumps.get(p[dec_a], 0) - p[dec_v]
+        self.lump = [0] * n
+        for age, value in event_inc.items():
+            if current_age <= age <= end_age:
+                i = age - current_age
+                self.inflow[i] = self.income[i] + value
+        for age, value in event_dec.items():
+            if current_age <= age <= end_age:
+                i = age - current_age
+                self.outflow[i] = cost[i] + extra[i] + value + self.k401_add[i]
+        for age, value in lumps.items():
+            if current_age <= age <= end_age:
+                self.lump[age - current_age] = value
+
+        n_nisa = until(p["nisa_stop_age"])
+        self.nisa_cap = [min(p["nisa_monthly"] * 12, NISA_TSUMITATE_LIMIT)] * n_nisa + [0] * (n - n_nisa)
+        n_paypay = until(p["paypay_stop_age"])
+        self.paypay_add = [p["paypay_monthly"] * 12] * n_paypay + [0] * (n - n_paypay)
+        # 現金がこの額を超えたら超過分を成長枠へ (積立期間外は inf にして移さない)
+        self.sweep_above = _by_age(current_age, n_nisa, (50, 60), (p["dam_1"], p["dam_2"], p["dam_3"])) + [float('inf')] * (n - n_nisa)
+
+        # 取り崩し: 解禁状況ごとの関数と、月次の一括計算で最初に取り崩す資産 ("nisa" / "other" / None)
+        rules = _withdraw_rules(p)
+        nisa_start, paypay_start = p["nisa_start_age"], p["paypay_start_age"]
+        # 解禁状況は (どちらも未解禁) → (早い方だけ解禁) → (両方解禁) と2回だけ変わる
+        unlocked = [(False, False), (True, False) if nisa_start <= paypay_start else (False, True), (True, True)]
+        edges = sorted((nisa_start, paypay_start))
+        self.unlocked = _by_age(current_age, n, edges, unlocked)
+        self.withdraw = _by_age(current_age, n, edges, [rules[u] for u in unlocked])
+        self.withdraw_first = _by_age(current_age, n, edges, [_first_source(p["priority"], *u) for u in unlocked])
+        self.limit_nisa = _limit_rule(p["limit_mode_nisa"], p["nisa_limit_yen_calc"])
+        self.limit_other = _limit_rule(p["limit_mode_other"], p["other_limit_yen_calc"])
+
+def _first_source(priority, open_nisa, open_other):
+    if priority == "新NISAから先に使う":
+        return "nisa" if open_nisa else ("other" if open_other else None)
+    return "other" if open_other else ("nisa" if open_nisa else None)
+
+def compile_schedule(config):
+    return Schedule(prepare_params(config))
+
+# --- シミュレーション本体 ---
+
+def simulate(config):
+    return simulate_with_states(config)[0]
+
+def simulate_with_states(config, resume=None):
+    # 戻り値: (ProjectionResult, states)。states[i] は i 行目の年末時点の状態 (丸める前の値)
+    # resume: (再開する年齢, 前回の ProjectionResult, それより前の states)
+    with phase("engine.prepare"):
+        p = prepare_params(config)
+        s = Schedule(p)
+    with phase("engine.loop"):
+        if uses_lots(p):
+            # ロットは states に入らないので、途中からの再開はしない
+            return _simulate_lots(p, s)
+        if p["step_mode"] == "月次":
+            return _simulate_monthly(p, s, resume)
+        return _simulate_annual(p, s, resume)
+
+def _resume_point(p, resume, names):
+    result = ProjectionResult(p["current_age"], p["end_age"], names)
+    if resume is not None:
+        first_age, previous, states = resume
+        result.copy_rows(previous, first_age - p["current_age"])
+        return first_age, result, list(states)
+    state = (p["ini_cash"], p["ini_401k"], p["ini_nisa"], p["ini_paypay"], p["ini_nisa"])
+    result.set_row(0, *state[:4], 0, 0, state[4])
+    return p["current_age"] + 1, result, [state]
+
+def _simulate_annual(p, s, resume=None):
+    first_age, result, states = _resume_point(p, resume, COLUMNS)
+    annual_rows(p, s, result, states, first_age - p["current_age"], len(result))
+    return result, states
+
+def annual_rows(p, s, result, states, lo, hi):
+    # lo 〜 hi - 1 行目を1年ずつ計算する。states の末尾 (lo - 1 行目の状態) から始め、各年の状態を states に足す
+    g_cash, g_401k, g_nisa, g_paypay = 1 + p["r_cash"], 1 + p["r_401k"], 1 + p["r_nisa"], 1 + p["r_paypay"]
+    working, inflow, outflow = s.working, s.inflow, s.outflow
+    k401_add, k401_grows, k401_lump, keep_401k = s.k401_add, s.k401_grows, s.k401_lump, s.keep_401k
+    nisa_cap, paypay_add, sweep_above = s.nisa_cap, s.paypay_add, s.sweep_above
+    withdraw, limit_nisa, limit_other = s.withdraw, s.limit_nisa, s.limit_other
+
+    cash, k401, nisa, paypay, nisa_principal = states[-1]
+    total_c, cash_c, k401_c, nisa_c, other_c, tsumitate_c, growth_c, principal_c = (result.columns[n] for n in COLUMNS[1:])
+
+    for i in range(lo, hi):
+        cash *= g_cash
+        nisa *= g_nisa
+        paypay *= g_paypay
+        if k401_grows[i]: k401 *= g_401k
+
+        if cash > 0 or working[i]:
+            val_nisa_add = min(nisa_cap[i], max(0, NISA_LIFETIME_LIMIT - nisa_principal))
+            val_paypay_add = paypay_add[i]
+        else:
+            val_nisa_add = val_paypay_add = 0
+
+        k401 += k401_add[i]
+        nisa += val_nisa_add
+        nisa_principal += val_nisa_add
+        paypay += val_paypay_add
+
+        if k401_lump[i]:
+            cash += k401 * keep_401k
+            k401 = 0
+
+        cash += inflow[i] - (outflow[i] + val_nisa_add + val_paypay_add)
+
+        if cash < 0:
+            total = nisa + paypay + k401
+            shortage, nisa, paypay, nisa_principal = withdraw[i](
+                abs(cash), nisa, paypay, nisa_principal, limit_nisa(nisa, total), limit_other(paypay, total))
+            cash = -shortage
+
+        nisa_growth_year = 0
+        if cash > sweep_above[i]:
+            move = min(cash - sweep_above[i], NISA_GROWTH_LIMIT, max(0, NISA_LIFETIME_LIMIT - nisa_principal))
+            cash -= move
+            nisa += move
+            nisa_principal += move
+            nisa_growth_year = move
+
+        total_c[i] = int(cash + k401 + nisa + paypay)
+        cash_c[i] = int(cash)
+        k401_c[i] = int(k401)
+        nisa_c[i] = int(nisa)
+        other_c[i] = int(paypay)
+        tsumitate_c[i] = int(val_nisa_add)
+        growth_c[i] = int(nisa_growth_year)
+        principal_c[i] = int(nisa_principal)
+        states.append((cash, k401, nisa, paypay, nisa_principal))
+
+# --- 月次モード ---
+# 年額の収支・積立は 12 等分して毎月計上し、臨時収支と 401k 一括受取は年初の月に計上する。
+# 現金が不足した月はその都度取り崩す (取り崩し上限は年額で、その年最初の不足月に決まる)。
+# ダム水位の成長枠投資は年次モードと同じく年末に1回。
+#
+# 1年の中では状態が「x = x * g + a」の繰り返しなので、月ごとに回さず等比数列の和で 12 か月分を一度に進める。
+# 現金の推移は1年の中で単調なので、年初と年末を見れば不足月の有無が分かる。
+# 取り崩し上限や残高切れが年の途中で効く年だけ、月ごとに回す (_step_months)。
+
+def _monthly_schedule(r):
+    # G[m] = g^m, S[m] = 1 + g + ... + g^(m-1)  (g は月次の成長率)
+    g = (1 + r) ** (1 / 12)
+    G, S = [1.0], [0.0]
+    for _ in range(12):
+        G.append(G[-1] * g)
+        S.append(S[-1] * g + 1)
+    return G, S
+
+def _step_months(s, i, state, flows, growth):
+    # 1か月ずつ回す版 (取り崩し上限・残高切れが年の途中で効く年に使う)
+    cash, k401, nisa, paypay, nisa_principal = state
+    fc, lump, an, ap, ak = flows
+    gc, gn, gp, gk = growth
+    k401_grows, withdraw = s.k401_grows[i], s.withdraw[i]
+    limit_nisa_yen = limit_other_yen = None
+    short_months = 0
+    for m in range(12):
+        cash = cash * gc + fc
+        nisa = nisa * gn + an
+        nisa_principal += an
+        paypay = paypay * gp + ap
+        if m == 0:
+            if s.k401_lump[i]:
+                cash += k401 * s.keep_401k
+                k401 = 0
+            cash += lump
+        if k401_grows:
+            k401 = k401 * gk + ak
+
+        if cash < 0:
+            short_months += 1
+            if limit_nisa_yen is None:
+                total = nisa + paypay + k401
+                limit_nisa_yen = s.limit_nisa(nisa, total)
+                limit_other_yen = s.limit_other(paypay, total)
+            before_nisa, before_other = nisa, paypay
+            shortage, nisa, paypay, nisa_principal = withdraw(
+                abs(cash), nisa, paypay, nisa_principal, limit_nisa_yen, limit_other_yen)
+            limit_nisa_yen -= before_nisa - nisa
+            limit_other_yen -= before_other - paypay
+            cash = -shortage
+    return cash, k401, nisa, paypay, nisa_principal, short_months
+
+def monthly_tables(p):
+    # 現金・NISA・他運用・401k の (G, S)
+    return tuple(_monthly_schedule(p[key]) for key in ("r_cash", "r_nisa", "r_paypay", "r_401k"))
+
+def _simulate_monthly(p, s, resume=None):
+    first_age, result, states = _resume_point(p, resume, MONTHLY_COLUMNS)
+    monthly_rows(p, s, monthly_tables(p), result, states, first_age - p["current_age"], len(result))
+    return result, states
+
+def monthly_rows(p, s, tables, result, states, lo, hi):
+    # annual_rows の月次版
+    (Gc, Sc), (Gn, Sn), (Gp, Sp), (Gk, Sk) = tables
+    growth = (Gc[1], Gn[1], Gp[1], Gk[1])
+    working, income, monthly_out, lumps = s.working, s.income, s.monthly_out, s.lump
+    k401_add, nisa_cap, paypay_add, sweep_above = s.k401_add, s.nisa_cap, s.paypay_add, s.sweep_above
+    keep_other = 1 - p["tax_rate_other"]
+
+    cash, k401, nisa, paypay, nisa_principal = states[-1]
+    total_c, cash_c, k401_c, nisa_c, other_c, tsumitate_c, growth_c, principal_c, short_c = (
+        result.columns[n] for n in MONTHLY_COLUMNS[1:])
+
+    for i in range(lo, hi):
+        val_k401_add = k401_add[i]
+        if cash > 0 or working[i]:
+            val_nisa_add = min(nisa_cap[i], max(0, NISA_LIFETIME_LIMIT - nisa_principal))
+            val_paypay_add = paypay_add[i]
+        else:
+            val_nisa_add = val_paypay_add = 0
+
+        lump = lumps[i]
+        k401_lump = s.k401_lump[i]
+        k401_grows = s.k401_grows[i]
+        fc = (income[i] - (monthly_out[i] + val_nisa_add + val_paypay_add)) / 12
+        an, ap, ak = val_nisa_add / 12, val_paypay_add / 12, val_k401_add / 12
+
+        # 1か月目 (年初の一括計上を含む) と 12か月目の現金
+        cash1 = cash * Gc[1] + fc + lump
+        if k401_lump:
+            cash1 += k401 * s.keep_401k
+        cash12 = cash1 * Gc[11] + fc * Sc[11]
+
+        if k401_grows: k401_end = k401 * Gk[12] + ak * Sk[12]
+        elif k401_lump: k401_end = 0
+        else: k401_end = k401
+
+        done = False
+        if cash1 >= 0 and cash12 >= 0:
+            # 不足月なし
+            new_state = (cash12, k401_end, nisa * Gn[12] + an * Sn[12], paypay * Gp[12] + ap * Sp[12],
+                         nisa_principal + val_nisa_add)
+            short_months = 0
+            done = True
+        else:
+            k = 1
+            cash_k = cash1
+            while cash_k >= 0:
+                cash_k = cash1 * Gc[k] + fc * Sc[k]
+                k += 1
+            first = s.withdraw_first[i]
+            rest = 12 - k
+            nisa_k = nisa * Gn[k] + an * Sn[k]
+            paypay_k = paypay * Gp[k] + ap * Sp[k]
+
+            if first is None:
+                # 取り崩せる資産がない: 現金はマイナスのまま年末まで進む
+                new_state = (cash12, k401_end, nisa * Gn[12] + an * Sn[12], paypay * Gp[12] + ap * Sp[12],
+                             nisa_principal + val_nisa_add)
+                if cash1 >= 0 or cash12 < 0:
+                    short_months = rest + 1 if cash1 >= 0 else 12
+                else:
+                    # 年初だけマイナスで、その後プラスに戻る
+                    short_months = 1
+                    while cash1 * Gc[short_months] + fc * Sc[short_months] < 0:
+                        short_months += 1
+                done = True
+            else:
+                k401_k = k401 * Gk[k] + ak * Sk[k] if k401_grows else k401_end
+                total_k = nisa_k + paypay_k + k401_k
+                if first == "nisa":
+                    A_k, G, S, a, keep = nisa_k, Gn, Sn, an, 1.0
+                    limit = s.limit_nisa(nisa_k, total_k)
+                else:
+                    A_k, G, S, a, keep = paypay_k, Gp, Sp, ap, keep_other
+                    limit = s.limit_other(paypay_k, total_k)
+                # 不足月以降は毎月 fc の不足が続く (fc >= 0 なら不足はその月だけ)
+                w_first = -cash_k / keep if keep > 0 else float('inf')
+                w_rest = -fc / keep if (fc < 0 and keep > 0) else 0.0
+                n_rest = rest if fc < 0 else 0
+                if A_k > 0 and w_first + w_rest * n_rest <= limit and (first != "nisa" or a == 0):
+                    after_first = A_k - w_first
+                    A_end = after_first * G[rest] + (a - w_rest) * S[rest]
+                    if after_first >= 0 and A_end >= 0:
+                        cash_end = 0.0 if fc < 0 else fc * Sc[rest]
+                        if first == "nisa":
+                            # 積立なしの月が続くので、元本の比例縮小は A_end / (A_k * G[rest]) にまとまる
+                            new_state = (cash_end, k401_end, A_end, paypay * Gp[12] + ap * Sp[12],
+                                         nisa_principal * (A_end / (A_k * G[rest])))
+                        else:
+                            new_state = (cash_end, k401_end, nisa * Gn[12] + an * Sn[12], A_end,
+                                         nisa_principal + val_nisa_add)
+                        short_months = n_rest + 1
+                        done = True
+
+        if not done:
+            *new_state, short_months = _step_months(
+                s, i, (cash, k401, nisa, paypay, nisa_principal), (fc, lump, an, ap, ak), growth)
+        cash, k401, nisa, paypay, nisa_principal = new_state
+
+        nisa_growth_year = 0
+        if cash > sweep_above[i]:
+            move = min(cash - sweep_above[i], NISA_GROWTH_LIMIT, max(0, NISA_LIFETIME_LIMIT - nisa_principal))
+            cash -= move
+            nisa += move
+            nisa_principal += move
+            nisa_growth_year = move
+
+        total_c[i] = int(cash + k401 + nisa + paypay)
+        cash_c[i] = int(cash)
+        k401_c[i] = int(k401)
+        nisa_c[i] = int(nisa)
+        other_c[i] = int(paypay)
+        tsumitate_c[i] = int(val_nisa_add)
+        growth_c[i] = int(nisa_growth_year)
+        principal_c[i] = int(nisa_principal)
+        short_c[i] = short_months
+        states.append((cash, k401, nisa, paypay, nisa_principal))
+
+# --- 取得価額の管理 (ロット) ---
+# 買付は年ごとのロット (j = age - current_age、j = 0 は初期残高) に口数と取得価額を記録する。
+# 1つの口座のロットは全て同じ利回りで増えるので、時価は 口数 × 単価 (口座の残高 / 総口数) で求まり、毎年書き換えなくてよい。
+# ロットは年齢数ぶんの型付き配列に先に確保しておき、売却は古いロットから順に減らす。
+# 総平均法は取得価額の合計を売却の割合で減らすだけなので、ロットの配列は先入先出法のときだけ持つ。
+# 他運用の税は、ロットごとの売却益にだけ掛ける (損失の出ているロットは 0。同じ年の利益との通算はしない)。
+
+def uses_lots(p):
+    return p["cost_basis"] in COST_BASIS_METHODS[1:]
+
+class LotBook:
+    def __init__(self, size, value, fifo, tax_rate):
+        self.fifo = fifo
+        self.tax_rate = tax_rate
+        self.units = array("d", bytes(8 * size)) if fifo else None
+        self.cost = array("d", bytes(8 * size)) if fifo else None
+        # 先入先出法: まだ残っている最も古いロットと、買付のあった最後のロットの次
+        self.first = 0
+        self.top = 0
+        self.total_units = 0.0
+        self.basis = 0.0
+        # 初期残高は、その時点の時価を取得価額とする (含み益なし)
+        self.buy(0, value, 0.0)
+
+    def _clear(self, j):
+        if self.fifo:
+            for k in range(self.first, self.top):
+                self.units[k] = self.cost[k] = 0.0
+            self.first = j
+        self.total_units = self.basis = 0.0
+
+    def buy(self, j, amount, value):
+        # value: 買う前の口座の残高
+        if amount <= 0:
+            return
+        if value <= 0 or self.total_units <= 0:
+            # 空の口座 (売り切った後の端数を含む) は単価 1 から数え直す
+            self._clear(j)
+            price = 1.0
+        else:
+            price = value / self.total_units
+        units = amount / price
+        self.total_units += units
+        self.basis += amount
+        if self.fifo:
+            self.units[j] += units
+            self.cost[j] += amount
+            self.top = j + 1
+
+    def sell(self, w, value):
+        # 残高 value のうち w を売る。戻り値: (税引後の受取額, 売った分の取得価額)
+        # ロットを売り切った後の端数の残高は、総平均法と同じに扱う
+        if self.fifo and self.total_units > 0:
+            price = value / self.total_units
+            units, cost, rate = self.units, self.cost, self.tax_rate
+            before = sold = consumed = tax = 0.0
+            for j in range(self.first, self.top):
+                u = units[j]
+                v = u * price
+                take = min(max(w - before, 0.0), v)
+                before += v
+                if take > 0:
+                    frac = take / v
+                    c = cost[j] * frac
+                    sold += u * frac
+                    consumed += c
+                    tax += rate * max(take - c, 0.0)
+                    units[j] = u - u * frac
+                    cost[j] -= c
+                if before >= w:
+                    break
+            while self.first < self.top - 1 and units[self.first] == 0:
+                self.first += 1
+        else:
+            frac = w / value
+            sold = self.total_units * frac
+            consumed = self.basis * frac
+            tax = self.tax_rate * max(w - consumed, 0.0)
+        self.total_units -= sold
+        self.basis -= consumed
+        return w - tax, consumed
+
+    def gross_for(self, net, value):
+        # 税引後で net を受け取るのに売る額 (全部売っても足りなければ残高)
+        rate = self.tax_rate
+        if rate == 0 or value <= 0:
+            return net
+        if not self.fifo or self.total_units <= 0:
+            keep = 1 - rate * max(1 - self.basis / value, 0.0)
+            return net / keep if keep > 0 else net
+        price = value / self.total_units
+        got = gross = 0.0
+        for j in range(self.first, self.top):
+            v = self.units[j] * price
+            cap = v - rate * max(v - self.cost[j], 0.0)
+            take = min(max(net - got, 0.0), cap)
+            got += cap
+            if take > 0:
+                gross += take / cap * v
+            if got >= net:
+                return gross
+        return value
+
+class TaxLots:
+    # 1回の計算の NISA・他運用のロットと、その年に売った NISA の取得価額 (生涯枠に戻るのは翌年)
+    def __init__(self, p, s):
+        size = p["end_age"] - p["current_age"] + 1
+        fifo = p["cost_basis"] == COST_BASIS_METHODS[2]
+        self.nisa = LotBook(size, p["ini_nisa"], fifo, 0.0)
+        self.other = LotBook(size, p["ini_paypay"], fifo, p["tax_rate_other"])
+        self.freed = 0.0
+        rules = _lot_withdraw_rules(p, self)
+        self.withdraw = [rules[u] for u in s.unlocked]
+
+def _lot_withdraw_rules(p, lots):
+    # _withdraw_rules のロット版 (引数・戻り値も同じ。戻り値の nisa_principal は NISA ロットの取得価額の合計)
+    nisa_book, other_book = lots.nisa, lots.other
+
+    def sell_nisa(shortage, nisa, limit_nisa):
+        w = min(shortage, nisa, limit_nisa)
+        if w > 0:
+            lots.freed += nisa_book.sell(w, nisa)[1]
+        return shortage - w, nisa - w
+
+    def sell_other(shortage, paypay, limit_other):
+        w = min(other_book.gross_for(shortage, paypay), paypay, limit_other)
+        if w > 0:
+            shortage -= other_book.sell(w, paypay)[0]
+            paypay -= w
+        return shortage, paypay
+
+    def take_none(shortage, nisa, paypay, nisa_principal, limit_nisa, limit_other):
+        return shortage, nisa, paypay, nisa_principal
+
+    def take_nisa(shortage, nisa, paypay, nisa_principal, limit_nisa, limit_other):
+        shortage, nisa = sell_nisa(shortage, nisa, limit_nisa)
+        return shortage, nisa, paypay, nisa_book.basis
+
+    def take_other(shortage, nisa, paypay, nisa_principal, limit_nisa, limit_other):
+        shortage, paypay = sell_other(shortage, paypay, limit_other)
+        return shortage, nisa, paypay, nisa_principal
+
+    def take_nisa_then_other(shortage, nisa, paypay, nisa_principal, limit_nisa, limit_other):
+        shortage, nisa = sell_nisa(shortage, nisa, limit_nisa)
+        shortage, paypay = sell_other(shortage, paypay, limit_other)
+        return shortage, nisa, paypay, nisa_book.basis
+
+    def take_other_then_nisa(shortage, nisa, paypay, nisa_principal, limit_nisa, limit_other):
+        shortage, paypay = sell_other(shortage, paypay, limit_other)
+        shortage, nisa = sell_nisa(shortage, nisa, limit_nisa)
+        return shortage, nisa, paypay, nisa_book.basis
+
+    take_both = take_nisa_then_other if p["priority"] == "新NISAから先に使う" else take_other_then_nisa
+    return {(False, False): take_none, (True, False): take_nisa, (False, True): take_other, (True, True): take_both}
+
+def _simulate_lots(p, s):
+    monthly = p["step_mode"] == "月次"
+    _, result, states = _resume_point(p, None, MONTHLY_COLUMNS if monthly else COLUMNS)
+    lots = TaxLots(p, s)
+    if monthly:
+        monthly_lot_rows(p, s, lots, result, states)
+    else:
+        annual_lot_rows(p, s, lots, result, states)
+    return result, states
+
+def _sweep_lots(lots, i, cash, nisa, above):
+    # 年末の成長枠投資。生涯枠は、今年売った分の取得価額をまだ戻さずに数える
+    move = min(cash - above, NISA_GROWTH_LIMIT, max(0, NISA_LIFETIME_LIMIT - (lots.nisa.basis + lots.freed)))
+    lots.nisa.buy(i, move, nisa)
+    return move
+
+def annual_lot_rows(p, s, lots, result, states):
+    # annual_rows のロット版 (1行目から最後まで)
+    g_cash, g_401k, g_nisa, g_paypay = 1 + p["r_cash"], 1 + p["r_401k"], 1 + p["r_nisa"], 1 + p["r_paypay"]
+    working, inflow, outflow = s.working, s.inflow, s.outflow
+    k401_add, k401_grows, k401_lump, keep_401k = s.k401_add, s.k401_grows, s.k401_lump, s.keep_401k
+    nisa_cap, paypay_add, sweep_above = s.nisa_cap, s.paypay_add, s.sweep_above
+    withdraw, limit_nisa, limit_other = lots.withdraw, s.limit_nisa, s.limit_other
+    nisa_book, other_book = lots.nisa, lots.other
+
+    cash, k401, nisa, paypay, nisa_principal = states[-1]
+    for i in range(1, len(result)):
+        lots.freed = 0.0
+        cash *= g_cash
+        nisa *= g_nisa
+        paypay *= g_paypay
+        if k401_grows[i]: k401 *= g_401k
+
+        if cash > 0 or working[i]:
+            val_nisa_add = min(nisa_cap[i], max(0, NISA_LIFETIME_LIMIT - nisa_book.basis))
+            val_paypay_add = paypay_add[i]
+        else:
+            val_nisa_add = val_paypay_add = 0
+
+        k401 += k401_add[i]
+        nisa_book.buy(i, val_nisa_add, nisa)
+        nisa += val_nisa_add
+        other_book.buy(i, val_paypay_add, paypay)
+        paypay += val_paypay_add
+
+        if k401_lump[i]:
+            cash += k401 * keep_401k
+            k401 = 0
+
+        cash += inflow[i] - (outflow[i] + val_nisa_add + val_paypay_add)
+
+        if cash < 0:
+            total = nisa + paypay + k401
+            shortage, nisa, paypay, _ = withdraw[i](
+                abs(cash), nisa, paypay, nisa_book.basis, limit_nisa(nisa, total), limit_other(paypay, total))
+            cash = -shortage
+
+        nisa_growth_year = 0
+        if cash > sweep_above[i]:
+            move = _sweep_lots(lots, i, cash, nisa, sweep_above[i])
+            cash -= move
+            nisa += move
+            nisa_growth_year = move
+
+        nisa_principal = nisa_book.basis
+        result.set_row(i, cash, k401, nisa, paypay, val_nisa_add, nisa_growth_year, nisa_principal)
+        states.append((cash, k401, nisa, paypay, nisa_principal))
+
+def monthly_lot_rows(p, s, lots, result, states):
+    # monthly_rows のロット版。毎月の買付・売却をロットに記録するので、12 か月を1か月ずつ回す (_step_months と同じ順番)
+    gc, gn, gp, gk = (G[1] for G, _ in monthly_tables(p))
+    working, income, monthly_out, lumps = s.working, s.income, s.monthly_out, s.lump
+    k401_add, nisa_cap, paypay_add, sweep_above = s.k401_add, s.nisa_cap, s.paypay_add, s.sweep_above
+    nisa_book, other_book = lots.nisa, lots.other
+
+    cash, k401, nisa, paypay, nisa_principal = states[-1]
+    short_c = result.columns["現金不足月数"]
+    for i in range(1, len(result)):
+        lots.freed = 0.0
+        if cash > 0 or working[i]:
+            val_nisa_add = min(nisa_cap[i], max(0, NISA_LIFETIME_LIMIT - nisa_book.basis))
+            val_paypay_add = paypay_add[i]
+        else:
+            val_nisa_add = val_paypay_add = 0
+        fc = (income[i] - (monthly_out[i] + val_nisa_add + val_paypay_add)) / 12
+        an, ap, ak = val_nisa_add / 12, val_paypay_add / 12, k401_add[i] / 12
+        k401_grows, withdraw = s.k401_grows[i], lots.withdraw[i]
+        limit_nisa_yen = limit_other_yen = None
+        short_months = 0
+        for m in range(12):
+            cash = cash * gc + fc
+            nisa *= gn
+            nisa_book.buy(i, an, nisa)
+            nisa += an
+            paypay *= gp
+            other_book.buy(i, ap, paypay)
+            paypay += ap
+            if m == 0:
+                if s.k401_lump[i]:
+                    cash += k401 * s.keep_401k
+                    k401 = 0
+                cash += lumps[i]
+            if k401_grows:
+                k401 = k401 * gk + ak
+
+            if cash < 0:
+                short_months += 1
+                if limit_nisa_yen is None:
+                    total = nisa + paypay + k401
+                    limit_nisa_yen = s.limit_nisa(nisa, total)
+                    limit_other_yen = s.limit_other(paypay, total)
+                before_nisa, before_other = nisa, paypay
+                shortage, nisa, paypay, _ = withdraw(
+                    abs(cash), nisa, paypay, nisa_book.basis, limit_nisa_yen, limit_other_yen)
+                limit_nisa_yen -= before_nisa - nisa
+                limit_other_yen -= before_other - paypay
+                cash = -shortage
+
+        nisa_growth_year = 0
+        if cash > sweep_above[i]:
+            move = _sweep_lots(lots, i, cash, nisa, sweep_above[i])
+            cash -= move
+            nisa += move
+            nisa_growth_year = move
+
+        nisa_principal = nisa_book.basis
+        result.set_row(i, cash, k401, nisa, paypay, val_nisa_add, nisa_growth_year, nisa_principal)
+        short_c[i] = short_months
+        states.append((cash, k401, nisa, paypay, nisa_principal))
+
+def depletion_age(result):
+    # 総資産が 0 以下になった最初の年齢を「資金が尽きた年齢」とする (尽きなければ None)
+    total = result.columns["Total"]
+    for i in range(1, len(total)):
+        if total[i] <= 0:
+            return result.current_age + i
+    return None
+
+# --- 途中からの再計算 ---
+# 多くの入力は「ある年齢以降」の計算にしか効かないので、前回の年齢ごとの状態を覚えておき、
+# 変更された入力が効き始める年齢の手前から計算を再開する。
+
+# 決まった年齢から効く入力
+_EFFECTIVE_FROM_AGE = {
+    **dict.fromkeys(("inc_30s", "exp_30s", "cost_30s"), 30),
+    **dict.fromkeys(("inc_40s", "exp_40s", "cost_40s"), 40),
+    **dict.fromkeys(("inc_50s", "exp_50s", "cost_50s", "dam_2"), 50),
+    **dict.fromkeys(("inc_60s", "exp_6064", "cost_6064", "dam_3"), 60),
+    **dict.fromkeys(("exp_65", "cost_65"), 65),
+}
+
+# 年齢の入力から効く入力: キー → (基準になる年齢のキー, ずらす年数)
+# 基準の年齢は変更前後の早い方を使う。「〜歳まで」の入力はその翌年から差が出る
+_EFFECTIVE_FROM_KEY = {
+    **{f"inc{i}_{x}": (f"inc{i}_a", 0) for i in (1, 2, 3) for x in "av"},
+    **{f"dec{i}_{x}": (f"dec{i}_a", 0) for i in (1, 2, 3) for x in "av"},
+    **dict.fromkeys(("age_pension", "pension_monthly", "tax_pension"), ("age_pension", 0)),
+    **dict.fromkeys(("age_401k_get", "tax_401k"), ("age_401k_get", 0)),
+    **dict.fromkeys(("nisa_start_age", "limit_mode_nisa", "limit_val_nisa_yen", "limit_val_nisa_pct"), ("nisa_start_age", 0)),
+    **dict.fromkeys(("paypay_start_age", "limit_mode_other", "limit_val_other_yen", "limit_val_other_pct",
+                     "tax_rate_other"), ("paypay_start_age", 0)),
+    **dict.fromkeys(("age_work_last", "inflation"), ("age_work_last", 1)),
+    "nisa_stop_age": ("nisa_stop_age", 1),
+    "paypay_stop_age": ("paypay_stop_age", 1),
+    "k401_stop_age": ("k401_stop_age", 1),
+    "end_age": ("end_age", 1),
+}
+
+def earliest_affected_age(old, new):
+    # old → new (どちらも normalize 済み) の変更で、結果が変わりうる最初の年齢 (変更がなければ inf)
+    if old["current_age"] != new["current_age"]:
+        return new["current_age"]
+    earliest = float('inf')
+    for key in DEFAULT_CONFIG:
+        if old[key] == new[key]:
+            continue
+        if key in _EFFECTIVE_FROM_AGE:
+            age = _EFFECTIVE_FROM_AGE[key]
+        elif key == "priority":
+            # 取り崩しの順番は、両方の資産が解禁されてから効く
+            age = max(min(old["nisa_start_age"], new["nisa_start_age"]),
+                      min(old["paypay_start_age"], new["paypay_start_age"]))
+        elif key in _EFFECTIVE_FROM_KEY:
+            ref, offset = _EFFECTIVE_FROM_KEY[key]
+            age = min(old[ref], new[ref]) + offset
+        else:
+            return new["current_age"]
+        earliest = min(earliest, age)
+    return earliest
+
+class Checkpoint:
+    # 直前の計算の設定と、年齢ごとの状態を覚えておく (セッションごとに1つ持つ想定)
+    def __init__(self):
+        self.config = None
+        self.result = None
+        self.states = None
+        self.resumed_from = None
+
+    def simulate(self, config):
+        c = normalize_config(config)
+        resume = None
+        if self.config is not None and not uses_lots(c):
+            age = earliest_affected_age(self.config, c)
+            if age > c["current_age"] + 1:
+                # 先頭 i 年分 (current_age 〜 再開する年齢の前年) はそのまま使える
+                i = min(age, c["end_age"] + 1) - c["current_age"]
+                resume = (c["current_age"] + i, self.result, self.states[:i])
+        result, states = simulate_with_states(c, resume)
+        self.config, self.result, self.states = c, result, states
+        self.resumed_from = None if resume is None else resume[0]
+        return result
+
+# --- 全セッション共有の結果キャッシュ ---
+
+class SimulationCache:
+    # 設定のハッシュをキーにした LRU キャッシュ (件数とメモリ量の両方に上限あり)
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, nbytes=None):
+        if nbytes is None:
+            nbytes = value.nbytes
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._data[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while len(self._data) > self.max_entries or self.nbytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._data.popitem(last=False)
+                self.nbytes -= evicted_bytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "nbytes": self.nbytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+RESULT_CACHE = SimulationCache()
+
+def simulate_cached(config, cache=RESULT_CACHE, checkpoint=None):
+    # キャッシュ済みの結果は全セッションで共有するため、呼び出し側で書き換えないこと
+    # checkpoint を渡すと、キャッシュにない場合に前回の計算の途中から再開する
+    key = config_hash(config)
+    result = cache.get(key)
+    if result is None:
+        result = checkpoint.simulate(config) if checkpoint is not None else simulate(config)
+        cache.put(key, result)
+    return result
@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# ==========================================
+# バックグラウンドの計算 (ジョブ)
+# 重い計算 (確率シミュレーション・スイープなど) を画面の実行スレッドから切り離し、作業スレッドのプールで動かす。
+# 計算側は途中経過を report(途中の結果, 進み具合) で知らせ、画面側はそれを定期的に読んで描き直す。
+# 入力が変わったら古いジョブは取り消す (計算側が次に report を呼んだところで JobCancelled で止まる)。
+# ==========================================
+
+# 計算の大部分は numpy (GIL を手放す) かスイープのプロセスプールなので、スレッドで足りる
+JOB_WORKERS = min(4, os.cpu_count() or 1)
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    def __init__(self, key):
+        self.key = key
+        self.progress = 0.0
+        self.partial = None
+        self.result = None
+        self.error = None
+        self.started_at = time.perf_counter()
+        self.finished_at = None
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    def cancel(self):
+        self._cancel.set()
+
+    def wait(self, timeout=None):
+        # 終わっていれば True
+        return self._done.wait(timeout)
+
+    def report(self, partial=None, progress=None):
+        # 計算側から呼ぶ。取り消されていればここで止める
+        if self._cancel.is_set():
+            raise JobCancelled()
+        if partial is not None:
+            self.partial = partial
+        if progress is not None:
+            self.progress = progress
+
+    def _run(self, fn):
+        try:
+            if self._cancel.is_set():
+                raise JobCancelled()
+            self.result = fn(self.report)
+            self.progress = 1.0
+        except JobCancelled:
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished_at = time.perf_counter()
+            self._done.set()
+
+# --- 作業スレッドのプール (全セッションで共有) ---
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+def get_executor():
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+        return _EXECUTOR
+
+class JobSlot:
+    # セッションごと・計算の種類ごとに1つ。動かしておくのは最新のジョブだけ
+    def __init__(self):
+        self.job = None
+
+    def submit(self, key, fn):
+        # fn(report) を動かす。同じキーのジョブがあればそれを返す (終わっていても、取り消されていなければ)
+        if self.job is not None and self.job.key == key and not self.job.cancelled:
+            return self.job
+        self.cancel()
+        job = Job(key)
+        get_executor().submit(job._run, fn)
+        self.job = job
+        return job
+
+    def cancel(self):
+        if self.job is not None and not self.job.done:
+            self.job.cancel()
+
+    def cancel_stale(self, key):
+        # 入力が変わって古くなった、実行中のジョブだけを取り消す (終わった結果は残す)
+        if self.job is not None and self.job.key != key:
+            self.cancel()
@@ -0,0 +1,355 @@
+import bisect
+
+from engine import (
+    COLUMNS,
+    MONTHLY_COLUMNS,
+    NISA_GROWTH_LIMIT,
+    NISA_LIFETIME_LIMIT,
+    ProjectionResult,
+    Schedule,
+    annual_rows,
+    monthly_rows,
+    monthly_tables,
+    prepare_params,
+    simulate,
+    uses_lots,
+)
+
+# ==========================================
+# 区切り飛ばしエンジン
+# 年齢区分・積立の終了・解禁・臨時収支・年金開始などの区切りの間は、年ごとのルールが変わらない。
+# その間に現金不足も NISA の枠の上限も効かなければ、各資産は「x = x * g + a」の繰り返しになるので、
+# 等比数列の和 (年金現価の式) で何年分でも一度に進められる。
+# 取り崩しや上限が効く年だけ、engine と同じ計算で1年ずつ進める。
+#
+#   simulate_jump(config)  : engine.simulate と同じ ProjectionResult (区切りの間は判定を省いて、同じ計算の順番で埋める)
+#   project_final(config)  : 区切りの間を式で飛ばし、途中の年の総資産は聞かれたときだけ求める (長い期間の最終値などに)
+#
+# 区切りの間に使える状態か (不足・上限が効かないか) は、現金の推移が単調なことを使い、
+# 区間の両端だけを式で確かめる。効く年が途中にあれば、そこまでを二分探索で求める。
+# simulate_jump は engine と同じ値になる。project_final は丸め誤差 (±1円) の範囲で一致するが、
+# 取り崩し後の現金がちょうど 0 付近になる年 (積み立てるかどうかの境目) の後は、engine とずれることがある。
+# 物価上昇の乗る退職後の年と、取り崩しの続く年は1年ずつ計算する。
+# 取得価額をロットで管理する設定は、買付のたびにロットが増えるので飛ばさず engine で計算する。
+# ==========================================
+
+# 式で進めることを試す最短の年数。これより短い区間は、判定の手間の方が大きいので1年ずつ計算する
+MIN_SPAN = 6
+
+# 「現金がプラスなら積み立てる」の判定がぶれないよう、現金が 0 に近い区間は1年ずつ計算する (円)
+_MARGIN = 1.0
+
+# --- 区切りの検出 ---
+
+# engine の年齢区分 (給与・生活費・特別支出) と、ダム水位の区切り
+_BRACKET_AGES = (30, 40, 50, 60, 65)
+_EVENT_AGE_KEYS = ("inc1_a", "inc2_a", "inc3_a", "dec1_a", "dec2_a", "dec3_a")
+
+def _run_ends(p):
+    # ends[i]: i 年目を含む「ルールが同じ年」の続く範囲の終わり (その次の行番号)
+    # 表 (Schedule) の値が変わりうる年齢を設定から集める。実際には値が変わらない年齢が混ざっても、区間が短くなるだけ
+    current_age, end_age = p["current_age"], p["end_age"]
+    ages = set(_BRACKET_AGES)
+    ages.update((p["age_work_last"] + 1, p["age_pension"], p["k401_stop_age"] + 1,
+                 p["nisa_stop_age"] + 1, p["paypay_stop_age"] + 1, p["nisa_start_age"], p["paypay_start_age"]))
+    # その年だけの値 (401k 一括受取・臨時収支) は前後で区切る
+    for age in [p["age_401k_get"]] + [p[key] for key in _EVENT_AGE_KEYS]:
+        ages.update((age, age + 1))
+    # 退職後の生活費は物価上昇で毎年変わるので、退職後は1年ずつ
+    n = end_age - current_age + 1
+    tail = min(max(p["age_work_last"] + 1 - current_age, 1), n) if p["inflation"] else n
+    ends = []
+    lo = 0
+    for hi in sorted(i for i in {age - current_age for age in ages} if 0 < i < tail) + [tail]:
+        ends += [hi] * (hi - lo)
+        lo = hi
+    ends += range(tail + 1, n + 1)
+    return ends
+
+# --- 区間の式 ---
+
+def _power(g, k):
+    # (g^k, 1 + g + ... + g^(k-1))
+    if g == 1:
+        return 1.0, k
+    gk = g ** k
+    return gk, (gk - 1) / (g - 1)
+
+def _span_rule(p, s, tables, i):
+    # i 年目のルールを、各資産の1年分の「x = x * g + a」にしたもの
+    # 戻り値: ((g_cash, g_nisa, g_paypay, g_401k), (a_cash, a_nisa, a_paypay, a_401k), 年間積立枠, 成長枠に移す水位,
+    #         積立に現金が要るか, 取り崩せる資産がないか)
+    cap, padd, kadd, grows = s.nisa_cap[i], s.paypay_add[i], s.k401_add[i], s.k401_grows[i]
+    if tables is None:
+        g = (1 + p["r_cash"], 1 + p["r_nisa"], 1 + p["r_paypay"], 1 + p["r_401k"] if grows else 1.0)
+        a = (s.inflow[i] - (s.outflow[i] + cap + padd), cap, padd, kadd)
+    else:
+        # 月次: 12 か月分をまとめた倍率と積立 (engine._monthly_schedule の G[12], S[12])
+        (Gc, Sc), (Gn, Sn), (Gp, Sp), (Gk, Sk) = tables
+        fc = (s.income[i] - (s.monthly_out[i] + cap + padd)) / 12
+        g = (Gc[12], Gn[12], Gp[12], Gk[12] if grows else 1.0)
+        a = (fc * Sc[12], cap / 12 * Sn[12], padd / 12 * Sp[12], kadd / 12 * Sk[12] if grows else 0.0)
+    # 働いていない年は、現金がプラスのときだけ積み立てる
+    needs_cash = not s.working[i] and (cap > 0 or padd > 0)
+    return g, a, cap, s.sweep_above[i], needs_cash, s.withdraw_first[i] is None
+
+def _advance(state, k, rule, pinned):
+    # state から k 年進めた状態 (式で一度に)
+    cash, k401, nisa, paypay, nisa_principal = state
+    (gc, gn, gp, gk), (ac, an, ap, ak), cap, target, _, _ = rule
+    Gn, Sn = _power(gn, k)
+    Gp, Sp = _power(gp, k)
+    Gk, Sk = _power(gk, k)
+    k401 = k401 * Gk + ak * Sk
+    paypay = paypay * Gp + ap * Sp
+    if pinned:
+        # 1年目に移す額 first と、2年目以降に毎年移す額 m
+        first = cash * gc + ac - target
+        m = target * gc + ac - target
+        nisa = nisa * Gn + (an + m) * Sn + (first - m) * gn ** (k - 1)
+        nisa_principal = nisa_principal + k * cap + first + (k - 1) * m
+        cash = target
+    else:
+        Gc, Sc = _power(gc, k)
+        cash = cash * Gc + ac * Sc
+        nisa = nisa * Gn + an * Sn
+        nisa_principal = nisa_principal + k * cap
+    return cash, k401, nisa, paypay, nisa_principal
+
+def _longest(state, k_max, rule, monthly):
+    # state から、ルールが変わらない k_max 年のうち、不足・上限が効かずに進める年数と、水位に張り付いているか
+    # 年数が 0 なら1年ずつ計算する
+    cash, _, _, _, nisa_principal = state
+    (gc, _, _, _), (ac, _, _, _), cap, target, needs_cash, locked = rule
+    if needs_cash and cash < _MARGIN:
+        return 0, False
+    year1 = cash * gc + ac
+    if year1 - target > _MARGIN:
+        # 毎年末に現金が水位を超え、超えた分を成長枠へ移す (現金は水位に張り付く)
+        # 1年目に移す額 first と、2年目以降に毎年移す額 m が成長枠に収まり、元本が生涯枠を超えない年数
+        first = year1 - target
+        m = target * gc + ac - target
+        if (monthly and cash < 0) or target < (_MARGIN if needs_cash else 0) or m <= _MARGIN \
+                or max(first, m) > NISA_GROWTH_LIMIT:
+            return 0, True
+        room = NISA_LIFETIME_LIMIT - nisa_principal - first + m
+        return max(0, min(k_max, int(room // (cap + m)))), True
+    if cap:
+        k_max = min(k_max, int((NISA_LIFETIME_LIMIT - nisa_principal) // cap))
+    # 現金の推移は単調なので、両端が 0 以上・水位以下なら途中も収まる (月次は年初の値も両端に含める)
+    # 取り崩せる資産がなければ、不足しても現金がマイナスのまま進むだけ (月次は不足月数が変わらないよう、ずっとマイナスの場合だけ)
+    start = cash if monthly else year1
+
+    def fits(last):
+        if min(start, last) < 0 and not (locked and (not monthly or max(start, last) < 0)):
+            return False
+        return max(year1, last) <= target
+
+    if k_max < 1 or not fits(year1):
+        return 0, False
+
+    def fits_k(k):
+        # k - 1 年目 (積み立てに現金が要るときは、その年の初めもプラス) と k 年目
+        G, S = _power(gc, k - 1)
+        before = cash * G + ac * S
+        return fits(before * gc + ac) and not (needs_cash and before < _MARGIN)
+
+    if fits_k(k_max):
+        return k_max, False
+    lo, hi = 1, k_max
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if fits_k(mid):
+            lo = mid
+        else:
+            hi = mid
+    return lo, False
+
+# --- 区間の行を埋める (simulate_jump) ---
+# 判定済みの区間なので、engine の1年分の計算から取り崩し・上限の判定を除いたものを繰り返す (計算の順番は engine と同じ)
+
+def _fill_annual(p, s, result, states, lo, hi, pinned):
+    cash, k401, nisa, paypay, nisa_principal = states[-1]
+    g_cash, g_nisa, g_paypay = 1 + p["r_cash"], 1 + p["r_nisa"], 1 + p["r_paypay"]
+    g_401k = 1 + p["r_401k"] if s.k401_grows[lo] else 1.0
+    cap, padd, kadd, target = s.nisa_cap[lo], s.paypay_add[lo], s.k401_add[lo], s.sweep_above[lo]
+    flow = s.inflow[lo] - (s.outflow[lo] + cap + padd)
+    total_c, cash_c, k401_c, nisa_c, other_c, tsumitate_c, growth_c, principal_c = (result.columns[n] for n in COLUMNS[1:])
+    move = 0
+    for i in range(lo, hi):
+        cash = cash * g_cash + flow
+        nisa = nisa * g_nisa + cap
+        paypay = paypay * g_paypay + padd
+        k401 = k401 * g_401k + kadd
+        nisa_principal += cap
+        if pinned:
+            move = cash - target
+            cash -= move
+            nisa += move
+            nisa_principal += move
+        total_c[i] = int(cash + k401 + nisa + paypay)
+        cash_c[i] = int(cash)
+        k401_c[i] = int(k401)
+        nisa_c[i] = int(nisa)
+        other_c[i] = int(paypay)
+        tsumitate_c[i] = int(cap)
+        growth_c[i] = int(move)
+        principal_c[i] = int(nisa_principal)
+        states.append((cash, k401, nisa, paypay, nisa_principal))
+
+def _fill_monthly(p, s, tables, result, states, lo, hi, pinned):
+    cash, k401, nisa, paypay, nisa_principal = states[-1]
+    (Gc, Sc), (Gn, Sn), (Gp, Sp), (Gk, Sk) = tables
+    cap, padd, kadd, target = s.nisa_cap[lo], s.paypay_add[lo], s.k401_add[lo], s.sweep_above[lo]
+    grows = s.k401_grows[lo]
+    fc = (s.income[lo] - (s.monthly_out[lo] + cap + padd)) / 12
+    an, ap, ak = cap / 12, padd / 12, kadd / 12
+    total_c, cash_c, k401_c, nisa_c, other_c, tsumitate_c, growth_c, principal_c, short_c = (
+        result.columns[n] for n in MONTHLY_COLUMNS[1:])
+    move = 0
+    for i in range(lo, hi):
+        cash = (cash * Gc[1] + fc) * Gc[11] + fc * Sc[11]
+        if grows:
+            k401 = k401 * Gk[12] + ak * Sk[12]
+        nisa = nisa * Gn[12] + an * Sn[12]
+        paypay = paypay * Gp[12] + ap * Sp[12]
+        nisa_principal = nisa_principal + cap
+        if pinned:
+            move = cash - target
+            cash -= move
+            nisa += move
+            nisa_principal += move
+        total_c[i] = int(cash + k401 + nisa + paypay)
+        cash_c[i] = int(cash)
+        k401_c[i] = int(k401)
+        nisa_c[i] = int(nisa)
+        other_c[i] = int(paypay)
+        tsumitate_c[i] = int(cap)
+        growth_c[i] = int(move)
+        principal_c[i] = int(nisa_principal)
+        short_c[i] = 12 if cash < 0 else 0
+        states.append((cash, k401, nisa, paypay, nisa_principal))
+
+# --- 本体 ---
+
+class JumpResult:
+    # project_final の戻り値。区切りの間の年は値を持たず、total_at() で聞かれたときに式で求める
+    # result には1年ずつ計算した年の行だけが入っている
+    def __init__(self, result, spans):
+        self.result = result
+        self.current_age = result.current_age
+        self.end_age = result.end_age
+        # [(開始行, 年数, 開始前の状態, ルール, 張り付きか)] (開始行の順)
+        self.spans = spans
+        self._starts = [span[0] for span in spans]
+        self._depletion = None
+
+    @property
+    def depletion_age(self):
+        # engine.depletion_age と同じ (総資産が 0 以下になった最初の年齢)。初めて聞かれたときに求める
+        if self._depletion is None:
+            self._depletion = (self._find_depletion(),)
+        return self._depletion[0]
+
+    def _find_depletion(self):
+        total = self.result.columns["Total"]
+        i = 1
+        for lo, k, state, rule, pinned in self.spans + [(len(total), 0, None, None, None)]:
+            for r in range(i, lo):
+                if total[r] <= 0:
+                    return self.current_age + r
+            if k:
+                j = _span_depleted(state, k, rule, pinned)
+                if j is not None:
+                    return self.current_age + lo + j - 1
+            i = lo + k
+        return None
+
+    def total_at(self, age):
+        i = age - self.current_age
+        j = bisect.bisect_right(self._starts, i) - 1
+        if j >= 0:
+            lo, k, state, rule, pinned = self.spans[j]
+            if i < lo + k:
+                cash, k401, nisa, paypay, _ = _advance(state, i - lo + 1, rule, pinned)
+                return int(cash + k401 + nisa + paypay)
+        return self.result.columns["Total"][i]
+
+    @property
+    def final_total(self):
+        return self.total_at(self.end_age)
+
+def _span_depleted(state, k, rule, pinned):
+    # 区間の中で総資産が 1 円未満になる最初の年 (1 〜 k)。なければ None
+    # 各資産は単調に推移するので、1年目と k 年目の小さい方の合計が 1 以上なら途中も下回らない
+    first = _advance(state, 1, rule, pinned)
+    last = _advance(state, k, rule, pinned)
+    if sum(min(a, b) for a, b in zip(first[:4], last[:4])) >= 1:
+        return None
+    for j in range(1, k + 1):
+        cash, k401, nisa, paypay, _ = _advance(state, j, rule, pinned)
+        if int(cash + k401 + nisa + paypay) <= 0:
+            return j
+    return None
+
+def _run(config, rows):
+    p = prepare_params(config)
+    if uses_lots(p):
+        result = simulate(config)
+        return result if rows else JumpResult(result, [])
+    s = Schedule(p)
+    monthly = p["step_mode"] == "月次"
+    tables = monthly_tables(p) if monthly else None
+    result = ProjectionResult(p["current_age"], p["end_age"], MONTHLY_COLUMNS if monthly else COLUMNS)
+    state = (p["ini_cash"], p["ini_401k"], p["ini_nisa"], p["ini_paypay"], p["ini_nisa"])
+    result.set_row(0, *state[:4], 0, 0, state[4])
+    states = [state]
+    ends = _run_ends(p)
+    n = len(result)
+    spans = []
+    rules = {}
+    backoff = 1
+    i = 1
+    while i < n:
+        k = 0
+        if ends[i] - i >= MIN_SPAN:
+            # ルールは区切りの間で同じなので、区切りごとに1回だけ作る
+            rule = rules.get(ends[i])
+            if rule is None:
+                rule = rules[ends[i]] = _span_rule(p, s, tables, i)
+            k, pinned = _longest(states[-1], ends[i] - i, rule, monthly)
+        if k:
+            if rows:
+                if monthly:
+                    _fill_monthly(p, s, tables, result, states, i, i + k, pinned)
+                else:
+                    _fill_annual(p, s, result, states, i, i + k, pinned)
+            else:
+                spans.append((i, k, states[-1], rule, pinned))
+                states.append(_advance(states[-1], k, rule, pinned))
+            i += k
+            backoff = 1
+            continue
+        if ends[i] - i >= MIN_SPAN:
+            # 区切りの間でも進められなかった (毎年取り崩すなど): 1, 2, 4, ... 年ずつ計算してから試し直す
+            j = min(ends[i], i + backoff)
+            backoff = 1 if j == ends[i] else backoff * 2
+        else:
+            # 次に区間が始まりうる年の手前まで、1年ずつ計算する
+            j = i + 1
+            while j < n and ends[j] - j < MIN_SPAN:
+                j += 1
+        if monthly:
+            monthly_rows(p, s, tables, result, states, i, j)
+        else:
+            annual_rows(p, s, result, states, i, j)
+        i = j
+    if rows:
+        return result
+    return JumpResult(result, spans)
+
+def simulate_jump(config):
+    return _run(config, rows=True)
+
+def project_final(config):
+    return _run(config, rows=False)
@@ -0,0 +1,290 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from engine import DEFAULT_CONFIG
+from sensitivity import SENSITIVITY_PARAMS
+
+# ==========================================
+# 負荷試験 (複数セッション)
+# 1つのプロセスの中で AppTest のセッションを N 個作り、順番に1操作ずつ
+# 「スライダーを動かす / 数値の入力を変える / 設定ファイルを読み込む」を続けて、画面の再実行の速さとメモリを測る。
+# (AppTest は同じプロセスの中で同時に2つ動かせないので、セッションは交互に動かす。
+#  サーバーでも再実行はほぼ GIL の取り合いになるので、全員が同時に1回操作したときの待ち時間は「1巡」の時間で見る)
+#
+#   python loadtest.py --sessions 8 --save     # 今の結果を基準値として保存
+#   python loadtest.py --sessions 8            # 基準値と比べ、しきい値 (既定 20%) 以上悪くなった項目があれば終了コード 1
+#
+# 操作の並びは乱数シードから作るので、同じ引数なら毎回 (コミットが変わっても) 同じ操作を流す。
+# 基準値はセッション数・操作数ごとに保存し、同じ条件どうしで比べる。時間はマシンによって変わるので、比べたいマシンで保存し直すこと。
+# ==========================================
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loadtest_baseline.json")
+DEFAULT_THRESHOLD = 20.0
+# メモリは tracemalloc を動かして測るので遅い。1セッションあたりの平均が分かる程度の数だけ動かす
+DEFAULT_MEMORY_SESSIONS = 3
+
+AGE_SLIDER_LABEL = "確認したい年齢を選択してください"
+
+# 操作の種類と割合
+ACTION_WEIGHTS = {"scrub": 4, "edit": 5, "upload": 1}
+# スライダーを1回つかんで動かすときの、再実行の回数 (1目盛りずつ動かす)
+SCRUB_STEPS = 5
+
+# --- 操作の並び ---
+# 1つの操作は (種類, 値)。値は画面の状態によらず決めておき、実際に当てるときに入力欄の範囲に収める
+
+def make_actions(rng, n_actions):
+    keys = list(SENSITIVITY_PARAMS)
+    kinds = list(ACTION_WEIGHTS)
+    weights = [ACTION_WEIGHTS[kind] for kind in kinds]
+    actions = []
+    for i in range(n_actions):
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "scrub":
+            actions.append(("scrub", (rng.randint(0, 60), rng.choice((-1, 1)))))
+        elif kind == "edit":
+            actions.append(("edit", (rng.choice(keys), rng.random())))
+        else:
+            # 「💾 保存」で書き出した設定を少し変えたもの (読み込み済みと見なされないよう、毎回違う名前)
+            config = dict(DEFAULT_CONFIG)
+            for key in rng.sample(keys, 5):
+                config[key] = _value_in_range(key, rng.random())
+            actions.append(("upload", (f"asset_config_{i}.json", json.dumps(config, ensure_ascii=False).encode("utf-8"))))
+    return actions
+
+def _value_in_range(key, u):
+    # u (0〜1) を入力欄の範囲の値にする。整数の入力欄は整数のまま
+    _, lo, hi, _ = SENSITIVITY_PARAMS[key]
+    if isinstance(lo, int):
+        return lo + int(u * (hi - lo))
+    return round(lo + u * (hi - lo), 1)
+
+# --- セッション ---
+
+class Session:
+    def __init__(self, actions, timeout=60):
+        from streamlit.testing.v1 import AppTest
+        self.at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        self.actions = actions
+        self.latencies = []
+
+    def rerun(self):
+        start = time.perf_counter()
+        self.at.run()
+        self.latencies.append(time.perf_counter() - start)
+        if self.at.exception:
+            raise RuntimeError(f"app.py の実行に失敗しました: {self.at.exception[0].value}")
+
+    def open(self):
+        self.rerun()
+
+    def apply(self, kind, value):
+        at = self.at
+        if kind == "scrub":
+            sliders = [s for s in at.slider if s.label == AGE_SLIDER_LABEL]
+            if not sliders:
+                return
+            start, direction = value
+            slider = sliders[0]
+            age = min(max(slider.min + start, slider.min), slider.max)
+            for _ in range(SCRUB_STEPS):
+                age = min(max(age + direction, slider.min), slider.max)
+                slider.set_value(age)
+                self.rerun()
+                slider = next(s for s in at.slider if s.label == AGE_SLIDER_LABEL)
+        elif kind == "edit":
+            key, u = value
+            present = {w.key for w in at.number_input}
+            if key not in present:
+                # 取崩し上限の「金額」と「割合」のように、今の設定では出ていない入力欄
+                return
+            at.number_input(key=key).set_value(_value_in_range(key, u))
+            self.rerun()
+        else:
+            name, data = value
+            at.file_uploader[0].set_value((name, data, "application/json"))
+            self.rerun()
+
+    def replay(self):
+        self.open()
+        for kind, value in self.actions:
+            self.apply(kind, value)
+
+# --- 測定 ---
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def measure_latency(n_sessions, n_actions, seed):
+    # 1巡ごとに、全セッションが1操作ずつ進める
+    sessions = [Session(make_actions(random.Random(seed * 1000 + i), n_actions)) for i in range(n_sessions)]
+    start = time.perf_counter()
+    for s in sessions:
+        s.open()
+    opens = [s.latencies[0] for s in sessions]
+    rounds = []
+    for i in range(n_actions):
+        round_start = time.perf_counter()
+        for s in sessions:
+            s.apply(*s.actions[i])
+        rounds.append(time.perf_counter() - round_start)
+    elapsed = time.perf_counter() - start
+    # 最初の表示 (open) は別に数える
+    reruns = [t for s in sessions for t in s.latencies[1:]]
+    return {
+        "reruns": len(reruns),
+        "elapsed_s": elapsed,
+        "throughput_per_s": (len(reruns) + len(opens)) / elapsed,
+        "p50_ms": statistics.median(reruns) * 1000,
+        "p99_ms": percentile(reruns, 99) * 1000,
+        "round_p99_ms": percentile(rounds, 99) * 1000,
+        "open_p50_ms": statistics.median(opens) * 1000,
+    }
+
+def measure_memory(n_sessions, n_actions, seed):
+    # 1セッション増えるごとに増えるメモリ (session_state・グラフなどの要素の木) を tracemalloc で測る
+    # tracemalloc を動かしている間は遅くなるので、時間の測定とは別に、セッションを1つずつ順に動かす。
+    # 共有のキャッシュ (計算結果など) は measure_latency で温まっているので、ほぼセッション固有の分になる
+    sessions = []
+    gc.collect()
+    tracemalloc.start()
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        growth = []
+        for i in range(n_sessions):
+            s = Session(make_actions(random.Random(seed * 1000 + i), n_actions))
+            s.replay()
+            sessions.append(s)
+            gc.collect()
+            growth.append(tracemalloc.get_traced_memory()[0] - base)
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return {
+        "mem_per_session_kb": growth[-1] / len(growth) / 1024,
+        "mem_first_session_kb": growth[0] / 1024,
+        "mem_peak_kb": peak / 1024,
+    }
+
+def run_loadtest(n_sessions, n_actions, seed=0, memory_sessions=DEFAULT_MEMORY_SESSIONS, progress=None):
+    from streamlit.logger import set_log_level
+    # 非推奨の警告などがセッションごとに出ないよう、streamlit のログはエラーだけにする
+    # (ロガーは初回の実行中に作られるので、1回動かしてから下げる)
+    warmup = Session([])
+    warmup.open()
+    set_log_level("error")
+
+    results = measure_latency(n_sessions, n_actions, seed)
+    if progress is not None:
+        progress(f"再実行 {results['reruns']:,} 回 ({results['elapsed_s']:.1f} 秒)")
+    results.update(measure_memory(memory_sessions, n_actions, seed))
+    return results
+
+# --- 基準値 ---
+
+# (項目, 表示名, 単位, 大きいほど良いか)
+METRICS = [
+    ("throughput_per_s", "スループット", "回/秒", True),
+    ("p50_ms", "再実行 p50", "ms", False),
+    ("p99_ms", "再実行 p99", "ms", False),
+    ("round_p99_ms", "1巡 p99", "ms", False),
+    ("open_p50_ms", "最初の表示 p50", "ms", False),
+    ("mem_per_session_kb", "メモリ / セッション", "KB", False),
+]
+
+def scenario_name(n_sessions, n_actions, seed):
+    return f"sessions={n_sessions},actions={n_actions},seed={seed}"
+
+def git_revision():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(APP_PATH),
+                             capture_output=True, text=True, check=True)
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_baseline(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)["scenarios"]
+
+def save_baseline(path, name, results):
+    scenarios = load_baseline(path) if os.path.exists(path) else {}
+    scenarios[name] = dict(results, revision=git_revision(), saved_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+    data = {"python": platform.python_version(), "machine": platform.machine(), "processor": platform.processor(),
+            "scenarios": scenarios}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+
+def compare(results, base, threshold):
+    # 戻り値: [(項目, 基準値, 今回, 悪くなった割合 %)] のうち、しきい値を超えたもの
+    regressions = []
+    for key, _, _, higher_is_better in METRICS:
+        if key not in base:
+            continue
+        change = (results[key] / base[key] - 1) * 100
+        worse = -change if higher_is_better else change
+        if worse > threshold:
+            regressions.append((key, base[key], results[key], worse))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="複数のセッションで画面を同時に操作し、再実行の速さとメモリを測ります。")
+    parser.add_argument("--sessions", type=int, default=8, help="同時に動かすセッションの数 (既定: 8)")
+    parser.add_argument("--actions", type=int, default=20, help="1セッションあたりの操作の数 (既定: 20)")
+    parser.add_argument("--seed", type=int, default=0, help="操作の並びを作る乱数シード (既定: 0)")
+    parser.add_argument("--memory-sessions", type=int, default=DEFAULT_MEMORY_SESSIONS,
+                        help=f"メモリを測るセッションの数 (既定: {DEFAULT_MEMORY_SESSIONS})")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="基準値のファイル (既定: loadtest_baseline.json)")
+    parser.add_argument("--save", action="store_true", help="今回の結果を基準値として保存する")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"何 %% 悪くなったら失敗にするか (既定: {DEFAULT_THRESHOLD:g})")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    args = parser.parse_args(argv)
+    if min(args.sessions, args.actions, args.memory_sessions) < 1:
+        parser.error("--sessions・--actions・--memory-sessions は 1 以上にしてください")
+
+    name = scenario_name(args.sessions, args.actions, args.seed)
+    results = run_loadtest(args.sessions, args.actions, args.seed, args.memory_sessions,
+                           progress=None if args.json else print)
+    if args.json:
+        print(json.dumps(dict(results, scenario=name, revision=git_revision()), ensure_ascii=False))
+    else:
+        print(f"\n{name}")
+        for key, label, unit, _ in METRICS:
+            print(f"{label:<16} {results[key]:12,.1f} {unit}")
+
+    if args.save:
+        save_baseline(args.baseline, name, results)
+        print(f"💾 基準値を保存しました → {args.baseline}", file=sys.stderr)
+        return 0
+    if not os.path.exists(args.baseline) or name not in load_baseline(args.baseline):
+        print(f"この条件の基準値がありません。--save で保存してください ({args.baseline})", file=sys.stderr)
+        return 0
+
+    base = load_baseline(args.baseline)[name]
+    print(f"\n基準値 ({base.get('revision') or '?'}, {base.get('saved_at', '')}) との比較", file=sys.stderr)
+    for key, label, unit, _ in METRICS:
+        if key in base:
+            change = (results[key] / base[key] - 1) * 100
+            print(f"{label:<16} {base[key]:12,.1f} → {results[key]:12,.1f} {unit} ({change:+.1f}%)", file=sys.stderr)
+    regressions = compare(results, base, args.threshold)
+    if regressions:
+        print(f"\n⚠️ {args.threshold:g}% を超えて悪くなった項目: " + ", ".join(key for key, *_ in regressions), file=sys.stderr)
+        return 1
+    print(f"\n✅ {args.threshold:g}% を超えて悪くなった項目はありません", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,384 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from batch_engine import prepare_batch, repeat_params, run_vectorized
+from engine import SimulationCache, config_hash, earliest_affected_age, normalize_config, validate_config
+
+# ==========================================
+# モンテカルロ (確率) シミュレーション
+# 利回りとインフレ率を毎年ランダムに振り、全パスをベクトル化エンジンで一括計算する
+#
+#   python montecarlo.py 設定.json --paths 200000 --memory-limit 256            # 分割計算して要約を表示
+#   python montecarlo.py 設定.json --paths 200000 --export 出力フォルダ/         # 全パスを .npy に書き出す
+# ==========================================
+
+# 変動させる項目 (順番は相関行列の行・列の順番)
+MC_KEYS = ("r_cash", "r_401k", "r_nisa", "r_paypay", "inflation")
+MC_LABELS = {"r_cash": "貯蓄金利", "r_401k": "401k", "r_nisa": "新NISA", "r_paypay": "他運用", "inflation": "インフレ率"}
+
+# 年率の標準偏差 (%)
+DEFAULT_VOLATILITY = {"r_cash": 0.2, "r_401k": 15.0, "r_nisa": 18.0, "r_paypay": 20.0, "inflation": 1.0}
+
+DEFAULT_CORRELATION = [
+    [1.0, 0.0, 0.0, 0.0, 0.3],
+    [0.0, 1.0, 0.8, 0.7, 0.0],
+    [0.0, 0.8, 1.0, 0.8, 0.0],
+    [0.0, 0.7, 0.8, 1.0, 0.0],
+    [0.3, 0.0, 0.0, 0.0, 1.0],
+]
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# 1年で資産が消える (-100%) ような値は引かないようにする
+MIN_RETURN = -0.99
+
+# 途中から再開するための状態を何年ごとに残すか
+CHECKPOINT_EVERY = 5
+
+def cholesky_factor(corr):
+    c = np.asarray(corr, dtype=np.float64)
+    c = (c + c.T) / 2
+    np.fill_diagonal(c, 1.0)
+    try:
+        return np.linalg.cholesky(c)
+    except np.linalg.LinAlgError:
+        # 正定値でない入力は、固有値を切り上げてから対角を 1 に戻して使う
+        w, v = np.linalg.eigh(c)
+        c = (v * np.maximum(w, 1e-10)) @ v.T
+        d = np.sqrt(np.diag(c))
+        c = c / np.outer(d, d)
+        return np.linalg.cholesky(c)
+
+def _draw_params(c, volatility, correlation):
+    # 戻り値: (平均, 標準偏差, 相関のコレスキー因子)。いずれも MC_KEYS の順
+    vol = dict(DEFAULT_VOLATILITY, **(volatility or {}))
+    L = cholesky_factor(DEFAULT_CORRELATION if correlation is None else correlation)
+    mean = np.array([c[key] for key in MC_KEYS], dtype=np.float64) / 100
+    sigma = np.array([vol[key] for key in MC_KEYS], dtype=np.float64) / 100
+    return mean, sigma, L
+
+def _draw(rng, n_years, n_paths, mean, sigma, L):
+    z = rng.standard_normal((n_years + 1, n_paths, len(MC_KEYS)))
+    draws = mean + (z @ L.T) * sigma
+    np.maximum(draws, MIN_RETURN, out=draws)
+    return draws
+
+def draw_returns(config, n_paths, n_years, volatility=None, correlation=None, seed=None):
+    # 戻り値: {"r_cash": (n_years + 1, n_paths), ...} (比率)。行 0 は初年度の状態なので使われない
+    c = normalize_config(config)
+    mean, sigma, L = _draw_params(c, volatility, correlation)
+    draws = _draw(np.random.default_rng(seed), n_years, n_paths, mean, sigma, L)
+    return {key: draws[:, :, j] for j, key in enumerate(MC_KEYS)}
+
+class MonteCarloResult:
+    def __init__(self, ages, bands, ruin_prob, n_paths, elapsed, peak_bytes=None, n_chunks=1, export_dir=None):
+        self.ages = ages
+        self.bands = bands
+        self.ruin_prob = ruin_prob
+        self.n_paths = n_paths
+        self.elapsed = elapsed
+        # 以下は分割計算 (run_montecarlo_streaming) の場合だけ
+        self.peak_bytes = peak_bytes
+        self.n_chunks = n_chunks
+        self.export_dir = export_dir
+
+    @property
+    def nbytes(self):
+        return self.ages.nbytes + self.ruin_prob.nbytes + sum(b.nbytes for b in self.bands.values())
+
+def summarize_paths(ages, total, current_age, percentiles=PERCENTILES):
+    # total: (パス数, 年齢数)。パーセンタイル帯と「その年齢までに資金が尽きた確率」を返す
+    bands = dict(zip(percentiles, np.percentile(total, percentiles, axis=0)))
+    depleted = (total <= 0) & (ages > current_age)
+    ruin_prob = np.logical_or.accumulate(depleted, axis=1).mean(axis=0)
+    return bands, ruin_prob
+
+class MonteCarloCheckpoint:
+    # 直前の計算の乱数と、CHECKPOINT_EVERY 年ごとの途中状態を覚えておく (セッションごとに1つ持つ想定)
+    # 乱数の条件が同じで、後ろの年齢にしか効かない入力だけが変わった場合は途中から再開する
+    def __init__(self, every=CHECKPOINT_EVERY):
+        self.every = every
+        # 取り消された古いジョブがまだ計算中のまま、新しいジョブが始まることがあるので、1つずつ順に使う
+        self._lock = threading.Lock()
+        self.config = None
+        self.noise_key = None
+        self.mean_key = None
+        self.returns = None
+        self.result = None
+        self.resumed_from = None
+
+    def run(self, c, P, n_paths, volatility, correlation, seed, on_progress=None):
+        with self._lock:
+            return self._run(c, P, n_paths, volatility, correlation, seed, on_progress)
+
+    def _run(self, c, P, n_paths, volatility, correlation, seed, on_progress=None):
+        n_years = c["end_age"] - c["current_age"]
+        noise_key = repr((n_paths, c["current_age"], n_years, seed, sorted((volatility or {}).items()),
+                          None if correlation is None else np.asarray(correlation, dtype=np.float64).round(6).tolist()))
+        mean_key = tuple(c[key] for key in MC_KEYS)
+        # seed が同じなら正規乱数は同じなので、平均だけが変わった場合も途中の年齢までは結果が一致する
+        same_noise = seed is not None and noise_key == self.noise_key
+        if same_noise and mean_key == self.mean_key:
+            returns = self.returns
+        else:
+            returns = draw_returns(c, n_paths, n_years, volatility, correlation, seed)
+
+        resume = None
+        if same_noise:
+            first_col = earliest_affected_age(self.config, c) - c["current_age"]
+            usable = [col for col in self.result.checkpoints if col < first_col]
+            if usable:
+                col = max(usable)
+                resume = (col + 1, self.result.checkpoints[col], self.result.columns)
+        # 途中で止められた場合は、前回の状態をそのまま残す
+        result = run_vectorized(P, returns, columns=("Total",), resume=resume, checkpoint_every=self.every,
+                                on_year=on_progress)
+
+        self.config, self.noise_key, self.mean_key = c, noise_key, mean_key
+        self.returns, self.result = returns, result
+        self.resumed_from = None if resume is None else c["current_age"] + resume[0]
+        return result
+
+def run_montecarlo(config, n_paths=10000, volatility=None, correlation=None, seed=None, checkpoint=None, on_progress=None):
+    # on_progress(進み具合 0〜1): 1年分を計算するたびに呼ぶ (例外を投げれば計算を途中で止められる)
+    start = time.perf_counter()
+    c = normalize_config(config)
+    P = repeat_params(prepare_batch([c]), n_paths)
+    if checkpoint is None:
+        returns = draw_returns(c, n_paths, c["end_age"] - c["current_age"], volatility, correlation, seed)
+        result = run_vectorized(P, returns, columns=("Total",), on_year=on_progress)
+    else:
+        result = checkpoint.run(c, P, n_paths, volatility, correlation, seed, on_progress)
+    bands, ruin_prob = summarize_paths(result.ages, result.columns["Total"], c["current_age"])
+    return MonteCarloResult(result.ages, bands, ruin_prob, n_paths, time.perf_counter() - start)
+
+# --- 大量パスの分割計算 ---
+# パスを塊 (チャンク) に分けて順に計算し、全パスを同時には持たない。
+# パーセンタイル帯は年齢ごとの近似ヒストグラム (QuantileSketch) に、資金が尽きた確率は本数に足し込んでいくので、
+# 使うメモリはパス数によらず「塊1つ分 + ヒストグラム」で頭打ちになる。
+# 全パスの推移は、書き出し先 (export_dir) を渡された場合だけ np.memmap のファイルに書く。
+
+# 乱数はこの本数ごとに別の系列から引く (メモリの上限を変えて塊の大きさが変わっても、同じシードなら同じ結果になる)
+BLOCK_PATHS = 1000
+# 画面でこれより多いパス数を選んだ場合は分割計算にする
+STREAMING_MIN_PATHS = 50000
+DEFAULT_MEMORY_LIMIT = 256 * 1024 * 1024
+SKETCH_ACCURACY = 0.01
+# これより大きい金額 (円) は最後のビンにまとめる
+SKETCH_MAX_VALUE = 1e15
+EXPORT_COLUMNS = ("Total", "Cash", "401k", "NISA", "Other")
+
+class QuantileSketch:
+    # 年齢ごとの対数ビンのヒストグラム (DDSketch と同じ考え方)
+    # 金額 x を |x| ≤ γ^k となる最小の k のビンで数えるので、分位点の相対誤差は accuracy 以内。
+    # ビンの区切りは固定なので、別々に数えたものは数を足すだけで併合できる
+    def __init__(self, n_ages, accuracy=SKETCH_ACCURACY, max_value=SKETCH_MAX_VALUE):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.n_bins = int(np.ceil(np.log(max_value) / self.log_gamma))
+        # 列の並び: 負の値 (絶対値の大きい順) | 0 | 正の値 (小さい順)。1円未満は 0 のビン
+        self.counts = np.zeros((n_ages, 2 * self.n_bins + 1), dtype=np.int64)
+        self.n = 0
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes
+
+    def add(self, values):
+        # values: (パス数, 年齢数)
+        n_ages, width = self.counts.shape
+        v = values.astype(np.float64)
+        k = np.log(np.maximum(np.abs(v), 1.0))
+        k /= self.log_gamma
+        np.ceil(k, out=k)
+        np.minimum(k, self.n_bins, out=k)
+        k *= np.sign(v)
+        idx = k.astype(np.int64)
+        idx += self.n_bins + np.arange(n_ages) * width
+        self.counts += np.bincount(idx.ravel(), minlength=n_ages * width).reshape(n_ages, width)
+        self.n += len(values)
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.n += other.n
+        return self
+
+    def percentiles(self, qs):
+        # {q: 年齢ごとの q パーセンタイル (そのビンの代表値)}
+        cum = self.counts.cumsum(axis=1)
+        out = {}
+        for q in qs:
+            col = (cum > q / 100 * (self.n - 1)).argmax(axis=1)
+            k = col - self.n_bins
+            out[q] = np.sign(k) * 2 * self.gamma ** np.abs(k) / (self.gamma + 1)
+        return out
+
+    def percentile(self, q):
+        return self.percentiles((q,))[q]
+
+class PathExport:
+    # 全パスの推移を列ごとの .npy (np.memmap) に書く。読むときは np.load(path, mmap_mode="r") で必要な行だけ読める
+    def __init__(self, out_dir, ages, n_paths, columns=EXPORT_COLUMNS):
+        os.makedirs(out_dir, exist_ok=True)
+        np.save(os.path.join(out_dir, "ages.npy"), ages)
+        self.arrays = {name: np.lib.format.open_memmap(os.path.join(out_dir, f"{name}.npy"), mode="w+",
+                                                       dtype=np.int64, shape=(n_paths, len(ages)))
+                       for name in columns}
+
+    def write(self, lo, columns):
+        # 書いた分はすぐファイルに落とし、書き込み待ちのページがメモリに溜まらないようにする
+        for name, values in self.arrays.items():
+            values[lo:lo + len(columns[name])] = columns[name]
+            values.flush()
+
+    def close(self):
+        self.arrays = {}
+
+def _bytes_per_path(n_ages, n_columns):
+    # 1本あたりの概算 (バイト、多めに見積もる): 乱数 (正規乱数と利回り) 2 × 5 項目、記録する列、
+    # ヒストグラムに数える途中の配列 3 つ。残りは年齢によらない状態 (設定の値や計算途中の金額)
+    # (tracemalloc で測った値は 年次・月次とも この 6 割ほど。tracemalloc はプロセス全体で1つなので、
+    #  画面の複数セッションが同時に計算すると測り合ってしまう。そのため実測はせず、この見積もりで塊の大きさを決める)
+    return 8 * n_ages * (2 * len(MC_KEYS) + n_columns + 3) + 1024
+
+def run_montecarlo_streaming(config, n_paths, volatility=None, correlation=None, seed=None,
+                             memory_limit=DEFAULT_MEMORY_LIMIT, export_dir=None, chunk_paths=None, on_chunk=None):
+    # memory_limit: 計算に使うメモリの上限 (バイト)。塊の大きさは 1本あたりの見積もり (_bytes_per_path) で、これに収まるように決める
+    # 結果の peak_bytes も同じ見積もりから出す (一番大きい塊の本数 × 1本あたり + 分位点の集計)
+    # chunk_paths: 1つの塊のパス数の上限 (途中経過を細かく出したい場合。BLOCK_PATHS 単位に切り上げる)
+    # on_chunk: 塊が終わるたびに、そこまでのパスで作った MonteCarloResult (n_paths は終わった本数) で呼ぶ
+    start = time.perf_counter()
+    c = normalize_config(config)
+    n_years = c["end_age"] - c["current_age"]
+    ages = np.arange(c["current_age"], c["end_age"] + 1)
+    mean, sigma, L = _draw_params(c, volatility, correlation)
+    P = prepare_batch([c])
+    columns = ("Total",) if export_dir is None else EXPORT_COLUMNS
+
+    sketch = QuantileSketch(len(ages))
+    depleted_count = np.zeros(len(ages), dtype=np.int64)
+    after_start = ages > c["current_age"]
+    seeds = np.random.SeedSequence(seed).spawn(-(-n_paths // BLOCK_PATHS))
+    export = PathExport(export_dir, ages, n_paths, columns) if export_dir is not None else None
+
+    def blocks_per_chunk(per_path):
+        n_blocks = int((memory_limit - sketch.nbytes) // (per_path * BLOCK_PATHS))
+        if n_blocks < 1:
+            need = (sketch.nbytes + per_path * BLOCK_PATHS) / 1024 / 1024
+            raise ValueError(f"メモリの上限が小さすぎます ({need:,.0f}MB 以上にしてください)")
+        if chunk_paths is not None:
+            n_blocks = min(n_blocks, -(-chunk_paths // BLOCK_PATHS))
+        return n_blocks
+
+    def finish(done_paths, peak, n_chunks):
+        return MonteCarloResult(ages, sketch.percentiles(PERCENTILES), depleted_count / done_paths, done_paths,
+                                time.perf_counter() - start, peak_bytes=int(sketch.nbytes + peak), n_chunks=n_chunks,
+                                export_dir=export_dir)
+
+    def run_chunk(b0, b1):
+        lo, hi = b0 * BLOCK_PATHS, min(b1 * BLOCK_PATHS, n_paths)
+        draws = np.empty((n_years + 1, hi - lo, len(MC_KEYS)))
+        for b in range(b0, b1):
+            a, z = b * BLOCK_PATHS - lo, min((b + 1) * BLOCK_PATHS, n_paths) - lo
+            draws[:, a:z] = _draw(np.random.default_rng(seeds[b]), n_years, z - a, mean, sigma, L)
+        returns = {key: draws[:, :, j] for j, key in enumerate(MC_KEYS)}
+        result = run_vectorized(repeat_params(P, hi - lo), returns, columns=columns)
+        total = result.columns["Total"]
+        sketch.add(total)
+        depleted_count[:] += np.logical_or.accumulate((total <= 0) & after_start, axis=1).sum(axis=0)
+        if export is not None:
+            export.write(lo, result.columns)
+        return hi - lo
+
+    try:
+        per_path = _bytes_per_path(len(ages), len(columns))
+        step = blocks_per_chunk(per_path)
+        done = 0
+        peak = 0
+        n_chunks = 0
+        while done < len(seeds):
+            if n_chunks > 0 and on_chunk is not None:
+                on_chunk(finish(sketch.n, peak, n_chunks))
+            b1 = min(done + step, len(seeds))
+            peak = max(peak, per_path * run_chunk(done, b1))
+            done = b1
+            n_chunks += 1
+    finally:
+        if export is not None:
+            export.close()
+
+    result = finish(n_paths, peak, n_chunks)
+    if on_chunk is not None:
+        on_chunk(result)
+    return result
+
+MC_CACHE = SimulationCache(max_entries=32, max_bytes=32 * 1024 * 1024)
+
+def montecarlo_cache_key(config, n_paths=10000, volatility=None, correlation=None, seed=0,
+                         memory_limit=DEFAULT_MEMORY_LIMIT):
+    return "|".join([
+        config_hash(config), str(n_paths), str(seed),
+        repr(sorted((volatility or {}).items())),
+        repr(np.asarray(DEFAULT_CORRELATION if correlation is None else correlation, dtype=np.float64).round(6).tolist()),
+        str(memory_limit) if n_paths > STREAMING_MIN_PATHS else "",
+    ])
+
+def run_montecarlo_cached(config, n_paths=10000, volatility=None, correlation=None, seed=0, cache=MC_CACHE,
+                          checkpoint=None, memory_limit=DEFAULT_MEMORY_LIMIT, chunk_paths=None, on_chunk=None,
+                          on_progress=None):
+    # STREAMING_MIN_PATHS より多いパス数は分割計算 (途中からの再開はしない)。chunk_paths・on_chunk は分割計算の場合だけ、
+    # on_progress (年ごとの進み具合) は分割しない場合だけ使う
+    key = montecarlo_cache_key(config, n_paths, volatility, correlation, seed, memory_limit)
+    result = cache.get(key)
+    if result is None:
+        if n_paths > STREAMING_MIN_PATHS:
+            result = run_montecarlo_streaming(config, n_paths, volatility, correlation, seed, memory_limit,
+                                              chunk_paths=chunk_paths, on_chunk=on_chunk)
+        else:
+            result = run_montecarlo(config, n_paths, volatility, correlation, seed, checkpoint, on_progress)
+        cache.put(key, result, result.nbytes)
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="保存した設定で確率シミュレーションを分割計算し、要約を表示します。")
+    parser.add_argument("config", help="「💾 保存」で書き出した設定ファイル (JSON)")
+    parser.add_argument("--paths", type=int, default=100000, help="パス数 (既定: 100000)")
+    parser.add_argument("--seed", type=int, default=0, help="乱数シード (既定: 0)")
+    parser.add_argument("--memory-limit", type=int, default=DEFAULT_MEMORY_LIMIT // 1024 // 1024,
+                        help=f"計算に使うメモリの上限 MB (既定: {DEFAULT_MEMORY_LIMIT // 1024 // 1024})")
+    parser.add_argument("--export", metavar="DIR", help="全パスの推移を列ごとの .npy (memmap) としてこのフォルダに書き出す")
+    args = parser.parse_args(argv)
+    if args.paths < 1:
+        parser.error("--paths は 1 以上にしてください")
+
+    try:
+        with open(args.config, encoding="utf-8") as f:
+            config = validate_config(json.load(f))
+    except (OSError, ValueError) as e:
+        parser.error(f"設定ファイルを読み込めませんでした ({e})")
+
+    def on_chunk(partial):
+        print(f"{partial.n_paths:,} / {args.paths:,} パス", file=sys.stderr)
+
+    try:
+        result = run_montecarlo_streaming(config, args.paths, seed=args.seed, memory_limit=args.memory_limit * 1024 * 1024,
+                                          export_dir=args.export, on_chunk=on_chunk)
+    except ValueError as e:
+        parser.error(str(e))
+    age = int(result.ages[-1])
+    for q in PERCENTILES:
+        print(f"{age}歳の総資産 P{q:<2}   {result.bands[q][-1] / 10000:14,.0f} 万円")
+    print(f"{age}歳までに資金が尽きる確率 {result.ruin_prob[-1] * 100:.2f}%")
+    print(f"計算時間 {result.elapsed:.1f} 秒 / {result.n_chunks} 回に分割 / メモリ最大 約{result.peak_bytes / 1024 / 1024:,.0f}MB")
+    if result.export_dir is not None:
+        print(f"💾 全パスを書き出しました → {result.export_dir}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+import numpy as np
+
+from batch_engine import LIMIT_MODES, TAX_COLUMN, simulate_batch
+from engine import PRIORITIES, normalize_config
+
+# ==========================================
+# 取り崩しルールの最適化
+# 取り崩しの優先順位・解禁年齢・取り崩し上限・401k積立終了年齢の組み合わせから、
+# 最低貯蓄 (ダム水位) を割らずに、最終年齢の総資産が最大 (または生涯の税金が最小) になるものを探す。
+# 全部の組み合わせ (数千万通り) は計算しない。今の設定から始め、「1項目だけ変えた設定」をまとめて
+# ベクトル化エンジンで計算し、良かった上位 BEAM_WIDTH 件からまた次の候補を作る (ビームサーチ)。
+# 上位が入れ替わらなくなったら終わり。結果が同じになる値 (開始年齢以前の解禁年齢など) は1つにまとめてから探す。
+# ==========================================
+
+OBJECTIVES = {"final_total": "最終年齢の総資産を最大にする", "tax": "生涯の税金を最小にする"}
+
+# 探す項目 (候補の tuple はこの順番)
+DECISIONS = ("priority", "nisa_start_age", "paypay_start_age", "limit_nisa", "limit_other", "k401_stop_age")
+DECISION_LABELS = {
+    "priority": "取り崩し優先順位", "nisa_start_age": "新NISA 解禁年齢", "paypay_start_age": "他運用 解禁年齢",
+    "limit_nisa": "NISA取崩し上限", "limit_other": "他運用取崩し上限", "k401_stop_age": "401k積立終了年齢",
+}
+
+# 取り崩し上限の候補: (方式, 値)。年額定額の 0 は上限なし
+YEN_MODE = "年額定額 (万円)"
+LIMIT_YEN_VALUES = (0, 50, 100, 150, 200, 300, 500)
+LIMIT_PCT_VALUES = (2.0, 3.0, 4.0, 5.0, 6.0, 8.0)
+
+BEAM_WIDTH = 4
+MAX_ROUNDS = 20
+# 年齢は AGE_STRIDE 歳刻みの全体と、今の値の前後 AGE_STRIDE - 1 歳を候補にする
+AGE_STRIDE = 5
+
+# --- 探す範囲 ---
+
+def _limit_of(base, name):
+    mode = base[f"limit_mode_{name}"]
+    value = base[f"limit_val_{name}_yen"] if mode == YEN_MODE else base[f"limit_val_{name}_pct"]
+    return (mode, value)
+
+def _limit_options(current):
+    options = [(YEN_MODE, v) for v in LIMIT_YEN_VALUES]
+    options += [(mode, v) for mode in LIMIT_MODES if mode != YEN_MODE for v in LIMIT_PCT_VALUES]
+    return options if current in options else options + [current]
+
+def decision_space(base):
+    # 項目ごとの候補の一覧。年齢は (最小, 最大) で、その外の値は端の値と同じ結果になる
+    cur, end = base["current_age"], base["end_age"]
+    # 解禁年齢: 計算は current_age + 1 歳から、end_age + 1 歳以上は解禁しないのと同じ (入力欄は 50〜100)
+    unlock_lo = max(50, cur + 1)
+    unlock = (unlock_lo, max(min(100, end + 1), unlock_lo))
+    # 401k積立: 退職か受取の前年で止まるので、それより後の終了年齢は同じ (入力欄は 20〜70)
+    k401_lo = max(20, cur - 1)
+    k401_hi = min(70, max(min(base["age_work_last"], base["age_401k_get"] - 1), k401_lo))
+    k401 = (k401_lo, k401_hi) if base["k401_monthly"] > 0 else (base["k401_stop_age"],) * 2
+    return {
+        "priority": PRIORITIES,
+        "nisa_start_age": unlock,
+        "paypay_start_age": unlock,
+        "limit_nisa": _limit_options(_limit_of(base, "nisa")),
+        "limit_other": _limit_options(_limit_of(base, "other")),
+        "k401_stop_age": k401,
+    }
+
+def current_decisions(base, space):
+    # 今の設定を探す範囲にまとめた候補 (年齢は範囲の端に寄せる)
+    out = []
+    for name in DECISIONS:
+        if name.startswith("limit_"):
+            out.append(_limit_of(base, name[len("limit_"):]))
+        elif name == "priority":
+            out.append(base["priority"])
+        else:
+            lo, hi = space[name]
+            out.append(min(max(base[name], lo), hi))
+    return tuple(out)
+
+def decision_settings(name, value):
+    # 1項目の候補 → 設定のキーと値
+    if name.startswith("limit_"):
+        account = name[len("limit_"):]
+        mode, v = value
+        return {f"limit_mode_{account}": mode, f"limit_val_{account}_yen" if mode == YEN_MODE else f"limit_val_{account}_pct": v}
+    return {name: value}
+
+def candidate_config(base, candidate):
+    config = dict(base)
+    for name, value in zip(DECISIONS, candidate):
+        config.update(decision_settings(name, value))
+    return config
+
+def neighbours(candidate, space):
+    # 1項目だけ変えた候補
+    out = []
+    for i, name in enumerate(DECISIONS):
+        options = space[name]
+        if name.endswith("_age"):
+            lo, hi = options
+            near = range(candidate[i] - AGE_STRIDE + 1, candidate[i] + AGE_STRIDE)
+            values = sorted({*range(lo, hi + 1, AGE_STRIDE), hi, *(v for v in near if lo <= v <= hi)})
+        else:
+            values = options
+        out += [candidate[:i] + (v,) + candidate[i + 1:] for v in values if v != candidate[i]]
+    return out
+
+# --- 評価 ---
+
+def dam_floor(base, ages):
+    # 年齢ごとの最低貯蓄 (円)。〜49歳 dam_1 / 50代 dam_2 / 60歳〜 dam_3
+    dams = np.array([base["dam_1"], base["dam_2"], base["dam_3"]], dtype=np.float64) * 10000
+    return dams[np.searchsorted([50, 60], ages, side="right")]
+
+def evaluate(base, candidates):
+    # 戻り値: (最低貯蓄を割る年数, 最終年齢の総資産, 生涯の税金) の配列 (候補の数, 3)
+    # 割る年数: 使えるお金 (現金 + その年齢で解禁済みの NISA・他運用) が最低貯蓄を下回る年の数。0 ならダム水位を割らない
+    # (解禁しないまま現金をマイナスにしておくと総資産は増えるが、借金で暮らすことになるので、総資産ではなくこちらで見る)
+    result = simulate_batch([candidate_config(base, c) for c in candidates], columns=("Total", "Cash", "NISA", "Other", TAX_COLUMN))
+    ages = result.ages
+    in_range = (ages > base["current_age"]) & (ages <= base["end_age"])
+    a = ages[in_range]
+    col = lambda name: result.columns[name][:, in_range]
+    nisa_start = np.array([c[DECISIONS.index("nisa_start_age")] for c in candidates])[:, None]
+    paypay_start = np.array([c[DECISIONS.index("paypay_start_age")] for c in candidates])[:, None]
+    usable = col("Cash") + np.where(a >= nisa_start, col("NISA"), 0) + np.where(a >= paypay_start, col("Other"), 0)
+    years_below = (usable < dam_floor(base, a)).sum(axis=1)
+    tax = col(TAX_COLUMN).sum(axis=1)
+    return np.stack([years_below, result.final("Total"), tax], axis=1).astype(np.int64)
+
+def _rank(scores, objective):
+    # 良い順の番号。最低貯蓄を割る年数が少ないものを先に、同じなら目的の指標、その次にもう一方の指標で並べる
+    years_below, final_total, tax = scores.T
+    if objective == "tax":
+        return np.lexsort((-final_total, tax, years_below))
+    return np.lexsort((tax, -final_total, years_below))
+
+# --- 最適化 ---
+
+class OptimizeResult:
+    def __init__(self, base, objective, start, best, scores, evaluations, rounds, converged):
+        self.base = base
+        self.objective = objective
+        self.start = start
+        self.best = best
+        # (最低貯蓄を割る年数, 最終年齢の総資産, 生涯の税金)
+        self.start_scores = scores[start]
+        self.best_scores = scores[best]
+        self.evaluations = evaluations
+        self.rounds = rounds
+        self.converged = converged
+
+    @property
+    def feasible(self):
+        return self.best_scores[0] == 0
+
+    def changes(self):
+        # 今の設定から変える項目: [(項目, 今の値, 新しい値)]
+        return [(name, a, b) for name, a, b in zip(DECISIONS, self.start, self.best) if a != b]
+
+    def settings(self):
+        # 入力欄に反映する設定 (変える項目のキーだけ)
+        out = {}
+        for name, _, value in self.changes():
+            out.update(decision_settings(name, value))
+        return out
+
+def optimize(config, objective="final_total", beam_width=BEAM_WIDTH, max_rounds=MAX_ROUNDS, on_round=None):
+    # on_round(途中の OptimizeResult, 進み具合): 1回分の候補を計算するごとに呼ぶ
+    base = normalize_config(config)
+    space = decision_space(base)
+    start = current_decisions(base, space)
+    scores = dict(zip([start], evaluate(base, [start])))
+    expanded = set()
+    beam = [start]
+    rounds = 0
+    converged = False
+    while rounds < max_rounds:
+        frontier = [c for c in beam if c not in expanded]
+        if not frontier:
+            converged = True
+            break
+        expanded.update(frontier)
+        new = list(dict.fromkeys(n for c in frontier for n in neighbours(c, space) if n not in scores))
+        if new:
+            scores.update(zip(new, evaluate(base, new)))
+        rounds += 1
+        seen = list(scores)
+        order = _rank(np.array([scores[c] for c in seen]), objective)
+        beam = [seen[i] for i in order[:beam_width]]
+        if on_round is not None:
+            partial = OptimizeResult(base, objective, start, beam[0], scores, len(scores), rounds, False)
+            on_round(partial, rounds / max_rounds)
+    return OptimizeResult(base, objective, start, beam[0], scores, len(scores), rounds, converged)
+
+def format_decision(name, value):
+    if name == "priority":
+        return value
+    if name.startswith("limit_"):
+        mode, v = value
+        if mode == YEN_MODE:
+            return "上限なし" if v == 0 else f"年{v:,}万円まで"
+        return f"{mode.split(' ')[0]}の{v:.1f}%まで"
+    return f"{value}歳"
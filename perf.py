@@ -0,0 +1,105 @@
+import json
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+# ==========================================
+# 処理時間の計測 (フェーズごと)
+# 計測中の実行 (RunTimings) がある間だけ phase() が時間を測る。
+# 計測していないときの phase() は、使い回しの nullcontext を返すだけなので、ほぼコストがかからない。
+# ==========================================
+
+_CURRENT = ContextVar("perf_current", default=None)
+_NULL = nullcontext()
+
+class RunTimings:
+    # 1回の実行 (画面の再実行やフラグメントの再実行) のフェーズごとの時間 (秒)
+    def __init__(self, kind):
+        self.kind = kind
+        self.started_at = time.time()
+        self.phases = {}
+        self.total = None
+        # lap() 用: 前回の区切りの時刻と、それ以降に phase() で測った (入れ子でない) 時間
+        self._depth = 0
+        self._start = self._mark = time.perf_counter()
+        self._covered = 0.0
+
+    def add(self, name, elapsed):
+        # 同じ名前のフェーズが何度も呼ばれた場合は合計する
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def to_record(self):
+        return {
+            "ts": round(self.started_at, 3),
+            "kind": self.kind,
+            "total_ms": round(self.total * 1000, 3),
+            "phases_ms": {name: round(t * 1000, 3) for name, t in self.phases.items()},
+        }
+
+@contextmanager
+def _measure(timings, name):
+    timings._depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timings._depth -= 1
+        timings.add(name, elapsed)
+        if timings._depth == 0:
+            timings._covered += elapsed
+
+def current():
+    return _CURRENT.get()
+
+def phase(name):
+    # with phase("simulate"): ... の形で使う。入れ子にしてもよい (内側の時間は外側にも含まれる)
+    timings = _CURRENT.get()
+    if timings is None:
+        return _NULL
+    return _measure(timings, name)
+
+def lap(name):
+    # 前回の lap (なければ実行の開始) からの時間を name として記録する。間に phase() で測った分は除く
+    # with で囲みにくい長い区間 (入力欄を並べる部分など) に使う
+    timings = _CURRENT.get()
+    if timings is None:
+        return
+    now = time.perf_counter()
+    timings.add(name, now - timings._mark - timings._covered)
+    timings._mark = now
+    timings._covered = 0.0
+
+@contextmanager
+def run(kind, on_finish=None, enabled=True):
+    # 計測する実行の範囲。すでに計測中なら (フラグメントが本体の実行中に呼ばれた場合など) その実行に含める
+    if not enabled or _CURRENT.get() is not None:
+        yield _CURRENT.get()
+        return
+    timings = RunTimings(kind)
+    token = _CURRENT.set(timings)
+    try:
+        yield timings
+    finally:
+        timings.total = time.perf_counter() - timings._start
+        _CURRENT.reset(token)
+        if on_finish is not None:
+            on_finish(timings)
+
+# --- 集計 ---
+
+def summarize(records):
+    # records: to_record() のリスト。フェーズごとの p50 / p95 (ミリ秒) と件数を返す
+    import numpy as np
+    samples = {}
+    for record in records:
+        samples.setdefault("total", []).append(record["total_ms"])
+        for name, ms in record["phases_ms"].items():
+            samples.setdefault(name, []).append(ms)
+    return {
+        name: {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95)), "count": len(values)}
+        for name, values in samples.items()
+    }
+
+def to_jsonl(records):
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
@@ -0,0 +1,154 @@
+import numpy as np
+
+from batch_engine import simulate_batch
+from engine import SimulationCache, config_hash, normalize_config
+
+# ==========================================
+# 感度分析 (トルネード図)
+# 数値の入力を1つずつ上下に少し動かし、最終年齢の総資産と資金が尽きる年齢がどれだけ変わるかを比べる。
+# 動かした設定 (項目数 × 2) と元の設定をまとめて1回のベクトル化計算に流すので、元の設定は1回しか計算しない。
+# ==========================================
+
+# 動かす項目: キー → (表示名, 最小値, 最大値, 動かし方) ※範囲は入力欄と同じ
+# 動かし方 "pct": 今の値の ±pct %  /  "point": ±point (% の項目)  /  "year": ±years 歳
+# 計画の範囲 (current_age, end_age) は動かさない
+SENSITIVITY_PARAMS = {
+    "ini_cash": ("貯蓄 (現金)", 0, 10000, "pct"),
+    "ini_401k": ("401k (確定拠出)", 0, 10000, "pct"),
+    "ini_nisa": ("新NISA", 0, 10000, "pct"),
+    "ini_paypay": ("他運用", 0, 10000, "pct"),
+    "r_cash": ("貯蓄金利", 0.0, 10.0, "point"),
+    "r_401k": ("401k年利", 0.0, 30.0, "point"),
+    "r_nisa": ("新NISA年利", 0.0, 30.0, "point"),
+    "r_paypay": ("他運用年利", 0.0, 50.0, "point"),
+    "inflation": ("インフレ率", -5.0, 20.0, "point"),
+    "age_work_last": ("何歳まで働く", 50, 90, "year"),
+    "inc_20s": ("〜29歳 手取り年収", 0, 5000, "pct"),
+    "inc_30s": ("30〜39歳 手取り年収", 0, 5000, "pct"),
+    "inc_40s": ("40〜49歳 手取り年収", 0, 5000, "pct"),
+    "inc_50s": ("50〜59歳 手取り年収", 0, 5000, "pct"),
+    "inc_60s": ("60歳〜 手取り年収", 0, 5000, "pct"),
+    "age_401k_get": ("401k受取年齢", 50, 80, "year"),
+    "tax_401k": ("401k受取税率", 0.0, 50.0, "point"),
+    "age_pension": ("年金開始年齢", 60, 75, "year"),
+    "pension_monthly": ("年金月額", 0, 500000, "pct"),
+    "tax_pension": ("年金税・社会保険料率", 0.0, 50.0, "point"),
+    "cost_20s": ("〜29歳 生活費", 0, 500, "pct"),
+    "cost_30s": ("30代 生活費", 0, 500, "pct"),
+    "cost_40s": ("40代 生活費", 0, 500, "pct"),
+    "cost_50s": ("50代 生活費", 0, 500, "pct"),
+    "cost_6064": ("60〜64歳 生活費", 0, 500, "pct"),
+    "cost_65": ("65歳〜 生活費", 0, 500, "pct"),
+    "exp_20s": ("〜29歳 特別出費", 0, 5000, "pct"),
+    "exp_30s": ("30代 特別出費", 0, 5000, "pct"),
+    "exp_40s": ("40代 特別出費", 0, 5000, "pct"),
+    "exp_50s": ("50代 特別出費", 0, 5000, "pct"),
+    "exp_6064": ("60〜64歳 特別出費", 0, 5000, "pct"),
+    "exp_65": ("65歳〜 特別出費", 0, 5000, "pct"),
+    "nisa_monthly": ("NISA月額積立", 0, 500000, "pct"),
+    "nisa_stop_age": ("NISA積立終了年齢", 20, 100, "year"),
+    "paypay_monthly": ("他運用積立", 0, 1000000, "pct"),
+    "paypay_stop_age": ("他運用積立終了年齢", 20, 100, "year"),
+    "k401_monthly": ("401k積立", 0, 500000, "pct"),
+    "k401_stop_age": ("401k積立終了年齢", 20, 70, "year"),
+    "dam_1": ("〜49歳 最低貯蓄", 0, 10000, "pct"),
+    "dam_2": ("50代 最低貯蓄", 0, 10000, "pct"),
+    "dam_3": ("60歳〜 最低貯蓄", 0, 10000, "pct"),
+    "nisa_start_age": ("新NISA 解禁年齢", 50, 100, "year"),
+    "paypay_start_age": ("他運用 解禁年齢", 50, 100, "year"),
+    "limit_val_nisa_yen": ("NISA取崩し上限 (金額)", 0, 10000, "pct"),
+    "limit_val_nisa_pct": ("NISA取崩し上限 (割合)", 0.0, 100.0, "point"),
+    "limit_val_other_yen": ("他運用取崩し上限 (金額)", 0, 10000, "pct"),
+    "limit_val_other_pct": ("他運用取崩し上限 (割合)", 0.0, 100.0, "point"),
+    "tax_rate_other": ("他運用 取崩し税率", 0.0, 50.0, "point"),
+    "inc1_a": ("収入① 年齢", 0, 100, "year"),
+    "inc1_v": ("収入① 金額", 0, 10000, "pct"),
+    "inc2_a": ("収入② 年齢", 0, 100, "year"),
+    "inc2_v": ("収入② 金額", 0, 10000, "pct"),
+    "inc3_a": ("収入③ 年齢", 0, 100, "year"),
+    "inc3_v": ("収入③ 金額", 0, 10000, "pct"),
+    "dec1_a": ("支出① 年齢", 0, 100, "year"),
+    "dec1_v": ("支出① 金額", 0, 10000, "pct"),
+    "dec2_a": ("支出② 年齢", 0, 100, "year"),
+    "dec2_v": ("支出② 金額", 0, 10000, "pct"),
+    "dec3_a": ("支出③ 年齢", 0, 100, "year"),
+    "dec3_v": ("支出③ 金額", 0, 10000, "pct"),
+}
+
+METRICS = {"final_total": "最終年齢の総資産 (円)", "depletion_age": "資金が尽きる年齢 (歳)"}
+
+DEFAULT_PCT = 10.0
+DEFAULT_POINT = 1.0
+DEFAULT_YEARS = 1
+
+def nudged_values(base, pct=DEFAULT_PCT, point=DEFAULT_POINT, years=DEFAULT_YEARS):
+    # 戻り値: [(キー, 下げた値, 上げた値)]。入力欄の範囲に収め、上下どちらにも動かない項目 (0 の金額など) は除く
+    out = []
+    for key, (_, lo, hi, kind) in SENSITIVITY_PARAMS.items():
+        value = base[key]
+        if kind == "pct":
+            step = abs(value) * pct / 100
+        elif kind == "point":
+            step = point
+        else:
+            step = years
+        down = min(max(value - step, lo), hi)
+        up = min(max(value + step, lo), hi)
+        if kind == "year":
+            down, up = int(down), int(up)
+        else:
+            down, up = round(float(down), 6), round(float(up), 6)
+        if down != value or up != value:
+            out.append((key, down, up))
+    return out
+
+class SensitivityResult:
+    def __init__(self, nudges, base_total, base_depletion, final_total, depletion_age, end_age):
+        self.keys = [key for key, _, _ in nudges]
+        # (項目数, 2) の配列。列 0 が下げた場合、列 1 が上げた場合
+        self.values = [(down, up) for _, down, up in nudges]
+        self.base_total = int(base_total)
+        self.base_depletion = int(base_depletion)
+        self.final_total = final_total.reshape(-1, 2)
+        self.depletion_age = depletion_age.reshape(-1, 2)
+        self.end_age = end_age
+
+    @property
+    def nbytes(self):
+        return self.final_total.nbytes + self.depletion_age.nbytes
+
+    def deltas(self, metric):
+        # 元の設定との差 (項目数, 2)。資金が尽きない場合は「終了年齢 + 1 歳で尽きる」として差を取る
+        if metric == "final_total":
+            return self.final_total - self.base_total
+        never = self.end_age + 1
+        base = never if self.base_depletion < 0 else self.base_depletion
+        return np.where(self.depletion_age < 0, never, self.depletion_age) - base
+
+    def ranked(self, metric, top=None):
+        # 影響の大きい順 (上下の差の大きい方) の項目の番号。どちらに動かしても変わらない項目は除く
+        d = np.abs(self.deltas(metric)).max(axis=1)
+        order = [i for i in np.argsort(-d, kind="stable") if d[i] > 0]
+        return order[:top] if top is not None else order
+
+def run_sensitivity(config, pct=DEFAULT_PCT, point=DEFAULT_POINT, years=DEFAULT_YEARS):
+    base = normalize_config(config)
+    nudges = nudged_values(base, pct, point, years)
+    configs = [base]
+    for key, down, up in nudges:
+        configs.append(dict(base, **{key: down}))
+        configs.append(dict(base, **{key: up}))
+    result = simulate_batch(configs)
+    final_total = result.final("Total")
+    depletion = result.depletion_age()
+    return SensitivityResult(nudges, final_total[0], depletion[0], final_total[1:], depletion[1:], base["end_age"])
+
+SENSITIVITY_CACHE = SimulationCache(max_entries=32, max_bytes=4 * 1024 * 1024)
+
+def run_sensitivity_cached(config, pct=DEFAULT_PCT, point=DEFAULT_POINT, years=DEFAULT_YEARS, cache=SENSITIVITY_CACHE):
+    key = f"{config_hash(config)}|{pct}|{point}|{years}"
+    result = cache.get(key)
+    if result is None:
+        result = run_sensitivity(config, pct, point, years)
+        cache.put(key, result)
+    return result
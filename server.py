@@ -0,0 +1,287 @@
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from batch_engine import simulate_batch
+from engine import SimulationCache, config_hash, validate_config
+
+# ==========================================
+# シミュレーション HTTP サーバー (JSON)
+# 画面を通さずに、他のツールから年ごとの推移を取得するためのサーバー
+#
+#   python server.py --port 8765
+#   curl -s localhost:8765/simulate -d '{"current_age": 40, "end_age": 95}'
+#
+# POST /simulate : 設定 (DEFAULT_CONFIG と同じキー) 1件、または設定のリストを受け取り、年ごとの推移を返す
+# GET  /stats    : 待ち件数・応答時間 (p50/p95)・まとめ計算の件数・キャッシュの状況
+# GET  /health   : 死活確認
+#
+# 短い時間枠 (既定 5ms) に届いたリクエストは1回の simulate_batch にまとめて計算する。
+# 計算済みの設定は、結果の JSON ごとキャッシュしておき、そのまま返す。
+# ==========================================
+
+MAX_BODY_BYTES = 8 * 1024 * 1024
+MAX_CONFIGS_PER_REQUEST = 1000
+# listen() の待ち行列の長さ。既定の 5 では数百の同時接続で受け付ける前に接続が切られ、まとめ計算に届かない
+REQUEST_QUEUE_SIZE = 1024
+
+# 応答時間の統計に使う直近の件数
+LATENCY_WINDOW = 2000
+
+def encode_series(result, i, depletion):
+    # 1件分の結果を JSON のバイト列にする (キャッシュにはこの形で入れる)
+    lo = int(result.current_age[i] - result.ages[0])
+    hi = int(result.end_age[i] - result.ages[0]) + 1
+    series = {"Age": result.ages[lo:hi].tolist()}
+    for name, values in result.columns.items():
+        series[name] = values[i, lo:hi].tolist()
+    return json.dumps({
+        "depletion_age": None if depletion < 0 else int(depletion),
+        "series": series,
+    }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+class _Job:
+    def __init__(self, hashes, configs):
+        self.hashes = hashes
+        self.configs = configs
+        self.payloads = [None] * len(hashes)
+        self.error = None
+        self.done = threading.Event()
+
+class SimulationBatcher:
+    # リクエストを受け付けるスレッドから submit され、専用スレッドが時間枠ごとにまとめて計算する
+    def __init__(self, window_ms=5, max_batch=2000, cache=None):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.cache = cache or SimulationCache(max_entries=4096, max_bytes=256 * 1024 * 1024)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._latency = deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.configs = 0
+        self.batches = 0
+        self.batched_configs = 0
+        self.errors = 0
+        self._thread = threading.Thread(target=self._loop, name="simulation-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, configs):
+        # configs: validate_config 済みの設定のリスト。戻り値は各設定の JSON バイト列
+        hashes = [config_hash(c) for c in configs]
+        payloads = [self.cache.get(h) for h in hashes]
+        missing = [j for j, p in enumerate(payloads) if p is None]
+        if missing:
+            # キャッシュにないものだけを計算スレッドに回す
+            job = _Job([hashes[j] for j in missing], [configs[j] for j in missing])
+            with self._lock:
+                self._pending += len(missing)
+            self._queue.put(job)
+            job.done.wait()
+            if job.error is not None:
+                raise job.error
+            for j, payload in zip(missing, job.payloads):
+                payloads[j] = payload
+        return payloads
+
+    def record(self, elapsed, n_configs, ok=True):
+        with self._lock:
+            self.requests += 1
+            self.configs += n_configs
+            if not ok:
+                self.errors += 1
+            self._latency.append(elapsed)
+
+    # --- 計算スレッド ---
+
+    def _collect(self):
+        # 最初の1件が届いてから時間枠が過ぎるか、件数が上限に達するまで集める
+        jobs = [self._queue.get()]
+        n = len(jobs[0].configs)
+        deadline = time.perf_counter() + self.window
+        while n < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                job = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            jobs.append(job)
+            n += len(job.configs)
+        return jobs
+
+    def _loop(self):
+        while True:
+            jobs = self._collect()
+            try:
+                self._run(jobs)
+            except Exception as e:
+                for job in jobs:
+                    job.error = e
+            finally:
+                with self._lock:
+                    self._pending -= sum(len(job.configs) for job in jobs)
+                for job in jobs:
+                    job.done.set()
+
+    def _run(self, jobs):
+        # 同じ設定は1回だけ計算する (キャッシュは submit 側で確認済み)
+        unique = {}
+        for job in jobs:
+            for h, c in zip(job.hashes, job.configs):
+                unique.setdefault(h, c)
+        try:
+            payloads = self._compute(unique)
+            failed = {}
+        except Exception:
+            # 1件の設定のせいで同じ時間枠の他のリクエストまで失敗しないよう、1件ずつ計算し直す
+            payloads, failed = {}, {}
+            for h, c in unique.items():
+                try:
+                    payloads.update(self._compute({h: c}))
+                except Exception as e:
+                    failed[h] = e
+        for job in jobs:
+            errors = [failed[h] for h in job.hashes if h in failed]
+            if errors:
+                job.error = errors[0]
+            else:
+                job.payloads = [payloads[h] for h in job.hashes]
+
+    def _compute(self, unique):
+        # {ハッシュ: 設定} をまとめて計算し、結果の JSON をキャッシュに入れて返す
+        result = simulate_batch(list(unique.values()))
+        depletion = result.depletion_age()
+        payloads = {}
+        for i, h in enumerate(unique):
+            payloads[h] = encode_series(result, i, depletion[i])
+            self.cache.put(h, payloads[h], len(payloads[h]))
+        with self._lock:
+            self.batches += 1
+            self.batched_configs += len(unique)
+        return payloads
+
+    def stats(self):
+        with self._lock:
+            latency = sorted(self._latency)
+            return {
+                "queue_depth": self._pending,
+                "requests": self.requests,
+                "configs": self.configs,
+                "errors": self.errors,
+                "batches": self.batches,
+                "avg_batch_size": self.batched_configs / self.batches if self.batches else None,
+                "latency_ms": {
+                    "p50": None if not latency else round(_percentile(latency, 50) * 1000, 3),
+                    "p95": None if not latency else round(_percentile(latency, 95) * 1000, 3),
+                    "samples": len(latency),
+                },
+                "cache": self.cache.stats(),
+            }
+
+# --- HTTP ---
+
+class SimulationHandler(BaseHTTPRequestHandler):
+    # keep-alive で同じ接続を使い回せるようにする (応答には必ず Content-Length を付ける)
+    protocol_version = "HTTP/1.1"
+    batcher = None
+
+    def log_message(self, format, *args):
+        # 1リクエストごとのログは出さない (件数が多いと標準エラーへの書き込みが律速になる)
+        pass
+
+    def _send(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, data):
+        self._send(status, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/stats":
+            self._send_json(200, self.batcher.stats())
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/simulate":
+            self._send_json(404, {"error": "not found"})
+            return
+        start = time.perf_counter()
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_BYTES:
+            # 本文を読まずに返すので、この接続は閉じる
+            self.close_connection = True
+            self._send_json(413, {"error": f"本文が大きすぎます (上限 {MAX_BODY_BYTES:,} バイト)"})
+            return
+        try:
+            data = json.loads(self.rfile.read(length) or b"null")
+            single = isinstance(data, dict)
+            items = [data] if single else data
+            if not isinstance(items, list) or not items:
+                raise ValueError("設定 (JSON オブジェクト) か、そのリストを送ってください")
+            if len(items) > MAX_CONFIGS_PER_REQUEST:
+                raise ValueError(f"1回に送れる設定は {MAX_CONFIGS_PER_REQUEST:,} 件までです")
+            configs = []
+            for j, item in enumerate(items):
+                try:
+                    configs.append(validate_config(item))
+                except ValueError as e:
+                    raise ValueError(str(e) if single else f"{j} 件目: {e}")
+        except ValueError as e:
+            # json.JSONDecodeError も ValueError
+            self.batcher.record(time.perf_counter() - start, 0, ok=False)
+            self._send_json(400, {"error": str(e)})
+            return
+        try:
+            payloads = self.batcher.submit(configs)
+        except Exception as e:
+            self.batcher.record(time.perf_counter() - start, len(configs), ok=False)
+            self._send_json(500, {"error": f"計算に失敗しました ({e})"})
+            return
+        self._send(200, payloads[0] if single else b"[" + b",".join(payloads) + b"]")
+        self.batcher.record(time.perf_counter() - start, len(configs))
+
+class SimulationServer(ThreadingHTTPServer):
+    # bind / listen の前にクラス属性として読まれるので、ここで待ち行列を長くしておく
+    request_queue_size = REQUEST_QUEUE_SIZE
+    daemon_threads = True
+
+def make_server(host="127.0.0.1", port=8765, window_ms=5, max_batch=2000):
+    handler = type("Handler", (SimulationHandler,), {"batcher": SimulationBatcher(window_ms, max_batch)})
+    return SimulationServer((host, port), handler)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="シミュレーションを HTTP (JSON) で提供するサーバーを起動します。")
+    parser.add_argument("--host", default="127.0.0.1", help="待ち受けるアドレス (既定: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="ポート番号 (既定: 8765)")
+    parser.add_argument("--window-ms", type=float, default=5, help="リクエストをまとめる時間枠 (ミリ秒, 既定: 5)")
+    parser.add_argument("--max-batch", type=int, default=2000, help="1回にまとめて計算する設定の上限 (既定: 2000)")
+    args = parser.parse_args(argv)
+
+    server = make_server(args.host, args.port, args.window_ms, args.max_batch)
+    print(f"http://{args.host}:{server.server_port}/simulate で待ち受けています (Ctrl+C で終了)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+from engine import depletion_age, normalize_config, simulate
+
+# ==========================================
+# 逆算ソルバー
+# 実際の推移 (engine.simulate) を繰り返し計算し、条件を満たす境目を二分探索で探す
+# ==========================================
+
+class Evaluator:
+    # 1つの基準設定に対して、(キー, 値) ごとの計算結果を覚えておく
+    def __init__(self, base_config):
+        self.base = normalize_config(base_config)
+        self.memo = {}
+        self.calls = 0
+
+    def __call__(self, key, value):
+        if (key, value) not in self.memo:
+            self.calls += 1
+            self.memo[(key, value)] = simulate(dict(self.base, **{key: value}))
+        return self.memo[(key, value)]
+
+class SolveResult:
+    def __init__(self, value, feasible, evaluations, upper=None):
+        self.value = value
+        self.feasible = feasible
+        self.evaluations = evaluations
+        # 探した範囲の上限 (届かなかったときの表示用)
+        self.upper = upper
+
+# 二分探索の前に単調かどうかを確かめる途中の点の数
+PROBES = 4
+
+def _scan_first_true(pred, lo, hi, tol):
+    # lo から tol 刻みで順に調べ、最初に True になる値 (無ければ None)
+    for v in [*range(lo, hi, tol), hi]:
+        if pred(v):
+            return v
+    return None
+
+def bisect_first_true(pred, lo, hi, tol=1):
+    # True になる最小の値 (tol 刻み) を返す。lo で既に True なら lo、調べた点が全部 False なら None
+    # 二分探索は pred が lo→hi で False→True と単調に変わるときだけ使う。両端と途中の PROBES 点で確かめ、
+    # True の後に False がある (単調でない) ときは lo から tol 刻みで全部調べる
+    if pred(lo):
+        return lo
+    points = sorted({lo, hi, *(lo + (hi - lo) * i // (PROBES + 1) // tol * tol for i in range(1, PROBES + 1))})
+    values = [False] + [pred(p) for p in points[1:]]
+    if values != sorted(values):
+        return _scan_first_true(pred, lo, hi, tol)
+    if not values[-1]:
+        return None
+    first = values.index(True)
+    lo, hi = points[first - 1], points[first]
+    while hi - lo > tol:
+        mid = lo + (hi - lo) // 2
+        if pred(mid):
+            hi = mid
+        else:
+            lo = mid
+    return hi
+
+def _total_at(result, age):
+    # 範囲外の年齢は最終年齢の値
+    if not result.current_age <= age <= result.end_age:
+        age = result.end_age
+    return result.value("Total", age)
+
+# --- 逆算メニュー ---
+
+def max_sustainable_cost(base_config, lo=0, hi=500, tol=1, evaluator=None):
+    # 終了年齢まで資金が尽きない、65歳〜の生活費 (月/万円) の最大値
+    ev = evaluator or Evaluator(base_config)
+    never_depleted = lambda v: depletion_age(ev("cost_65", v)) is None
+    # 「尽きない」は生活費について単調減少なので、反転させて探す
+    first_bad = bisect_first_true(lambda v: not never_depleted(v), lo, hi, tol)
+    if first_bad is None:
+        return SolveResult(hi, True, ev.calls)
+    if first_bad == lo:
+        return SolveResult(None, False, ev.calls)
+    return SolveResult(first_bad - tol, True, ev.calls)
+
+def earliest_retirement_age(base_config, target_total, target_age=None, lo=None, hi=None, evaluator=None):
+    # target_age 時点で総資産が target_total (円) 以上になる、最も早い「何歳まで働く」
+    # 範囲は指定がなければ今の年齢から target_age (終了年齢を超えない) まで。それより後まで働いても target_age の総資産は変わらない
+    ev = evaluator or Evaluator(base_config)
+    age = target_age or ev.base["end_age"]
+    lo = ev.base["current_age"] if lo is None else lo
+    hi = min(ev.base["end_age"], age) if hi is None else hi
+    value = bisect_first_true(lambda v: _total_at(ev("age_work_last", v), age) >= target_total, lo, max(hi, lo), 1)
+    return SolveResult(value, value is not None, ev.calls, max(hi, lo))
+
+def min_nisa_monthly(base_config, target_total, target_age=None, lo=0, hi=500000, step=1000, evaluator=None):
+    # target_age 時点で総資産が target_total (円) 以上になる、最小の NISA 月額積立 (step 円刻み)
+    ev = evaluator or Evaluator(base_config)
+    age = target_age or ev.base["end_age"]
+    value = bisect_first_true(lambda v: _total_at(ev("nisa_monthly", v * step), age) >= target_total,
+                              lo // step, hi // step, 1)
+    return SolveResult(None if value is None else value * step, value is not None, ev.calls, hi)
@@ -0,0 +1,95 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from engine import ProjectionResult, config_hash, normalize_config
+
+# ==========================================
+# シナリオの保存 (SQLite)
+# 設定は正規化した JSON のハッシュをキーに1件だけ持つので、同じ設定を何人が共有しても1行で済む。
+# 計算結果は圧縮して同じ行に入れておき、共有リンクを開いたときは計算せずにそのまま使う。
+# 合計サイズが上限を超えたら、最後に使われたのが古いものから消す。
+# ==========================================
+
+STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scenarios.sqlite3")
+
+# URL に載せる ID の長さ (config_hash の先頭、16進数)
+SCENARIO_ID_LENGTH = 12
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenarios (
+    id TEXT PRIMARY KEY,
+    config TEXT NOT NULL,
+    result BLOB,
+    nbytes INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL
+)
+"""
+
+def scenario_id(config):
+    return config_hash(config)[:SCENARIO_ID_LENGTH]
+
+class ScenarioStore:
+    # Streamlit の複数のセッション (スレッド) から使うので、1つの接続をロックで守る
+    def __init__(self, path=STORE_PATH, max_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS scenarios_last_used ON scenarios (last_used_at)")
+
+    def save(self, config, result=None):
+        # 戻り値: シナリオ ID。すでにある設定なら最終利用時刻だけ更新する (結果がまだ無ければ入れる)
+        c = normalize_config(config)
+        sid = scenario_id(c)
+        text = json.dumps(c, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        blob = None if result is None else result.to_bytes()
+        nbytes = len(text.encode("utf-8")) + (0 if blob is None else len(blob))
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO scenarios (id, config, result, nbytes, created_at, last_used_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET last_used_at = excluded.last_used_at, "
+                "result = COALESCE(scenarios.result, excluded.result), "
+                "nbytes = CASE WHEN scenarios.result IS NULL THEN excluded.nbytes ELSE scenarios.nbytes END",
+                (sid, text, blob, nbytes, now, now))
+            self._evict()
+        return sid
+
+    def load(self, sid):
+        # 戻り値: (設定, ProjectionResult または None)。見つからなければ None
+        with self._lock:
+            row = self._conn.execute("SELECT config, result FROM scenarios WHERE id = ?", (sid,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE scenarios SET last_used_at = ? WHERE id = ?", (time.time(), sid))
+        config = json.loads(row[0])
+        return config, None if row[1] is None else ProjectionResult.from_bytes(row[1])
+
+    def _evict(self):
+        # ロックを持った状態で呼ぶこと
+        total = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM scenarios").fetchone()[0]
+        excess = total - self.max_bytes
+        if excess <= 0:
+            return
+        victims = []
+        for sid, nbytes in self._conn.execute("SELECT id, nbytes FROM scenarios ORDER BY last_used_at"):
+            victims.append((sid,))
+            excess -= nbytes
+            if excess <= 0:
+                break
+        self._conn.executemany("DELETE FROM scenarios WHERE id = ?", victims)
+
+    def stats(self):
+        with self._lock:
+            entries, nbytes = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM scenarios").fetchone()
+        return {"entries": entries, "nbytes": nbytes, "max_bytes": self.max_bytes}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,128 @@
+import itertools
+import math
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from batch_engine import simulate_batch
+from engine import normalize_config
+
+# ==========================================
+# パラメータスイープ
+# 2〜3個の入力を格子状に振り、プロセスプールで一括評価する
+# ==========================================
+
+# スイープできる項目: キー → (表示名, 最小値, 最大値) ※範囲は入力欄と同じ
+SWEEP_PARAMS = {
+    "age_work_last": ("何歳まで働く", 50, 90),
+    "nisa_monthly": ("NISA月額積立(円)", 0, 500000),
+    "paypay_monthly": ("他運用積立(月/円)", 0, 1000000),
+    "k401_monthly": ("401k積立(月/円)", 0, 500000),
+    "cost_6064": ("60〜64歳 生活費(万)", 0, 500),
+    "cost_65": ("65歳〜 生活費(万)", 0, 500),
+    "r_nisa": ("新NISA年利(%)", 0.0, 30.0),
+    "r_paypay": ("他運用年利(%)", 0.0, 50.0),
+    "r_401k": ("401k年利(%)", 0.0, 30.0),
+    "inflation": ("インフレ率(%)", -5.0, 20.0),
+    "pension_monthly": ("年金月額(円)", 0, 500000),
+    "age_pension": ("年金開始年齢", 60, 75),
+    "nisa_start_age": ("新NISA 解禁年齢", 50, 100),
+    "paypay_start_age": ("他運用 解禁年齢", 50, 100),
+    "dam_3": ("60歳〜 最低貯蓄(万)", 0, 10000),
+}
+
+METRICS = {"final_total": "最終年齢の総資産 (円)", "depletion_age": "資金が尽きる年齢 (歳)"}
+
+def axis_values(key, lo, hi, steps):
+    # 整数の項目は整数に丸め、重複を除いて並べる
+    values = np.linspace(lo, hi, steps)
+    if isinstance(SWEEP_PARAMS[key][1], int):
+        return sorted(set(int(round(v)) for v in values))
+    return [round(float(v), 4) for v in values]
+
+def _evaluate_chunk(base_config, keys, points):
+    configs = [dict(base_config, **dict(zip(keys, point))) for point in points]
+    result = simulate_batch(configs)
+    return result.final("Total"), result.depletion_age()
+
+# --- プロセスプール (呼び出しのたびに作り直さないよう使い回す) ---
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_pool(max_workers=None):
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            # Streamlit のスレッドから fork すると危ないので spawn で起動する
+            _POOL = ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(),
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _POOL
+
+def shutdown_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.shutdown(cancel_futures=True)
+            _POOL = None
+
+# --- スイープ本体 ---
+
+def iter_sweep(base_config, axes, chunk_size=None, pool=None):
+    # axes: [(key, [値, ...]), ...]。終わったチャンクから (平坦化した添字の範囲, 最終総資産, 尽きる年齢) を順に返す
+    base = normalize_config(base_config)
+    keys = [key for key, _ in axes]
+    points = list(itertools.product(*[values for _, values in axes]))
+    pool = pool or get_pool()
+    if chunk_size is None:
+        chunk_size = max(1, math.ceil(len(points) / ((os.cpu_count() or 1) * 4)))
+
+    futures = {}
+    for lo in range(0, len(points), chunk_size):
+        hi = min(lo + chunk_size, len(points))
+        futures[pool.submit(_evaluate_chunk, base, keys, points[lo:hi])] = (lo, hi)
+    try:
+        for future in as_completed(futures):
+            lo, hi = futures[future]
+            final_total, depletion = future.result()
+            yield lo, hi, final_total, depletion
+    finally:
+        for future in futures:
+            future.cancel()
+
+class SweepResult:
+    def __init__(self, axes):
+        self.axes = axes
+        self.shape = tuple(len(values) for _, values in axes)
+        size = math.prod(self.shape)
+        self.final_total = np.zeros(size, dtype=np.int64)
+        self.depletion_age = np.full(size, -1, dtype=np.int64)
+        self.done = np.zeros(size, dtype=bool)
+
+    def update(self, lo, hi, final_total, depletion):
+        self.final_total[lo:hi] = final_total
+        self.depletion_age[lo:hi] = depletion
+        self.done[lo:hi] = True
+
+    @property
+    def progress(self):
+        return float(self.done.mean())
+
+    def grid(self, metric):
+        # 未計算のマスと「尽きない」マスは NaN
+        values = self.final_total if metric == "final_total" else self.depletion_age
+        values = np.where(self.done, values, np.nan).astype(np.float64)
+        if metric == "depletion_age":
+            values[values < 0] = np.nan
+        return values.reshape(self.shape)
+
+def run_sweep(base_config, axes, chunk_size=None, pool=None, on_chunk=None):
+    result = SweepResult(axes)
+    for lo, hi, final_total, depletion in iter_sweep(base_config, axes, chunk_size, pool):
+        result.update(lo, hi, final_total, depletion)
+        if on_chunk is not None:
+            on_chunk(result)
+    return result
@@ -0,0 +1,46 @@
+import json
+
+import pandas as pd
+
+import batch_cli
+from engine import DEFAULT_CONFIG
+
+def write_jsonl(path, configs):
+    path.write_text("".join(json.dumps(c) + "\n" for c in configs), encoding="utf-8")
+    return str(path)
+
+def test_out_of_range_line_is_reported(tmp_path):
+    source = write_jsonl(tmp_path / "configs.jsonl", [{"current_age": 40}, {"inflation": 1e308}, {"current_age": 50}])
+    done, errors = batch_cli.run_batch(source, str(tmp_path / "out"))
+    assert (done, errors) == (2, ["configs.jsonl:2"])
+    summary = pd.read_csv(tmp_path / "out" / "summary.csv")
+    assert list(summary["config_id"]) == ["configs.jsonl:1", "configs.jsonl:3"]
+
+def test_unknown_option_line_is_reported(tmp_path):
+    # 知らない step_mode を年次として計算して、そのまま summary.csv に書かない
+    source = write_jsonl(tmp_path / "configs.jsonl", [{"step_mode": "foo"}, {"step_mode": "月次"}])
+    done, errors = batch_cli.run_batch(source, str(tmp_path / "out"))
+    assert (done, errors) == (1, ["configs.jsonl:1"])
+    summary = pd.read_csv(tmp_path / "out" / "summary.csv")
+    assert list(summary["step_mode"]) == ["月次"]
+
+def test_chunk_failure_is_isolated(tmp_path, monkeypatch):
+    # 読み込みを通った設定でも、計算で失敗したものだけを除いて書き出す
+    simulate_batch = batch_cli.simulate_batch
+
+    def flaky(configs):
+        if any(c["current_age"] == 44 for c in configs):
+            raise OverflowError("Numerical result out of range")
+        return simulate_batch(configs)
+
+    monkeypatch.setattr(batch_cli, "simulate_batch", flaky)
+    configs = [{"current_age": 40}, {"current_age": 44}, {"current_age": 50, "step_mode": "月次"}, {"current_age": 60}]
+    source = write_jsonl(tmp_path / "configs.jsonl", configs)
+    done, errors = batch_cli.run_batch(source, str(tmp_path / "out"), chunk_size=3)
+    assert (done, errors) == (3, ["configs.jsonl:2"])
+    summary = pd.read_csv(tmp_path / "out" / "summary.csv")
+    assert list(summary["current_age"]) == [40, 50, 60]
+    yearly = pd.read_csv(tmp_path / "out" / "yearly.csv")
+    expected = simulate_batch([dict(DEFAULT_CONFIG, **configs[2])])
+    got = yearly[yearly["config_id"] == "configs.jsonl:3"]["Total"].tolist()
+    assert got == expected.series(0, "Total").tolist()
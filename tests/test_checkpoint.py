@@ -0,0 +1,71 @@
+import pytest
+
+from engine import DEFAULT_CONFIG, STEP_MODES, Checkpoint, simulate
+
+# 前の計算から1項目 (または数項目) だけ変えた設定。途中から再開しても、最初から計算したのと1円単位で同じになる
+CHANGES = [
+    dict(cost_65=40),
+    dict(inc_50s=900, exp_50s=300),
+    dict(dam_3=2000),
+    dict(age_work_last=58),
+    dict(inflation=4.0),
+    dict(nisa_stop_age=50),
+    dict(k401_stop_age=45),
+    dict(age_pension=70, pension_monthly=150000),
+    dict(age_401k_get=60),
+    dict(inc1_v=800),
+    dict(dec1_a=45),
+    dict(nisa_start_age=55, limit_mode_nisa="総資産比率 (%)", limit_val_nisa_pct=4.0),
+    dict(paypay_start_age=75, tax_rate_other=20.315),
+    dict(priority="他運用から先に使う"),
+    dict(end_age=90),
+    dict(end_age=120),
+]
+
+# 効き始める年齢が current_age 以前 (またはその翌年) の変更は、先頭から計算し直す
+FULL_RUN_CHANGES = [
+    dict(current_age=40),
+    dict(cost_30s=40),
+    dict(ini_cash=1000),
+    dict(r_nisa=3.0),
+    dict(inc1_a=30),
+    # 使っていない臨時収入 (年齢 0) を使い始めるときも、年齢 0 から効くとみなす
+    dict(inc2_a=70, inc2_v=3000),
+]
+
+@pytest.mark.parametrize("step_mode", STEP_MODES)
+@pytest.mark.parametrize("change", CHANGES, ids=lambda c: ",".join(c))
+def test_resume_matches_full_run(step_mode, change):
+    base = dict(DEFAULT_CONFIG, step_mode=step_mode)
+    checkpoint = Checkpoint()
+    assert checkpoint.simulate(base).records() == simulate(base).records()
+    new = dict(base, **change)
+    assert checkpoint.simulate(new).records() == simulate(new).records()
+    assert checkpoint.resumed_from is not None and checkpoint.resumed_from > new["current_age"]
+
+@pytest.mark.parametrize("step_mode", STEP_MODES)
+@pytest.mark.parametrize("change", FULL_RUN_CHANGES, ids=lambda c: ",".join(c))
+def test_change_at_or_before_current_age_runs_in_full(step_mode, change):
+    base = dict(DEFAULT_CONFIG, step_mode=step_mode)
+    checkpoint = Checkpoint()
+    checkpoint.simulate(base)
+    new = dict(base, **change)
+    assert checkpoint.simulate(new).records() == simulate(new).records()
+    assert checkpoint.resumed_from is None
+
+@pytest.mark.parametrize("old_mode, new_mode", [STEP_MODES, STEP_MODES[::-1]])
+def test_step_mode_change_runs_in_full(old_mode, new_mode):
+    # 年次と月次では年ごとの状態の中身が違うので、途中から再開しない
+    checkpoint = Checkpoint()
+    checkpoint.simulate(dict(DEFAULT_CONFIG, step_mode=old_mode))
+    new = dict(DEFAULT_CONFIG, step_mode=new_mode, cost_65=40)
+    assert checkpoint.simulate(new).records() == simulate(new).records()
+    assert checkpoint.resumed_from is None
+
+def test_resume_chain_matches_full_run():
+    # 続けて何回も変えても、毎回最初から計算したのと同じ
+    checkpoint = Checkpoint()
+    config = dict(DEFAULT_CONFIG)
+    for change in CHANGES + FULL_RUN_CHANGES:
+        config = dict(config, **change)
+        assert checkpoint.simulate(config).records() == simulate(config).records()
@@ -0,0 +1,32 @@
+import time
+
+from engine import DEFAULT_CONFIG
+from jobs import JobSlot
+from montecarlo import STREAMING_MIN_PATHS, MonteCarloCheckpoint, run_montecarlo_cached
+
+class _NoCache:
+    def get(self, key):
+        return None
+
+    def put(self, key, value, nbytes=None):
+        pass
+
+def test_montecarlo_without_streaming_reports_and_cancels():
+    # 分割しないパス数でも1年ごとに進み具合を知らせ、取り消せば途中で止まる
+    config = dict(DEFAULT_CONFIG, step_mode="月次")
+    n_paths = STREAMING_MIN_PATHS
+    checkpoint = MonteCarloCheckpoint()
+    slot = JobSlot()
+    job = slot.submit("a", lambda report: run_montecarlo_cached(
+        config, n_paths, seed=1, cache=_NoCache(), checkpoint=checkpoint,
+        on_progress=lambda progress: report(progress=progress)))
+    deadline = time.perf_counter() + 30
+    while job.progress == 0 and not job.done and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    assert 0 < job.progress < 1
+    # 新しい入力のジョブを出すと、古い方はすぐに止まる
+    slot.submit("b", lambda report: None)
+    assert job.wait(5)
+    assert job.cancelled and job.result is None and job.error is None
+    # 止まった計算は途中状態を残さない
+    assert checkpoint.result is None
@@ -0,0 +1,39 @@
+import pytest
+
+from engine import DEFAULT_CONFIG, STEP_MODES, depletion_age, simulate
+from jump_engine import project_final, simulate_jump
+
+# 区切り飛ばしエンジンが engine.simulate と1円単位で一致することを確かめる固定の設定
+# 区切りの間を式で飛ばす区間が長い設定・飛ばした区間の中で資金が尽きる設定・取り崩しが続く設定を含める
+VARIANTS = [
+    {},
+    dict(current_age=20, end_age=120, inc1_v=0, dec1_v=0),
+    dict(current_age=20, end_age=120, ini_cash=5000, ini_nisa=3000, age_work_last=50, cost_65=15, inflation=0.0),
+    dict(current_age=40, end_age=110, age_work_last=50, cost_50s=60, cost_6064=60, cost_65=60, inflation=0.0,
+         dam_1=0, dam_2=0, dam_3=0),
+    dict(current_age=25, end_age=100, nisa_monthly=300000, inflation=0.0),
+    dict(current_age=60, end_age=120, ini_cash=8000, ini_nisa=0, ini_paypay=0, ini_401k=0, age_work_last=60,
+         cost_65=10, exp_65=0, pension_monthly=0, inflation=0.0, dam_3=0),
+    dict(tax_rate_other=20.315, paypay_monthly=30000, priority="他運用から先に使う",
+         limit_mode_nisa="総資産比率 (%)", limit_val_nisa_pct=4.0, limit_mode_other="残高比率 (%)", limit_val_other_pct=5.0),
+    dict(cost_65=40, exp_65=120, nisa_start_age=55, paypay_start_age=70, inflation=3.5,
+         inc2_a=70, inc2_v=300, dec2_a=45, dec2_v=800),
+]
+
+CASES = [(step, i) for step in STEP_MODES for i in range(len(VARIANTS))]
+
+@pytest.mark.parametrize("step_mode, variant", CASES)
+def test_jump_matches_engine(step_mode, variant):
+    config = dict(DEFAULT_CONFIG, step_mode=step_mode, **VARIANTS[variant])
+    expected = simulate(config)
+    assert simulate_jump(config).records() == expected.records()
+    final = project_final(config)
+    assert final.final_total == expected.columns["Total"][-1]
+    assert final.depletion_age == depletion_age(expected)
+
+@pytest.mark.parametrize("step_mode", STEP_MODES)
+def test_fixtures_skip_spans(step_mode):
+    # 式で飛ばす区間を通らない比較にならないように、飛ばす区間があること・資金が尽きる設定があることを確かめる
+    finals = [project_final(dict(DEFAULT_CONFIG, step_mode=step_mode, **v)) for v in VARIANTS]
+    assert sum(len(f.spans) for f in finals) >= len(VARIANTS)
+    assert any(f.depletion_age is not None and f.spans for f in finals)
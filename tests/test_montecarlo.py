@@ -0,0 +1,30 @@
+import threading
+
+import numpy as np
+
+from engine import DEFAULT_CONFIG
+from montecarlo import run_montecarlo_streaming
+
+MEMORY_LIMIT = 16 * 1024 * 1024
+
+def test_concurrent_streaming_runs_size_chunks_alike():
+    # 画面の複数セッションが同時に計算しても、塊の分け方・peak_bytes・結果は1件ずつ計算したときと同じ
+    config = DEFAULT_CONFIG
+    alone = run_montecarlo_streaming(config, 20000, seed=1, memory_limit=MEMORY_LIMIT)
+    assert alone.n_chunks > 1
+    assert alone.peak_bytes <= MEMORY_LIMIT
+
+    results = [None] * 2
+
+    def run(i):
+        results[i] = run_montecarlo_streaming(config, 20000, seed=1, memory_limit=MEMORY_LIMIT)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(results))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for result in results:
+        assert (result.n_chunks, result.peak_bytes) == (alone.n_chunks, alone.peak_bytes)
+        assert all(np.array_equal(result.bands[p], alone.bands[p]) for p in alone.bands)
+        assert np.array_equal(result.ruin_prob, alone.ruin_prob)
@@ -0,0 +1,85 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import urllib.error
+import urllib.request
+
+import pytest
+
+from engine import normalize_config, validate_config
+from server import SimulationBatcher, make_server
+
+def test_bad_config_does_not_fail_its_batch():
+    # 計算できない設定 (validate_config を通していない) と正しい設定が同じ時間枠に入っても、正しい方は結果が返る
+    batcher = SimulationBatcher(window_ms=200)
+    bad = normalize_config({"inflation": 1e308})
+    good = validate_config({"current_age": 41, "end_age": 95})
+    outcome = {}
+
+    def submit(name, config):
+        try:
+            outcome[name] = batcher.submit([config])[0]
+        except Exception as e:
+            outcome[name] = e
+
+    threads = [threading.Thread(target=submit, args=(name, c)) for name, c in (("bad", bad), ("good", good))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert isinstance(outcome["bad"], OverflowError)
+    series = json.loads(outcome["good"])["series"]
+    assert series["Age"][0] == 41 and series["Age"][-1] == 95
+    # 成功した方はキャッシュに入り、次は計算せずに返る
+    batches = batcher.batches
+    assert batcher.submit([good])[0] == outcome["good"]
+    assert batcher.batches == batches
+
+@pytest.mark.parametrize("config", [
+    {"inflation": 1e308},
+    {"current_age": 80, "end_age": 80.5},
+    {"current_age": 33.5},
+    {"end_age": 3000},
+    # 選択肢の項目に選択肢にない値・文字列以外
+    {"step_mode": {"a": 1}},
+    {"priority": ["x"]},
+    {"limit_mode_nisa": "毎月定額"},
+    {"cost_basis": None},
+])
+def test_out_of_range_config_is_400(config):
+    server = make_server(port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        request = urllib.request.Request(f"http://127.0.0.1:{server.server_port}/simulate",
+                                         data=json.dumps(config).encode("utf-8"))
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(request)
+        assert e.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_burst_of_clients_is_accepted():
+    # 負荷試験: 400 の接続を一度に開いても、どれも切られずに結果が返る
+    # (listen() の待ち行列が既定の 5 のままだと、一部が ConnectionResetError になっていた。REQUEST_QUEUE_SIZE を参照)
+    server = make_server(port=0, window_ms=20)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    start = threading.Barrier(400)
+
+    def post(i):
+        request = urllib.request.Request(f"http://127.0.0.1:{server.server_port}/simulate",
+                                         data=json.dumps({"current_age": 20 + i % 60}).encode("utf-8"))
+        start.wait()
+        with urllib.request.urlopen(request, timeout=60) as response:
+            return response.status
+
+    try:
+        with ThreadPoolExecutor(400) as pool:
+            statuses = list(pool.map(post, range(400)))
+        assert statuses == [200] * 400
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,60 @@
+from engine import DEFAULT_CONFIG, depletion_age, simulate
+from solver import bisect_first_true, earliest_retirement_age, max_sustainable_cost, min_nisa_monthly
+
+def total_at(config, age):
+    return simulate(config).value("Total", age)
+
+def test_bisect_checks_lo_first():
+    calls = []
+    pred = lambda v: calls.append(v) or True
+    assert bisect_first_true(pred, 0, 100) == 0
+    assert calls == [0]
+
+def test_bisect_monotone():
+    assert bisect_first_true(lambda v: v >= 37, 0, 100) == 37
+    assert bisect_first_true(lambda v: v >= 37, 0, 100, tol=5) == 40
+    assert bisect_first_true(lambda v: False, 0, 100) is None
+
+def test_bisect_falls_back_to_scan():
+    # 途中の点で True の後に False があるので、二分探索ではなく端から調べる
+    pred = lambda v: 15 <= v <= 30 or v >= 90
+    assert bisect_first_true(pred, 0, 100) == 15
+
+def test_max_sustainable_cost():
+    result = max_sustainable_cost(DEFAULT_CONFIG)
+    assert result.feasible
+    assert depletion_age(simulate(dict(DEFAULT_CONFIG, cost_65=result.value))) is None
+    assert depletion_age(simulate(dict(DEFAULT_CONFIG, cost_65=result.value + 1))) is not None
+
+def test_earliest_retirement_age():
+    target = 5000 * 10000
+    result = earliest_retirement_age(DEFAULT_CONFIG, target, 65)
+    assert result.feasible
+    assert total_at(dict(DEFAULT_CONFIG, age_work_last=result.value), 65) >= target
+    assert total_at(dict(DEFAULT_CONFIG, age_work_last=result.value - 1), 65) < target
+
+def test_earliest_retirement_age_searches_from_current_age():
+    # 今の年齢で辞めても届くなら、入力欄の下限 (50歳) ではなく今の年齢を返す
+    config = dict(DEFAULT_CONFIG, current_age=30, ini_cash=20000)
+    assert total_at(dict(config, age_work_last=30), 65) >= 1000 * 10000
+    result = earliest_retirement_age(config, 1000 * 10000, 65)
+    assert result.value == 30
+
+def test_earliest_retirement_age_upper_bound():
+    result = earliest_retirement_age(DEFAULT_CONFIG, 10 ** 13, 65)
+    assert not result.feasible
+    assert result.upper == 65
+
+def test_min_nisa_monthly():
+    target = 8000 * 10000
+    result = min_nisa_monthly(DEFAULT_CONFIG, target, 65)
+    assert result.feasible
+    assert total_at(dict(DEFAULT_CONFIG, nisa_monthly=result.value), 65) >= target
+    assert total_at(dict(DEFAULT_CONFIG, nisa_monthly=result.value - 1000), 65) < target
+
+def test_min_nisa_monthly_when_saving_more_lowers_total():
+    # NISA の利回りが現金より低いと、積立を増やすほど総資産が減る。積立 0 で届くので 0 を返す
+    config = dict(DEFAULT_CONFIG, r_nisa=0, r_cash=3.0, nisa_monthly=50000)
+    assert total_at(dict(config, nisa_monthly=0), 65) >= 1000 * 10000
+    result = min_nisa_monthly(config, 1000 * 10000, 65)
+    assert result.feasible and result.value == 0